@@ -43,6 +43,8 @@ from cartridge.shop.forms import DiscountAdminForm, ImageWidget, MoneyWidget
 from cartridge.shop.models import Category, Product, ProductImage
 from cartridge.shop.models import ProductVariation, ProductOption, Order
 from cartridge.shop.models import OrderItem, Sale, DiscountCode
+from cartridge.shop.models import ShippingZone, ShippingPostcodeRange
+from cartridge.shop.models import ShippingRate, TaxRate
 
 
 # Lists of field names.
@@ -288,6 +290,16 @@ class SaleAdmin(admin.ModelAdmin):
         (_("Sale period"), {"fields": (("valid_from", "valid_to"),)}),
     )
 
+    def save_related(self, request, form, formsets, change):
+        """
+        Sync the sale with its products once the products and
+        categories selected have been saved, since products no longer
+        selected aren't handled by the ``sale_update_products``
+        signal when the selection is cleared.
+        """
+        super(SaleAdmin, self).save_related(request, form, formsets, change)
+        form.instance.sync_products()
+
 
 class DiscountCodeAdmin(admin.ModelAdmin):
     list_display = ("title", "active", "code", "discount_deduct",
@@ -310,6 +322,34 @@ class DiscountCodeAdmin(admin.ModelAdmin):
     )
 
 
+class ShippingPostcodeRangeInline(admin.TabularInline):
+    model = ShippingPostcodeRange
+    extra = 1
+
+
+class ShippingRateInline(admin.TabularInline):
+    model = ShippingRate
+    extra = 1
+    formfield_overrides = {MoneyField: {"widget": MoneyWidget}}
+
+
+class ZoneTaxRateInline(admin.TabularInline):
+    model = TaxRate
+    extra = 0
+
+
+class ShippingZoneAdmin(admin.ModelAdmin):
+    list_display = ("title", "countries")
+    inlines = (ShippingPostcodeRangeInline, ShippingRateInline,
+               ZoneTaxRateInline)
+
+
+class TaxRateAdmin(admin.ModelAdmin):
+    list_display = ("title", "zone", "rate", "includes_shipping")
+    list_editable = ("rate", "includes_shipping")
+    list_filter = ("zone",)
+
+
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(Product, ProductAdmin)
 if settings.SHOP_USE_VARIATIONS:
@@ -317,3 +357,5 @@ if settings.SHOP_USE_VARIATIONS:
 admin.site.register(Order, OrderAdmin)
 admin.site.register(Sale, SaleAdmin)
 admin.site.register(DiscountCode, DiscountCodeAdmin)
+admin.site.register(ShippingZone, ShippingZoneAdmin)
+admin.site.register(TaxRate, TaxRateAdmin)
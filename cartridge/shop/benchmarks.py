@@ -0,0 +1,385 @@
+"""
+Benchmarks for the shop's views and model operations, run by the
+``shop_benchmark`` management command against data created with
+``cartridge.shop.generator``. Each benchmark records its wall time,
+number of queries and peak memory, and the results of two runs can be
+compared with ``compare`` to flag regressions.
+
+A benchmark is a function registered with the ``benchmark`` decorator,
+that's given the ``BenchmarkData`` instance, does any setup required,
+and returns the function to be measured. It's called again for each
+repetition, so that each measured call starts from the same state.
+"""
+
+import os
+import resource
+import sys
+from csv import DictWriter
+from StringIO import StringIO
+from tempfile import mkstemp
+from time import time
+from traceback import format_exc
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.urlresolvers import reverse
+from django.db import connection, reset_queries
+from django.db.models import Count
+from django.test.client import Client, RequestFactory
+from django.utils.datastructures import SortedDict
+from django.utils.importlib import import_module
+from django.utils.timezone import now
+from django.utils import simplejson
+
+from mezzanine.conf import settings
+
+from cartridge.shop.checkout import CHECKOUT_STEPS
+from cartridge.shop.forms import OrderForm
+from cartridge.shop.management.commands import product_db
+from cartridge.shop.models import Cart, Category, Order, Product
+from cartridge.shop.models import ProductVariation, Sale
+from cartridge.shop.page_processors import category_processor
+from cartridge.shop.utils import CheckoutState
+
+
+BENCHMARKS = SortedDict()
+
+
+def benchmark(name):
+    """
+    Register the decorated function as the benchmark with the given
+    name.
+    """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+class BenchmarkData(object):
+    """
+    Objects from the generated data used by the benchmarks, along with
+    helpers for creating carts, sessions, clients and requests.
+    """
+
+    password = "benchmark"
+
+    def __init__(self, cart_items=10, orders=20):
+        self.cart_items = cart_items
+        categories = Category.objects.annotate(total=Count("products"))
+        self.category = categories.order_by("-total")[0]
+        products = Product.objects.annotate(total=Count("variations"))
+        self.product = products.order_by("-total")[0]
+        variations = ProductVariation.objects.select_related("product")
+        self.variations = list(variations.order_by("id")[:cart_items])
+        self.user = User.objects.create_user("benchmark", "", self.password)
+        order_ids = Order.objects.values_list("id", flat=True)[:orders]
+        Order.objects.filter(id__in=list(order_ids)).update(
+            user_id=self.user.id)
+        self.sale = Sale.objects.create(title="Benchmark", active=True,
+                                        discount_percent=10)
+        self.sale.categories.add(self.category)
+        self.engine = import_module(settings.SESSION_ENGINE)
+
+    def cart(self):
+        """
+        Create a cart containing the benchmark variations.
+        """
+        cart = Cart.objects.create(last_updated=now())
+        for variation in self.variations:
+            cart.add_item(variation, 1)
+        return cart
+
+    def session(self, **state):
+        session = self.engine.SessionStore()
+        CheckoutState(session).update(**state)
+        session.save()
+        return session
+
+    def client(self, cart=True, login=False):
+        """
+        Test client with a session containing a new cart.
+        """
+        client = Client()
+        if login:
+            client.login(username=self.user.username,
+                         password=self.password)
+        if cart:
+            session = self.session(cart=self.cart().id)
+            client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        return client
+
+    def request(self, path="/"):
+        """
+        Request with a session and a new cart, as set up by
+        ``ShopMiddleware``.
+        """
+        request = RequestFactory().get(path)
+        request.user = AnonymousUser()
+        request.cart = self.cart()
+        request.session = self.session(cart=request.cart.id)
+        request.wishlist = []
+        return request
+
+
+def order_data():
+    """
+    Post data for the final checkout step.
+    """
+    data = {"step": len(CHECKOUT_STEPS), "discount_code": "",
+            "billing_detail_email": "benchmark@example.com"}
+    for name, field in OrderForm(None, None).fields.items():
+        value = field.choices[-1][1] if hasattr(field, "choices") else "1"
+        data.setdefault(name, value)
+    return data
+
+
+@benchmark("product")
+def product_view(data):
+    client = data.client()
+    url = data.product.get_absolute_url()
+    return lambda: client.get(url)
+
+
+@benchmark("category_processor")
+def category_processor_view(data):
+    request = data.request()
+
+    def run():
+        context = category_processor(request, data.category)
+        list(context["products"].object_list)
+        list(context["child_categories"])
+    return run
+
+
+@benchmark("cart")
+def cart_view(data):
+    client = data.client()
+    url = reverse("shop_cart")
+    return lambda: client.get(url)
+
+
+@benchmark("wishlist")
+def wishlist_view(data):
+    client = data.client()
+    skus = [v.sku for v in data.variations]
+    client.cookies["wishlist"] = ",".join(skus)
+    url = reverse("shop_wishlist")
+    return lambda: client.get(url)
+
+
+@benchmark("checkout_steps")
+def checkout_steps_view(data):
+    client = data.client()
+    url = reverse("shop_checkout")
+    post = order_data()
+    return lambda: client.post(url, post)
+
+
+@benchmark("complete")
+def complete_view(data):
+    client = data.client()
+    client.post(reverse("shop_checkout"), order_data())
+    url = reverse("shop_complete")
+    return lambda: client.get(url)
+
+
+@benchmark("order_history")
+def order_history_view(data):
+    client = data.client(cart=False, login=True)
+    url = reverse("shop_order_history")
+    return lambda: client.get(url)
+
+
+@benchmark("Order.setup")
+def order_setup(data):
+    request = data.request()
+    order = Order(billing_detail_email="benchmark@example.com")
+    return lambda: order.setup(request)
+
+
+@benchmark("Order.complete")
+def order_complete(data):
+    request = data.request()
+    order = Order(billing_detail_email="benchmark@example.com")
+    order.setup(request)
+    return lambda: order.complete(request)
+
+
+@benchmark("Sale.update_products")
+def sale_update_products(data):
+    return data.sale.update_products
+
+
+@benchmark("Sale.sync_products")
+def sale_sync_products(data):
+    return data.sale.sync_products
+
+
+def quiet(func, *args):
+    """
+    Call the function with stdout suppressed, since the product_db
+    functions print as they go.
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        func(*args)
+    finally:
+        sys.stdout = stdout
+
+
+@benchmark("product_db export")
+def product_db_export(data):
+    return lambda: quiet(product_db.export_products, os.devnull)
+
+
+@benchmark("product_db import")
+def product_db_import(data):
+    handle, path = mkstemp(suffix=".csv")
+    prefix = "B%s" % int(time() * 1000)
+    with os.fdopen(handle, "w") as f:
+        writer = DictWriter(f, fieldnames=product_db.fieldnames)
+        writer.writerow(dict([(n, n) for n in product_db.fieldnames]))
+        for i in range(data.cart_items):
+            row = dict([(n, "") for n in product_db.fieldnames])
+            row.update({product_db.TITLE: "%s %s" % (prefix, i),
+                        product_db.SKU: "%s-%s" % (prefix, i),
+                        product_db.CATEGORY: data.category.title,
+                        product_db.SUB_CATEGORY: "Benchmark",
+                        product_db.UNIT_PRICE: "10",
+                        product_db.NUM_IN_STOCK: "10"})
+            writer.writerow(row)
+
+    def run():
+        try:
+            quiet(product_db.import_products, path)
+        finally:
+            os.remove(path)
+    return run
+
+
+def current_memory():
+    """
+    Current resident memory in kilobytes, where /proc is available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() / 1024
+
+
+def peak_memory():
+    """
+    Peak resident memory of the process in kilobytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak
+
+
+def measure(func, data, repeat):
+    """
+    Run the benchmark ``repeat`` times, returning the median, minimum
+    and maximum wall time, along with the number of queries and the
+    memory used by the last run.
+    """
+    connection.use_debug_cursor = True
+    baseline = current_memory()
+    times = []
+    for i in range(repeat):
+        run = func(data)
+        reset_queries()
+        start = time()
+        run()
+        times.append(time() - start)
+    queries = len(connection.queries)
+    reset_queries()
+    times.sort()
+    peak = peak_memory()
+    return {"time": times[len(times) // 2], "time_min": times[0],
+            "time_max": times[-1], "queries": queries,
+            "peak_memory_kb": peak,
+            "memory_growth_kb": peak - baseline if baseline else None}
+
+
+def run_isolated(func, data, repeat, fork=True):
+    """
+    Run ``measure`` in a forked process where possible, so that the
+    peak memory is only that of the benchmark, and so that changes it
+    makes in memory don't affect the benchmarks that follow. Any error
+    is returned as the result's ``error`` value.
+    """
+    def result():
+        try:
+            return measure(func, data, repeat)
+        except Exception:
+            return {"error": format_exc()}
+
+    if not fork or not hasattr(os, "fork"):
+        return result()
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        in_memory = (connection.vendor == "sqlite" and
+                     connection.settings_dict["NAME"] in ("", ":memory:"))
+        if not in_memory:
+            # Open a new connection rather than sharing the parent's.
+            connection.connection = None
+        with os.fdopen(write, "w") as f:
+            f.write(simplejson.dumps(result()))
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as f:
+        output = f.read()
+    os.waitpid(pid, 0)
+    try:
+        return simplejson.loads(output)
+    except ValueError:
+        return {"error": "Benchmark process exited without a result"}
+
+
+def run_benchmarks(names=None, repeat=5, cart_items=10, isolate=True,
+                   log=None):
+    """
+    Run the benchmarks with the given names, or all of them, returning
+    a dict of results for each.
+    """
+    log = log or (lambda message: None)
+    data = BenchmarkData(cart_items=cart_items)
+    results = SortedDict()
+    for name, func in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        log(name)
+        results[name] = run_isolated(func, data, repeat, isolate)
+    return results
+
+
+def compare(previous, current, tolerance=.2):
+    """
+    Compare two sets of results, returning a message for each
+    benchmark that's slower or uses more memory than previously by
+    more than the given fraction, or makes more queries.
+    """
+    regressions = []
+    for name, result in current.items():
+        before = previous.get(name)
+        if not before or "error" in before or "error" in result:
+            continue
+        if result["time"] > before["time"] * (1 + tolerance):
+            regressions.append("%s: time %.4fs, previously %.4fs" %
+                               (name, result["time"], before["time"]))
+        if result["queries"] > before["queries"]:
+            regressions.append("%s: %s queries, previously %s" %
+                               (name, result["queries"], before["queries"]))
+        growth, growth_before = (result.get("memory_growth_kb"),
+                                 before.get("memory_growth_kb"))
+        if (growth is not None and growth_before is not None and
+                growth > max(growth_before, 1024) * (1 + tolerance)):
+            regressions.append("%s: memory growth %skB, previously %skB" %
+                               (name, growth, growth_before))
+    return regressions
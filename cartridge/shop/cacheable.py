@@ -0,0 +1,216 @@
+"""
+Product and category pages that can be cached when the
+``SHOP_CACHEABLE_PAGES`` setting is ``True``. The pages are then
+rendered the same for all anonymous visitors, without their cart,
+wishlist or CSRF token, which are loaded with JavaScript from the
+``shop_cart_state`` view instead, and are given ``ETag`` and
+``Last-Modified`` headers from the version of the catalogue, so that
+browsers and caches in front of the site can revalidate them with
+conditional requests.
+
+The version of the catalogue is the time it was last changed, stored
+in the cache, and is changed when products, categories, pages or
+settings are saved or deleted, and when sales or price feeds are
+applied. During a request, the change is only recorded, and the
+version is changed by ``ShopMiddleware`` once the response is ready,
+so that a page rendered by another request before the changes are
+committed isn't cached under the new version. Stock levels aren't
+part of the pages, so orders don't change it. Products and pages can
+also be published, expire, or go on sale by date without being saved,
+so the next of these dates is found once for each version and stored
+along with it, and the version is changed once it has passed.
+"""
+
+from calendar import timegm
+from hashlib import md5
+from math import ceil
+from threading import local
+from time import mktime, time
+
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db.models import Min
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from django.utils.http import quote_etag
+from django.utils.timezone import is_aware, now
+from django.utils.translation import get_language
+
+from mezzanine.conf import settings
+from mezzanine.pages.models import Page
+
+from cartridge.shop.models import Product
+
+
+VERSION_KEY = "cartridge.shop.cacheable.version"
+CHANGE_KEY = "cartridge.shop.cacheable.change"
+
+# Whether changes are being recorded for the current request, and
+# whether any have been.
+_changes = local()
+
+
+def timestamp(value):
+    """
+    Returns the datetime as a timestamp.
+    """
+    if is_aware(value):
+        seconds = timegm(value.utctimetuple())
+    else:
+        seconds = mktime(value.timetuple())
+    return seconds + value.microsecond / 1000000.
+
+
+def next_change():
+    """
+    Returns the timestamp of the next date a product or page will be
+    published, expire, or have its sale start or end, or ``None`` if
+    there isn't one.
+    """
+    n = now()
+    dated = ((Page, ("publish_date", "expiry_date")),
+             (Product, ("publish_date", "expiry_date", "sale_from",
+                        "sale_to")))
+    dates = []
+    for model, names in dated:
+        for name in names:
+            later = model.objects.filter(**{"%s__gt" % name: n})
+            dates.append(later.aggregate(date=Min(name))["date"])
+    dates = [timestamp(date) for date in dates if date is not None]
+    return min(dates) if dates else None
+
+
+def get_version():
+    """
+    Returns the version of the catalogue, creating it if it doesn't
+    exist.
+    """
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, time())
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def get_change(version):
+    """
+    Returns the timestamp of the next date that will change the given
+    version of the catalogue, if any, finding it the first time it's
+    asked for.
+    """
+    stored = cache.get(CHANGE_KEY)
+    if stored is not None and stored[0] == version:
+        return stored[1]
+    change = next_change()
+    cache.set(CHANGE_KEY, (version, change))
+    return change
+
+
+def invalidate():
+    """
+    Change the version of the catalogue, so that cached pages are no
+    longer current.
+    """
+    cache.set(VERSION_KEY, time())
+
+
+def defer():
+    """
+    Record changes to the catalogue made from here on, rather than
+    changing the version straight away. Called by ``ShopMiddleware``
+    at the start of each request.
+    """
+    _changes.deferred = True
+    _changes.changed = False
+
+
+def changed():
+    """
+    Change the version of the catalogue, or record that it needs to
+    be changed once the current request's response is ready.
+    """
+    if getattr(_changes, "deferred", False):
+        _changes.changed = True
+    else:
+        invalidate()
+
+
+def flush():
+    """
+    Change the version of the catalogue if it was changed during the
+    current request. Called by ``ShopMiddleware`` once the response
+    is ready.
+    """
+    was_changed = getattr(_changes, "changed", False)
+    _changes.deferred = _changes.changed = False
+    if was_changed:
+        invalidate()
+
+
+def is_cacheable(request):
+    """
+    Returns whether the page for the request can be rendered without
+    anything particular to the visitor - only anonymous ``GET`` and
+    ``HEAD`` requests without messages waiting to be shown.
+    """
+    return (settings.SHOP_CACHEABLE_PAGES and
+            request.method in ("GET", "HEAD") and
+            not request.user.is_authenticated() and
+            not len(get_messages(request)))
+
+
+def get_etag(version):
+    return md5("%r:%s" % (version, get_language())).hexdigest()
+
+
+def get_last_modified(version):
+    return int(ceil(version))
+
+
+def conditional_response(request):
+    """
+    Marks the request as cacheable if it is, and returns a "304 Not
+    Modified" response if the visitor's copy of the page is current,
+    otherwise ``None``. ``ShopMiddleware`` adds the headers to the
+    response for requests marked as cacheable.
+    """
+    if not is_cacheable(request):
+        return None
+    version = get_version()
+    change = get_change(version)
+    if change is not None and time() >= change:
+        invalidate()
+        version = get_version()
+    request.shop_cacheable = True
+    request.shop_catalogue_version = version
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        if get_etag(version) not in etags and "*" not in etags:
+            return None
+    else:
+        if_modified_since = parse_http_date_safe(
+            request.META.get("HTTP_IF_MODIFIED_SINCE"))
+        if (if_modified_since is None or
+                if_modified_since < get_last_modified(version)):
+            return None
+    return add_headers(request, HttpResponseNotModified())
+
+
+def add_headers(request, response):
+    """
+    Adds the caching headers to the response for a request marked as
+    cacheable by ``conditional_response``, unless rendering the page
+    used the CSRF token, such as for a rating form, or set cookies.
+    """
+    if (getattr(request, "shop_cacheable", False) and
+            response.status_code in (200, 304) and
+            not request.META.get("CSRF_COOKIE_USED") and
+            not response.cookies):
+        version = request.shop_catalogue_version
+        response["ETag"] = quote_etag(get_etag(version))
+        response["Last-Modified"] = http_date(get_last_modified(version))
+        patch_cache_control(response, public=True,
+                            max_age=settings.SHOP_CACHEABLE_PAGES_MAX_AGE)
+    return response
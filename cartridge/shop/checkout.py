@@ -5,14 +5,17 @@ Checkout process utilities.
 from copy import copy
 
 from django.contrib.auth.models import SiteProfileNotAvailable
+from django.db import IntegrityError, transaction
 from django.utils.translation import ugettext as _
 from django.template.loader import get_template, TemplateDoesNotExist
 
 from mezzanine.conf import settings
 from mezzanine.utils.email import send_mail_template
 
-from cartridge.shop.models import Order
-from cartridge.shop.utils import set_shipping, set_tax, sign
+from cartridge.shop.editable import use_editable
+from cartridge.shop.instrumentation import timer
+from cartridge.shop.models import Cart, Order
+from cartridge.shop.utils import checkout_state, set_shipping, set_tax, sign
 
 
 class CheckoutError(Exception):
@@ -35,8 +38,8 @@ def default_billship_handler(request, order_form):
     ``cartridge.shop.utils.set_shipping``. The Cart object is also
     accessible via ``request.cart``
     """
-    if not request.session.get("free_shipping"):
-        settings.use_editable()
+    if not checkout_state(request).get("free_shipping"):
+        use_editable(request)
         set_shipping(request, _("Flat rate shipping"),
                      settings.SHOP_DEFAULT_SHIPPING_VALUE)
 
@@ -51,7 +54,7 @@ def default_tax_handler(request, order_form):
     ``cartridge.shop.utils.set_tax``. The Cart object is also
     accessible via ``request.cart``
     """
-    settings.use_editable()
+    use_editable(request)
     set_tax(request, _("Tax"), 0)
 
 
@@ -103,8 +106,12 @@ def initial_order_data(request, form_class=None):
         # it's missing from the POST data, to persist it not checked.
         data.setdefault("remember", "")
         return dict(data.items())
-    if "order" in request.session:
-        return request.session["order"]
+    state = checkout_state(request)
+    if "order" in state:
+        initial = dict(state.get("order"))
+        if state.step:
+            initial["step"] = state.step
+        return initial
     previous_lookup = {}
     if request.user.is_authenticated():
         previous_lookup["user_id"] = request.user.id
@@ -116,6 +123,8 @@ def initial_order_data(request, form_class=None):
         previous_orders = Order.objects.filter(**previous_lookup).values()[:1]
         if len(previous_orders) > 0:
             initial.update(previous_orders[0])
+            # The token has been claimed by the previous order.
+            del initial["checkout_token"]
     if not initial and request.user.is_authenticated():
         # No previous order data - try and get field values from the
         # logged in user. Check the profile model before the user model
@@ -155,11 +164,12 @@ def initial_order_data(request, form_class=None):
     return initial
 
 
+@timer("checkout.send_order_email")
 def send_order_email(request, order):
     """
     Send order receipt email on successful order.
     """
-    settings.use_editable()
+    use_editable(request)
     order_context = {"order": order, "request": request,
                      "order_items": order.items.all()}
     order_context.update(order.details_as_dict())
@@ -178,6 +188,88 @@ def send_order_email(request, order):
         fail_silently=settings.DEBUG)
 
 
+# Number of times the order is set up when its checkout token turns
+# out to be free after failing to claim it.
+CLAIM_TOKEN_ATTEMPTS = 3
+
+
+def claim_token(request, order, retry=True):
+    """
+    Call ``order.setup``, which also claims the checkout token issued
+    with the final checkout step, since it's unique to each order.
+    Returns ``False`` if the token may have already been claimed and
+    ``retry`` is given, otherwise integrity errors are raised.
+
+    The order is set up inside its own transaction, so that it's
+    committed once the token is claimed and before payment is taken,
+    and within a savepoint, so that a failed claim can be rolled back
+    on databases such as PostgreSQL that abort the transaction.
+    """
+    with transaction.commit_on_success():
+        sid = transaction.savepoint()
+        try:
+            order.setup(request)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            order.id = None
+            if not (retry and order.checkout_token):
+                # The error wasn't from the token.
+                raise
+            return False
+        transaction.savepoint_commit(sid)
+        return True
+
+
+def setup_order(request, order):
+    """
+    Set up the order, claiming its checkout token. If the token has
+    already been claimed, the final step has been submitted more than
+    once, such as by double clicking, so rather than creating another
+    order and taking payment again, the customer should be shown the
+    ``shop_checkout_processing`` page, which waits for the first
+    submission to finish. Returns ``True`` if the order was set up
+    and payment should be taken, or ``False`` if the token belongs to
+    an earlier submission.
+    """
+    if not order.checkout_token:
+        # Custom order forms may not include the token.
+        order.checkout_token = None
+    for attempt in range(CLAIM_TOKEN_ATTEMPTS):
+        retry = attempt < CLAIM_TOKEN_ATTEMPTS - 1
+        if claim_token(request, order, retry):
+            return True
+        try:
+            claimed = Order.objects.get(checkout_token=order.checkout_token)
+        except Order.DoesNotExist:
+            # Payment failed for the first submission and its order
+            # was deleted, so this submission can claim the token,
+            # unless the error wasn't from the token, in which case
+            # it's raised once the attempts run out.
+            continue
+        if claimed.key != request.session.session_key:
+            # Token wasn't issued to this customer.
+            order.checkout_token = None
+            continue
+        return False
+
+
+def processing_status(request, token):
+    """
+    Returns the status of the submission of the final checkout step
+    that claimed the given token, for the ``shop_checkout_processing``
+    page: ``"complete"`` once its order is complete, ``"failed"`` if
+    payment failed and its order was deleted, or ``"processing"``.
+    """
+    orders = Order.objects.filter(checkout_token=token,
+                                  key=request.session.session_key)
+    if not token or not orders.exists():
+        return "failed"
+    if not Cart.objects.filter(id=request.cart.id).exists():
+        # The cart is deleted once the order is complete.
+        return "complete"
+    return "processing"
+
+
 # Set up some constants for identifying each checkout step.
 
 CHECKOUT_STEPS = [{"template": "billing_shipping", "url": "details",
@@ -20,7 +20,7 @@ register_setting(
         (_("Content"), ("pages.Page", "blog.BlogPost",
             "generic.ThreadedComment", (_("Media Library"), "fb_browse"),)),
         (_("Shop"), ("shop.Product", "shop.ProductOption", "shop.DiscountCode",
-            "shop.Sale", "shop.Order")),
+            "shop.Sale", "shop.Order", "shop.ShippingZone", "shop.TaxRate")),
         (_("Site"), ("sites.Site", "redirects.Redirect", "conf.Setting")),
         (_("Users"), ("auth.User", "auth.Group",)),
     ),
@@ -77,6 +77,28 @@ register_setting(
     default=("Mastercard", "Visa", "Diners", "Amex"),
 )
 
+register_setting(
+    name="SHOP_CACHEABLE_PAGES",
+    description="If ``True``, product and category pages are rendered "
+        "the same for all anonymous visitors, without their cart, "
+        "wishlist or CSRF token, and are given ``ETag`` and "
+        "``Last-Modified`` headers from the version of the catalogue, "
+        "so that they can be cached and revalidated with conditional "
+        "requests. The cart summary, CSRF token and stock levels are "
+        "then loaded with JavaScript from the ``shop_cart_state`` view.",
+    editable=False,
+    default=False,
+)
+
+register_setting(
+    name="SHOP_CACHEABLE_PAGES_MAX_AGE",
+    description="Number of seconds that caches can serve product and "
+        "category pages for without revalidating them, when "
+        "``SHOP_CACHEABLE_PAGES`` is ``True``.",
+    editable=False,
+    default=0,
+)
+
 register_setting(
     name="SHOP_CART_EXPIRY_MINUTES",
     description="Number of minutes of inactivity until carts are abandoned.",
@@ -123,6 +145,15 @@ register_setting(
     default=True,
 )
 
+register_setting(
+    name="SHOP_CHECKOUT_PROCESSING_INTERVAL",
+    description="Number of seconds between each check for the first "
+        "submission of the final checkout step having completed, when "
+        "the step is submitted again while it's still being processed.",
+    editable=False,
+    default=2,
+)
+
 register_setting(
     name="SHOP_PAYMENT_STEP_ENABLED",
     label=_("Payment Enabled"),
@@ -210,6 +241,51 @@ register_setting(
     default="cartridge.shop.checkout.default_payment_handler",
 )
 
+register_setting(
+    name="SHOP_INSTRUMENTATION_SINKS",
+    description="Sequence of dotted package paths and class names of the "
+        "sinks that timings and counters for the shop's hot paths are "
+        "recorded with. Choices in ``cartridge.shop.instrumentation`` are "
+        "``LogSink``, ``HistogramSink`` and ``StatsdSink``. Nothing is "
+        "recorded if empty.",
+    editable=False,
+    default=(),
+)
+
+register_setting(
+    name="SHOP_INSTRUMENTATION_DIR",
+    description="Directory that ``HistogramSink`` writes the timings "
+        "and counters for each process to, which the ``shop_metrics`` "
+        "management command reports percentiles from. If empty, they're "
+        "only kept in memory.",
+    editable=False,
+    default="",
+)
+
+register_setting(
+    name="SHOP_INSTRUMENTATION_FLUSH_INTERVAL",
+    description="Number of seconds between each write of the timings "
+        "and counters to ``SHOP_INSTRUMENTATION_DIR``.",
+    editable=False,
+    default=10,
+)
+
+register_setting(
+    name="SHOP_INSTRUMENTATION_STATSD_ADDRESS",
+    description="Host and port, separated by a colon, that "
+        "``StatsdSink`` sends timings and counters to over UDP.",
+    editable=False,
+    default="127.0.0.1:8125",
+)
+
+register_setting(
+    name="SHOP_INSTRUMENTATION_PREFIX",
+    description="Prefix added to the names of the timings and counters "
+        "sent by ``StatsdSink``.",
+    editable=False,
+    default="cartridge",
+)
+
 register_setting(
     name="SHOP_OPTION_TYPE_CHOICES",
     description="Sequence of value/name pairs for types of product options "
@@ -238,6 +314,47 @@ register_setting(
     default="do_not_reply@%s" % gethostname(),
 )
 
+register_setting(
+    name="SHOP_ORDER_TASKS_DEFERRED",
+    description="Sequence of names of tasks in ``cartridge.shop.tasks`` "
+        "that are run when an order is complete, which should be queued "
+        "and run by the ``order_tasks`` management command, rather than "
+        "run during the checkout process. Choices are "
+        "``product_actions``, ``order_handler``, ``order_email`` and "
+        "``order_invoice``, which renders the PDF invoice ahead of time "
+        "and is only run when deferred. Deferred tasks are called "
+        "without the request and order form.",
+    editable=False,
+    default=(),
+)
+
+register_setting(
+    name="SHOP_ORDER_TASK_ATTEMPTS",
+    description="Number of times a deferred order task is attempted "
+        "before it's given up on.",
+    editable=False,
+    default=5,
+)
+
+register_setting(
+    name="SHOP_INVOICE_DIR",
+    description="Directory that PDF invoices are stored in once "
+        "rendered, which shouldn't be publicly served. If empty, "
+        "invoices are stored in the cache instead, which must be "
+        "shared between processes for invoices rendered ahead of time "
+        "to be used.",
+    editable=False,
+    default="",
+)
+
+register_setting(
+    name="SHOP_INVOICE_CACHE_TIMEOUT",
+    description="Number of seconds PDF invoices are stored in the cache "
+        "for, when ``SHOP_INVOICE_DIR`` isn't set.",
+    editable=False,
+    default=60 * 60 * 24 * 7,
+)
+
 register_setting(
     name="SHOP_ORDER_STATUS_CHOICES",
     description="Sequence of value/name pairs for order statuses.",
@@ -248,6 +365,65 @@ register_setting(
     ),
 )
 
+register_setting(
+    name="SHOP_PAYMENT_CONNECT_TIMEOUT",
+    description="Number of seconds to wait when connecting to a payment "
+        "gateway.",
+    editable=False,
+    default=5,
+)
+
+register_setting(
+    name="SHOP_PAYMENT_READ_TIMEOUT",
+    description="Number of seconds to wait for a response from a payment "
+        "gateway once connected.",
+    editable=False,
+    default=30,
+)
+
+register_setting(
+    name="SHOP_PAYMENT_MAX_IDLE",
+    description="Number of idle keep-alive connections to hold open per "
+        "payment gateway, for each process.",
+    editable=False,
+    default=4,
+)
+
+register_setting(
+    name="SHOP_PAYMENT_IDLE_TIMEOUT",
+    description="Number of seconds an idle connection to a payment "
+        "gateway is kept for reuse.",
+    editable=False,
+    default=15,
+)
+
+register_setting(
+    name="SHOP_PAYMENT_RETRIES",
+    description="Number of times a failed request to a payment gateway "
+        "is retried. Payment requests are only retried if the gateway "
+        "couldn't be connected to.",
+    editable=False,
+    default=2,
+)
+
+register_setting(
+    name="SHOP_PAYMENT_CIRCUIT_FAILURES",
+    description="Number of consecutive failed requests to a payment "
+        "gateway after which it's no longer called, for the period "
+        "given by ``SHOP_PAYMENT_CIRCUIT_RESET``.",
+    editable=False,
+    default=5,
+)
+
+register_setting(
+    name="SHOP_PAYMENT_CIRCUIT_RESET",
+    description="Number of seconds a payment gateway isn't called for, "
+        "once it has failed ``SHOP_PAYMENT_CIRCUIT_FAILURES`` times in "
+        "a row.",
+    editable=False,
+    default=30,
+)
+
 register_setting(
     name="SHOP_PER_PAGE_CATEGORY",
     label=_("Products Per Category Page"),
@@ -269,6 +445,16 @@ register_setting(
     ),
 )
 
+register_setting(
+    name="SHOP_SEARCH_INDEX_DIR",
+    description="Directory that the product search index is stored in, "
+        "built by the ``search_index`` management command and updated "
+        "when products are changed. If empty, or the index hasn't been "
+        "built, product search uses Mezzanine's search instead.",
+    editable=False,
+    default="",
+)
+
 register_setting(
     name="SHOP_USE_VARIATIONS",
     label=_("Use product variations"),
@@ -0,0 +1,133 @@
+"""
+Discount evaluation over the items in a cart. The SKUs a discount
+applies to are resolved from its products and categories once, and
+kept in each process until the discount or the catalogue changes, so
+that totalling the discount each time the cart changes doesn't query
+the catalogue. As with the shipping and tax rates index, a version
+number stored in the cache lets other processes know to discard the
+SKUs they've resolved.
+
+Categories can select products by the dates of their sales, so the
+SKUs resolved are also discarded once they're ``MAX_AGE`` seconds old.
+Whether any discount codes are active is also kept, so that the cart
+and checkout only show the discount code field when there are codes.
+"""
+
+from decimal import Decimal
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db.models import Min
+from django.utils.timezone import now
+
+from cartridge.shop.models import DiscountCode, ProductVariation
+
+
+VERSION_KEY = "cartridge.shop.discounts.version"
+
+MAX_AGE = 300
+
+_skus = {}
+_skus_lock = Lock()
+_active = None
+
+
+def get_version():
+    """
+    Returns the version of the discounts and catalogue, creating it if
+    it doesn't exist.
+    """
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid4().hex)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def eligible_skus(discount):
+    """
+    Returns the set of SKUs the discount applies to, or ``None`` if it
+    isn't restricted to any products and applies to the cart total.
+    """
+    version = get_version()
+    key = (discount.__class__, discount.id)
+    resolved = _skus.get(key)
+    if (resolved is not None and resolved[0] == version and
+            time() - resolved[1] < MAX_AGE):
+        return resolved[2]
+    products = discount.all_products()
+    if not products.exists():
+        skus = None
+    else:
+        variations = ProductVariation.objects.filter(product__in=products)
+        skus = frozenset(variations.values_list("sku", flat=True))
+    if discount.id is not None:
+        with _skus_lock:
+            _skus[key] = (version, time(), skus)
+    return skus
+
+
+def any_active_codes():
+    """
+    Returns whether any discount codes are active. This is checked
+    again when the discounts change, when the next code becomes valid,
+    or once ``MAX_AGE`` seconds have passed, since codes stop being
+    active when they've been used up.
+    """
+    global _active
+    version = get_version()
+    active = _active
+    if active is None or active[0] != version or time() >= active[1]:
+        flag = DiscountCode.objects.active().exists()
+        expires = time() + MAX_AGE
+        n = now()
+        starts = DiscountCode.objects.filter(active=True, valid_from__gt=n)
+        start = starts.aggregate(start=Min("valid_from"))["start"]
+        if start is not None:
+            delta = start - n
+            expires = min(expires, time() + delta.days * 86400 +
+                          delta.seconds + 1)
+        active = (version, expires, flag)
+        _active = active
+    return active[2]
+
+
+def invalidate():
+    """
+    Discard the SKUs resolved and whether codes are active in this
+    process, and change the version in the cache so that other
+    processes discard theirs.
+    """
+    global _active
+    with _skus_lock:
+        _skus.clear()
+        _active = None
+    cache.set(VERSION_KEY, uuid4().hex)
+
+
+def line_discounts(discount, items):
+    """
+    Returns the discount amount for each of the given cart items, as a
+    list of ``(item, amount)`` pairs, for the items the discount
+    applies to. Returns ``None`` when the discount applies to the cart
+    total rather than to particular items.
+    """
+    skus = eligible_skus(discount)
+    if skus is None:
+        return None
+    return [(item, discount.calculate(item.unit_price) * item.quantity)
+            for item in items if item.sku in skus]
+
+
+def calculate_discount(discount, items, total_price):
+    """
+    Returns the total discount for the given cart items, using the
+    cart's total price when the discount isn't restricted to any
+    products.
+    """
+    lines = line_discounts(discount, items)
+    if lines is None:
+        return discount.calculate(total_price)
+    return sum([amount for item, amount in lines], Decimal("0"))
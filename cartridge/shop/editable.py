@@ -0,0 +1,86 @@
+"""
+A snapshot of the editable settings for each site, kept in each
+process, so that loading the editable settings doesn't query the
+database each time. ``use_editable`` is used in place of
+``settings.use_editable``, and loads the settings from the snapshot
+unless they've been changed since it was taken. As with the shipping
+and tax rates index, a version number stored in the cache lets other
+processes know to take a new snapshot.
+
+The version is only read from the cache once for each request it's
+given.
+"""
+
+from threading import Lock
+from uuid import uuid4
+
+from django.core.cache import cache
+
+from mezzanine.conf import registry, settings
+from mezzanine.utils.sites import current_site_id
+
+
+VERSION_KEY = "cartridge.shop.editable.version"
+
+_snapshots = {}
+_snapshots_lock = Lock()
+
+
+def get_version(request=None):
+    """
+    Returns the version of the editable settings, creating it if it
+    doesn't exist. The version is stored against the request given,
+    so that it's only read from the cache once per request.
+    """
+    version = getattr(request, "_editable_version", None)
+    if version is None:
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            cache.add(VERSION_KEY, uuid4().hex)
+            version = cache.get(VERSION_KEY)
+        if request is not None:
+            request._editable_version = version
+    return version
+
+
+def load():
+    """
+    Load the editable settings from the database, and return them.
+    """
+    settings.use_editable()
+    for name, setting in registry.items():
+        if setting["editable"]:
+            # Accessing any editable setting loads them all.
+            getattr(settings, name)
+            break
+    return dict(settings._editable_cache)
+
+
+def use_editable(request=None):
+    """
+    Load the editable settings for the current site from the snapshot,
+    taking a new snapshot if the settings have changed.
+    """
+    if not hasattr(settings, "_editable_cache"):
+        # Not the settings object this was written against.
+        settings.use_editable()
+        return
+    version = get_version(request)
+    site_id = getattr(request, "site_id", None) or current_site_id()
+    snapshot = _snapshots.get(site_id)
+    if snapshot is None or snapshot[0] != version:
+        snapshot = (version, load())
+        with _snapshots_lock:
+            _snapshots[site_id] = snapshot
+    settings._editable_cache = dict(snapshot[1])
+    settings._loaded = True
+
+
+def invalidate():
+    """
+    Discard the snapshots in this process, and change the version in
+    the cache so that other processes discard theirs.
+    """
+    with _snapshots_lock:
+        _snapshots.clear()
+    cache.set(VERSION_KEY, uuid4().hex)
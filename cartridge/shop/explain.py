@@ -0,0 +1,106 @@
+"""
+The shop's main lookups, and the query plans the configured database
+backend chooses for them, used by the ``shop_explain`` command to
+report lookups that scan a whole table rather than using an index.
+
+Query planners prefer sequential scans for tables that are small, or
+that they have no statistics for, so the plans are only meaningful
+against a database with a realistic amount of data, such as one
+filled by the ``generate_shop_data`` command. The values looked up
+don't need to exist.
+"""
+
+import re
+
+from django.db import connection
+from django.db.models import Sum
+from django.utils.datastructures import SortedDict
+from django.utils.timezone import now
+
+from cartridge.shop.models import Cart, CartItem, DiscountCode, Order
+from cartridge.shop.models import Product, ProductVariation, WishlistItem
+
+
+# Query plan details for sequential scans, and the table scanned, for
+# the backends that support ``EXPLAIN``.
+SQLITE_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?!.* USING )")
+POSTGRESQL_SCAN = re.compile(r"Seq Scan on (\w+)")
+
+
+def lookups():
+    """
+    Returns the shop's main lookups, mapping their names to querysets.
+    """
+    n = now()
+    items_in_carts = CartItem.objects.filter(sku__in=["1", "2"])
+    return SortedDict([
+        ("cart", Cart.objects.filter(id=1, last_updated__gte=n)),
+        ("cart_expiry", Cart.objects.filter(last_updated__lt=n)),
+        ("cart_item", CartItem.objects.filter(cart=1, sku="1")),
+        ("stock_in_carts", items_in_carts.values_list("sku").annotate(
+            total=Sum("quantity"))),
+        ("order_by_key", Order.objects.filter(key="1").order_by("-id")[:1]),
+        ("order_by_user", Order.objects.filter(user_id=1)[:1]),
+        ("order_history", Order.objects.filter(user_id=1).order_by("-time")),
+        ("order_transaction", Order.objects.filter(transaction_id="1")),
+        ("order_status", Order.objects.filter(status=1, time__gte=n)),
+        ("discount_codes", DiscountCode.objects.active()),
+        ("sale_products", Product.objects.filter(sale_id=1)),
+        ("sale_variations", ProductVariation.objects.filter(sale_id=1)),
+        ("wishlist", WishlistItem.objects.filter(user_id=1)),
+    ])
+
+
+def explain(queryset):
+    """
+    Returns the query plan for the queryset, as the rows returned by
+    the backend, along with the names of their columns.
+    """
+    vendor = connection.vendor
+    if vendor == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    elif vendor in ("postgresql", "mysql"):
+        prefix = "EXPLAIN "
+    else:
+        raise NotImplementedError("EXPLAIN isn't supported for %s" % vendor)
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    columns = [column[0] for column in cursor.description]
+    return columns, cursor.fetchall()
+
+
+def sequential_scans(columns, rows):
+    """
+    Returns the names of the tables scanned sequentially in the query
+    plan given by ``explain``.
+    """
+    vendor = connection.vendor
+    tables = []
+    for row in rows:
+        if vendor == "mysql":
+            row = dict(zip(columns, row))
+            if row.get("type") == "ALL":
+                tables.append(row["table"])
+            continue
+        pattern = SQLITE_SCAN if vendor == "sqlite" else POSTGRESQL_SCAN
+        match = pattern.search(row[-1])
+        if match:
+            tables.append(match.group(1))
+    return tables
+
+
+def check(names=None):
+    """
+    Returns a list of ``(name, plan, tables)`` tuples for the lookups
+    with the given names, or for all of them, giving the lines of each
+    lookup's query plan and the tables it scans sequentially.
+    """
+    results = []
+    for name, queryset in lookups().items():
+        if names and name not in names:
+            continue
+        columns, rows = explain(queryset)
+        plan = [" ".join([unicode(value) for value in row]) for row in rows]
+        results.append((name, plan, sequential_scans(columns, rows)))
+    return results
@@ -3,9 +3,12 @@ from copy import copy
 from datetime import date
 from itertools import dropwhile, takewhile
 from locale import localeconv
-from re import match
+from re import match, split
+from uuid import uuid4
 
 from django import forms
+from django.core.validators import EMPTY_VALUES
+from django.db.models import F, Sum
 from django.forms.models import BaseInlineFormSet, ModelFormMetaclass
 from django.forms.models import inlineformset_factory
 from django.utils.datastructures import SortedDict
@@ -17,9 +20,12 @@ from mezzanine.conf import settings
 from mezzanine.core.templatetags.mezzanine_tags import thumbnail
 
 from cartridge.shop import checkout
+from cartridge.shop.discounts import any_active_codes
+from cartridge.shop.editable import use_editable
 from cartridge.shop.models import Product, ProductOption, ProductVariation
 from cartridge.shop.models import Cart, CartItem, Order, DiscountCode
-from cartridge.shop.utils import make_choices, set_locale, set_shipping
+from cartridge.shop.utils import checkout_state, make_choices, set_locale
+from cartridge.shop.utils import set_shipping
 
 
 ADD_PRODUCT_ERRORS = {
@@ -132,19 +138,185 @@ class CartItemForm(forms.ModelForm):
 
     def clean_quantity(self):
         """
-        Validate that the given quantity is available.
+        Validate that the given quantity is available, using the
+        variation looked up by ``BaseCartItemFormSet`` if there is one.
         """
-        variation = ProductVariation.objects.get(sku=self.instance.sku)
+        variation = getattr(self, "variation", None)
+        if variation is None:
+            variation = ProductVariation.objects.get(sku=self.instance.sku)
         quantity = self.cleaned_data["quantity"]
         if not variation.has_stock(quantity - self.instance.quantity):
             error = ADD_PRODUCT_ERRORS["no_stock_quantity"]
             raise forms.ValidationError(error)
         return quantity
 
+
+class ExistingObjectField(forms.ModelChoiceField):
+    """
+    Primary key field for each form of a model formset, that looks up
+    the formset's existing objects, which are read in a single query,
+    rather than querying for the object given to each form.
+    """
+
+    def __init__(self, formset, *args, **kwargs):
+        self.formset = formset
+        super(ExistingObjectField, self).__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        if value in EMPTY_VALUES:
+            return None
+        try:
+            pk = self.queryset.model._meta.pk.to_python(value)
+        except forms.ValidationError:
+            pk = None
+        obj = self.formset._existing_object(pk)
+        if obj is None:
+            raise forms.ValidationError(self.error_messages["invalid_choice"])
+        return obj
+
+
+class BaseCartItemFormSet(BaseInlineFormSet):
+    """
+    Formset for the items in the cart, which validates and saves the
+    items together, rather than querying for each item. The variations
+    for the items and their stock levels are looked up once, and the
+    changed quantities are saved with an update for each distinct
+    quantity, as ``Cart.add_items`` does.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BaseCartItemFormSet, self).__init__(*args, **kwargs)
+        if self.is_bound:
+            skus = [form.instance.sku for form in self.initial_forms]
+            variations = ProductVariation.objects.with_live_stock(skus)
+            for form in self.initial_forms:
+                form.variation = variations.get(form.instance.sku)
+
+    def add_fields(self, form, index):
+        super(BaseCartItemFormSet, self).add_fields(form, index)
+        name = self._pk_field.name
+        field = form.fields[name]
+        form.fields[name] = ExistingObjectField(self, field.queryset,
+            initial=field.initial, required=False, widget=field.widget)
+
+    def save_existing_objects(self, commit=True):
+        """
+        Delete the removed items, and those given a quantity of zero,
+        as ``SelectedProduct.save`` does, and update the quantities of
+        the others that have changed.
+        """
+        if not commit:
+            return super(BaseCartItemFormSet, self).save_existing_objects(
+                commit)
+        self.changed_objects = []
+        self.deleted_objects = []
+        try:
+            forms_to_delete = self.deleted_forms
+        except AttributeError:
+            forms_to_delete = []
+        quantities = {}
+        for form in self.initial_forms:
+            item = form.instance
+            if form in forms_to_delete:
+                self.deleted_objects.append(item)
+            elif form.has_changed():
+                if item.quantity <= 0:
+                    self.deleted_objects.append(item)
+                    continue
+                self.changed_objects.append((item, form.changed_data))
+                quantities.setdefault(item.quantity, []).append(item)
+        if self.deleted_objects:
+            ids = [item.id for item in self.deleted_objects]
+            self.model.objects.filter(id__in=ids).delete()
+        for quantity, items in quantities.items():
+            ids = [item.id for item in items]
+            self.model.objects.filter(id__in=ids).update(quantity=quantity,
+                total_price=F("unit_price") * quantity)
+            for item in items:
+                item.total_price = item.unit_price * quantity
+        return [item for item, changed_data in self.changed_objects]
+
 CartItemFormSet = inlineformset_factory(Cart, CartItem, form=CartItemForm,
+                                        formset=BaseCartItemFormSet,
                                         can_delete=True, extra=0)
 
 
+class QuickOrderForm(forms.Form):
+    """
+    A form for adding many variations to the cart at once, with each
+    line of ``items`` giving a SKU followed by an optional quantity.
+    The variations and their stock are validated together, with an
+    error given for each line that can't be added. The variations and
+    quantities to add are assigned as an attribute to be used in views.
+    """
+
+    items = forms.CharField(label=_("Items"), widget=forms.Textarea,
+        help_text=_("One SKU per line, followed by the quantity."))
+
+    # Maximum number of lines accepted at once.
+    max_lines = 500
+
+    def clean_items(self):
+        """
+        Parse the SKU and quantity from each line, and validate the
+        variations and stock for all of the lines together.
+        """
+        lines = []
+        errors = []
+        for i, text in enumerate(self.cleaned_data["items"].splitlines()):
+            parts = split(r"[\s,;]+", text.strip())
+            if not parts[0]:
+                continue
+            sku, quantity = parts[0], "1"
+            if len(parts) > 1:
+                quantity = parts[1]
+            valid = match(r"^\d+$", quantity) and int(quantity) > 0
+            if len(parts) > 2 or not valid:
+                errors.append((i + 1, _("Line %(line)s: %(text)s: invalid "
+                    "quantity") % {"line": i + 1, "text": text.strip()}))
+                continue
+            lines.append((i + 1, sku, int(quantity)))
+        if not lines and not errors:
+            raise forms.ValidationError(_("No SKUs were given."))
+        if len(lines) > self.max_lines:
+            raise forms.ValidationError(_("No more than %s lines can be "
+                                          "added at once.") % self.max_lines)
+        skus = set([sku for line, sku, quantity in lines])
+        products = Product.objects.published()
+        variations = ProductVariation.objects.filter(sku__in=skus,
+            unit_price__isnull=False, product__in=products)
+        variations = variations.select_related("product", "image")
+        variations = dict([(v.sku, v) for v in variations])
+        in_carts = CartItem.objects.filter(sku__in=variations.keys())
+        in_carts = dict(in_carts.values_list("sku").annotate(Sum("quantity")))
+        requested = {}
+        self.variations = []
+        for line, sku, quantity in lines:
+            variation = variations.get(sku)
+            error = None
+            if variation is None:
+                error = "invalid_options"
+            elif variation.num_in_stock is not None:
+                # The live number in stock, as given by
+                # ``ProductVariation.live_num_in_stock``.
+                live = variation.num_in_stock - in_carts.get(sku, 0)
+                requested[sku] = requested.get(sku, 0) + quantity
+                if live <= 0:
+                    error = "no_stock"
+                elif live < requested[sku]:
+                    error = "no_stock_quantity"
+            if error is not None:
+                errors.append((line, _("Line %(line)s: %(sku)s: %(error)s")
+                    % {"line": line, "sku": sku,
+                       "error": ADD_PRODUCT_ERRORS[error]}))
+            else:
+                self.variations.append((variation, quantity))
+        if errors:
+            raise forms.ValidationError([error for line, error in
+                                         sorted(errors)])
+        return self.cleaned_data["items"]
+
+
 class FormsetForm(object):
     """
     Form mixin that provides template methods for iterating through
@@ -261,16 +433,16 @@ class DiscountForm(forms.ModelForm):
 
     def set_discount(self):
         """
-        Assigns the session variables for the discount.
+        Stores the discount in the checkout state.
         """
         discount = getattr(self, "_discount", None)
         if discount is not None:
             total = self._request.cart.calculate_discount(discount)
             if discount.free_shipping:
                 set_shipping(self._request, _("Free shipping"), 0)
-            self._request.session["free_shipping"] = discount.free_shipping
-            self._request.session["discount_code"] = discount.code
-            self._request.session["discount_total"] = total
+            checkout_state(self._request).update(
+                free_shipping=discount.free_shipping,
+                discount_code=discount.code, discount_total=total)
 
 
 class OrderForm(FormsetForm, DiscountForm):
@@ -296,6 +468,8 @@ class OrderForm(FormsetForm, DiscountForm):
     card_expiry_year = forms.ChoiceField()
     card_ccv = forms.CharField(label=_("CCV"), help_text=_("A security code, "
         "usually the last 3 digits found on the back of your card."))
+    checkout_token = forms.CharField(required=False,
+                                     widget=forms.HiddenInput())
 
     class Meta:
         model = Order
@@ -313,6 +487,7 @@ class OrderForm(FormsetForm, DiscountForm):
         - Hides the discount code field if applicable
         - Hides sets of fields based on the checkout step
         - Sets year choices for cc expiry field based on current date
+        - Issues the checkout token for the final step
         """
 
         # ``data`` is usually the POST attribute of a Request object,
@@ -333,9 +508,9 @@ class OrderForm(FormsetForm, DiscountForm):
         self._checkout_errors = errors
 
         # Hide Discount Code field if no codes are active.
-        settings.use_editable()
-        no_discounts = DiscountCode.objects.active().count() == 0
-        if no_discounts or not settings.SHOP_DISCOUNT_FIELD_IN_CHECKOUT:
+        use_editable(request)
+        if (not any_active_codes() or
+                not settings.SHOP_DISCOUNT_FIELD_IN_CHECKOUT):
             self.fields["discount_code"].widget = forms.HiddenInput()
 
         # Determine which sets of fields to hide for each checkout step.
@@ -367,6 +542,13 @@ class OrderForm(FormsetForm, DiscountForm):
         choices = make_choices(range(year, year + 21))
         self.fields["card_expiry_year"].choices = choices
 
+        # Issue a token with the final step, that's claimed by the
+        # order when the step is submitted, so that submitting it
+        # more than once doesn't create another order.
+        token = self.initial.get("checkout_token")
+        if is_last_step and not self.is_bound and not token:
+            self.initial["checkout_token"] = uuid4().hex
+
     @classmethod
     def preprocess(cls, data):
         """
@@ -0,0 +1,406 @@
+"""
+Generates a shop's worth of data - categories, products with images
+and variations for combinations of options, sales, discount codes,
+carts and historical orders - for development and load testing. The
+data is generated offline from a seed, so the same seed always gives
+the same catalogue, and is written with bulk inserts in batches so
+that catalogues with millions of variations can be created. Used by
+the ``generate_shop_data`` management command.
+
+Since ``bulk_create`` doesn't return the IDs of the rows it inserts,
+the IDs are read back as the highest IDs in the table, so nothing else
+should be writing to the shop's tables while data is generated.
+"""
+
+import os
+from decimal import Decimal
+from datetime import timedelta
+from itertools import product as combinations
+from random import Random
+
+from django.contrib.webdesign.lorem_ipsum import WORDS
+from django.db import connection, reset_queries
+from django.db.models import AutoField, Max
+from django.template.defaultfilters import slugify
+from django.utils.timezone import now
+
+from mezzanine.conf import settings
+from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
+from mezzanine.utils.sites import current_site_id
+
+from cartridge.shop.models import Cart, CartItem, Category, DiscountCode
+from cartridge.shop.models import Order, OrderItem, Product, ProductImage
+from cartridge.shop.models import ProductOption, ProductVariation, Sale
+
+
+ADJECTIVES = ("Classic", "Deluxe", "Compact", "Vintage", "Modern", "Rustic",
+              "Premium", "Essential", "Organic", "Handmade", "Travel",
+              "Everyday", "Limited", "Heavy Duty", "Lightweight")
+NOUNS = ("Shirt", "Jacket", "Lamp", "Chair", "Mug", "Backpack", "Watch",
+         "Notebook", "Speaker", "Blanket", "Kettle", "Sneaker", "Scarf",
+         "Bottle", "Wallet", "Helmet", "Candle", "Bowl", "Tent", "Cap")
+NAMES = ("Alex", "Sam", "Jordan", "Taylor", "Morgan", "Casey", "Riley",
+         "Jamie", "Avery", "Quinn", "Robin", "Drew")
+CITIES = ("Sydney", "Melbourne", "London", "Leeds", "Toronto", "Austin",
+          "Berlin", "Auckland", "Dublin", "Denver")
+COLOURS = ((200, 60, 60), (60, 160, 80), (60, 90, 200), (220, 180, 40),
+           (150, 70, 170), (40, 170, 170), (230, 120, 40), (90, 90, 90))
+
+# Number of variations kept as a sample for creating carts and orders.
+SAMPLE_SIZE = 1000
+
+
+class DataGenerator(object):
+    """
+    Generates data with its own random number generator, seeded with
+    the given seed. Each ``create_*`` method creates one type of data,
+    and should be called in the order given by ``generate``.
+    """
+
+    def __init__(self, seed=0, batch_size=1000, log=None):
+        self.random = Random(seed)
+        self.batch_size = batch_size
+        self.log = log or (lambda message: None)
+        self.now = now()
+        self.site_id = current_site_id()
+        self.sample = []
+        self.sample_seen = 0
+
+    def insert(self, model, objects):
+        """
+        Insert the objects in batches, limited to the batch size the
+        database backend supports.
+        """
+        if not objects:
+            return
+        fields = [f for f in model._meta.local_fields
+                  if not isinstance(f, AutoField)]
+        limit = connection.ops.bulk_batch_size(fields, objects)
+        model.objects.bulk_create(objects,
+                                  batch_size=min(self.batch_size, limit))
+
+    def insert_ids(self, model, objects):
+        """
+        Insert the objects and return their new IDs, in order.
+        """
+        if not objects:
+            return []
+        self.insert(model, objects)
+        ids = model.objects.order_by("-id").values_list("id", flat=True)
+        return list(ids[:len(objects)])[::-1]
+
+    def price(self, low=5, high=500):
+        cents = self.random.randint(low * 100, high * 100)
+        return Decimal("%s.%02d" % divmod(cents, 100))
+
+    def words(self, count):
+        return " ".join([self.random.choice(WORDS) for _ in range(count)])
+
+    def paragraph(self):
+        return "<p>%s.</p>" % self.words(self.random.randint(20, 60))
+
+    def add_to_sample(self, variation, title):
+        """
+        Keep a uniform sample of the variations created, from which
+        the items for carts and orders are chosen.
+        """
+        self.sample_seen += 1
+        item = (variation.sku, variation.unit_price, title,
+                variation.product_id)
+        if len(self.sample) < SAMPLE_SIZE:
+            self.sample.append(item)
+        else:
+            i = self.random.randint(0, self.sample_seen - 1)
+            if i < SAMPLE_SIZE:
+                self.sample[i] = item
+
+    def create_options(self, count):
+        """
+        Create ``count`` options for each option type, returning a
+        list of option names for each option field.
+        """
+        options = []
+        for option_type, label in settings.SHOP_OPTION_TYPE_CHOICES:
+            names = ["%s %s" % (label, i + 1) for i in range(count)]
+            existing = ProductOption.objects.filter(type=option_type,
+                                                    name__in=names)
+            existing = set(existing.values_list("name", flat=True))
+            self.insert(ProductOption, [
+                ProductOption(type=option_type, name=name)
+                for name in names if name not in existing])
+            options.append(names)
+        return options
+
+    def create_images(self, count):
+        """
+        Draw ``count`` placeholder images in the media directory,
+        returning their paths relative to it. PIL is required by
+        Mezzanine for thumbnails, so it's assumed to be installed.
+        """
+        from PIL import Image, ImageDraw
+        directory = os.path.join(settings.MEDIA_ROOT, "product", "generated")
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        paths = []
+        for i in range(count):
+            name = "generated-%s.jpg" % i
+            path = os.path.join(directory, name)
+            if not os.path.exists(path):
+                colour = COLOURS[i % len(COLOURS)]
+                image = Image.new("RGB", (400, 400), colour)
+                draw = ImageDraw.Draw(image)
+                draw.text((20, 20), str(i), fill=(255, 255, 255))
+                image.save(path, "JPEG")
+            paths.append("product/generated/%s" % name)
+        return paths
+
+    def create_categories(self, count):
+        """
+        Create ``count`` categories, with roughly the square root of
+        the count at the top level and the rest beneath them. There
+        are few enough categories that they're created individually,
+        since they're pages.
+        """
+        parents = []
+        categories = []
+        top_level = max(1, int(count ** .5))
+        for i in range(count):
+            title = "%s %s" % (self.random.choice(ADJECTIVES),
+                               self.random.choice(NOUNS))
+            parent = self.random.choice(parents) if i >= top_level else None
+            category = Category.objects.create(title="%ss" % title,
+                parent=parent, content=self.paragraph(),
+                status=CONTENT_STATUS_PUBLISHED)
+            if parent is None:
+                parents.append(category)
+            categories.append(category)
+        return categories
+
+    def create_products(self, count, categories, options, images,
+                        max_values=3, images_per_product=2):
+        """
+        Create ``count`` products in batches, each with images, a
+        variation for each combination of up to ``max_values`` values
+        of each option, and one or two categories. The variations are
+        generated before the products are inserted, so that the price
+        fields of each product's default variation can be inserted
+        with it. Returns the number of variations created.
+        """
+        Through = Category.products.through
+        option_fields = [f.name for f in ProductVariation.option_fields()]
+        offset = Product.objects.count()
+        sku_offset = ProductVariation.objects.aggregate(Max("id"))["id__max"]
+        sku_offset = sku_offset or 0
+        total_variations = 0
+        for start in range(0, count, self.batch_size):
+            products = []
+            product_images = []
+            product_variations = []
+            for i in range(start, min(start + self.batch_size, count)):
+                title = "%s %s %s" % (self.random.choice(ADJECTIVES),
+                                      self.random.choice(NOUNS),
+                                      self.words(1).title())
+                paths = self.random.sample(images, min(len(images),
+                                                       images_per_product))
+                values = [self.random.sample(names, self.random.randint(1,
+                          min(max_values, len(names)))) for names in options]
+                variations = []
+                for n, combination in enumerate(combinations(*values)):
+                    total_variations += 1
+                    variations.append(ProductVariation(default=n == 0,
+                        sku="G%s" % (sku_offset + total_variations),
+                        unit_price=self.price(),
+                        num_in_stock=self.random.randint(0, 100),
+                        **dict(zip(option_fields, combination))))
+                default = variations[0]
+                products.append(Product(title=title,
+                    slug="%s-%s" % (slugify(title), offset + i + 1),
+                    site_id=self.site_id, content=self.paragraph(),
+                    description=title, gen_description=False,
+                    status=CONTENT_STATUS_PUBLISHED, available=True,
+                    publish_date=self.now, in_sitemap=True,
+                    unit_price=default.unit_price, sku=default.sku,
+                    num_in_stock=default.num_in_stock,
+                    image=paths[0] if paths else None))
+                product_images.append(paths)
+                product_variations.append(variations)
+            product_ids = self.insert_ids(Product, products)
+
+            # Images, with the first image for each product used as
+            # the image for its variations.
+            images_list = []
+            for product_id, paths in zip(product_ids, product_images):
+                for order, path in enumerate(paths):
+                    images_list.append(ProductImage(file=path,
+                        product_id=product_id, _order=order))
+            image_ids = iter(self.insert_ids(ProductImage, images_list))
+
+            # Variations, inserted in batches since there can be many
+            # for each product.
+            batch = []
+            for product, product_id, paths, variations in zip(products,
+                    product_ids, product_images, product_variations):
+                ids = [image_ids.next() for path in paths]
+                image_id = ids[0] if ids else None
+                for variation in variations:
+                    variation.product_id = product_id
+                    variation.image_id = image_id
+                    self.add_to_sample(variation, product.title)
+                batch.extend(variations)
+                if len(batch) >= self.batch_size:
+                    self.insert(ProductVariation, batch)
+                    batch = []
+            self.insert(ProductVariation, batch)
+
+            # Categories.
+            rows = []
+            for product_id in product_ids:
+                for category in self.random.sample(categories,
+                        min(len(categories), self.random.randint(1, 2))):
+                    rows.append(Through(category_id=category.id,
+                                        product_id=product_id))
+            self.insert(Through, rows)
+            # Queries are kept in memory when DEBUG is True.
+            reset_queries()
+            self.log("Products: %s, variations: %s" %
+                     (start + len(products), total_variations))
+        return total_variations
+
+    def create_sales(self, count, categories):
+        """
+        Create active sales for random categories. Sales are applied
+        to their products with update queries when their categories
+        are assigned.
+        """
+        for i in range(count):
+            sale = Sale.objects.create(title="Sale %s" % (i + 1),
+                active=True, discount_percent=self.random.randint(5, 50),
+                valid_from=self.now - timedelta(days=7),
+                valid_to=self.now + timedelta(days=7))
+            sale.categories.add(self.random.choice(categories))
+
+    def create_discount_codes(self, count):
+        """
+        Create active discount codes, a third of which have a minimum
+        purchase amount.
+        """
+        offset = DiscountCode.objects.count()
+        codes = []
+        for i in range(count):
+            n = offset + i + 1
+            codes.append(DiscountCode(title="Discount %s" % n,
+                code="GEN%s" % n, active=True,
+                discount_percent=self.random.randint(5, 30),
+                min_purchase=self.price(20, 100) if i % 3 == 0 else None,
+                uses_remaining=self.random.choice((None, 100, 1000))))
+        self.insert(DiscountCode, codes)
+
+    def items(self, model, max_items=5, **kwargs):
+        """
+        Return a random number of cart or order items, chosen from
+        the sample of variations created.
+        """
+        items = []
+        for sku, price, title, product_id in self.random.sample(self.sample,
+                min(len(self.sample), self.random.randint(1, max_items))):
+            quantity = self.random.randint(1, 3)
+            item = model(sku=sku, description=title, quantity=quantity,
+                         unit_price=price, total_price=price * quantity,
+                         **kwargs)
+            if model is OrderItem:
+                item.product_id = product_id
+                item.product_title = title
+            items.append(item)
+        return items
+
+    def create_carts(self, count):
+        """
+        Create carts with items, updated within the cart expiry time.
+        """
+        expiry = settings.SHOP_CART_EXPIRY_MINUTES
+        for start in range(0, count, self.batch_size):
+            carts = []
+            for i in range(start, min(start + self.batch_size, count)):
+                minutes = self.random.randint(0, expiry)
+                carts.append(Cart(last_updated=self.now -
+                                  timedelta(minutes=minutes)))
+            items = []
+            for cart_id in self.insert_ids(Cart, carts):
+                items.extend(self.items(CartItem, cart_id=cart_id))
+            self.insert(CartItem, items)
+
+    def create_orders(self, count, days=365):
+        """
+        Create orders with items, placed over the given number of
+        days. The order time field is set automatically when orders
+        are created, so this is disabled while they're inserted.
+        """
+        time_field = Order._meta.get_field("time")
+        statuses = [s[0] for s in settings.SHOP_ORDER_STATUS_CHOICES]
+        offset = Order.objects.count()
+        time_field.auto_now_add = False
+        try:
+            for start in range(0, count, self.batch_size):
+                orders = []
+                items = []
+                for i in range(start, min(start + self.batch_size, count)):
+                    order_items = self.items(OrderItem)
+                    item_total = sum([item.total_price
+                                      for item in order_items])
+                    shipping = Decimal("10.00")
+                    name = self.random.choice(NAMES)
+                    city = self.random.choice(CITIES)
+                    details = {"first_name": name, "last_name": "Example",
+                        "street": "%s Main St" % self.random.randint(1, 999),
+                        "city": city, "state": city, "country": city,
+                        "postcode": str(self.random.randint(1000, 9999)),
+                        "phone": str(self.random.randint(10 ** 7, 10 ** 8)),
+                        "email": "%s%s@example.com" % (name.lower(),
+                                                       offset + i)}
+                    fields = {}
+                    for prefix in ("billing_detail_", "shipping_detail_"):
+                        for name, value in details.items():
+                            fields[prefix + name] = value
+                    del fields["shipping_detail_email"]
+                    seconds = self.random.randint(0, days * 24 * 60 * 60)
+                    orders.append(Order(key="generated-%s" % (offset + i),
+                        time=self.now - timedelta(seconds=seconds),
+                        shipping_type="Flat rate shipping",
+                        shipping_total=shipping, item_total=item_total,
+                        total=item_total + shipping,
+                        status=self.random.choice(statuses), **fields))
+                    items.append(order_items)
+                for order_id, order_items in zip(
+                        self.insert_ids(Order, orders), items):
+                    for item in order_items:
+                        item.order_id = order_id
+                self.insert(OrderItem, sum(items, []))
+                reset_queries()
+                self.log("Orders: %s" % (start + len(orders)))
+        finally:
+            time_field.auto_now_add = True
+
+    def generate(self, categories=10, products=100, options=5,
+                 max_values=3, images=20, sales=5, discount_codes=20,
+                 carts=100, orders=1000, days=365):
+        """
+        Generate each type of data, returning a dict of counts.
+        """
+        self.log("Creating options and images")
+        option_names = self.create_options(options)
+        image_paths = self.create_images(images)
+        self.log("Creating categories")
+        category_list = self.create_categories(categories)
+        variations = self.create_products(products, category_list,
+                                          option_names, image_paths,
+                                          max_values=max_values)
+        self.log("Creating sales and discount codes")
+        self.create_sales(sales, category_list)
+        self.create_discount_codes(discount_codes)
+        self.log("Creating carts")
+        self.create_carts(carts)
+        self.create_orders(orders, days)
+        return {"categories": categories, "products": products,
+                "variations": variations, "sales": sales,
+                "discount_codes": discount_codes, "carts": carts,
+                "orders": orders}
@@ -0,0 +1,320 @@
+"""
+Opt-in timers and counters for the shop's hot paths, such as loading
+the cart, checking stock, building category filters, validating
+discount codes, the checkout handlers, payment gateway requests and
+sending the order email.
+
+Nothing is recorded unless ``SHOP_INSTRUMENTATION_SINKS`` is set to a
+sequence of import paths for sink classes, which are given each
+timing and counter. The sinks provided are:
+
+  - ``LogSink`` - logs each timing and counter with the
+    ``cartridge.shop.instrumentation`` logger.
+  - ``HistogramSink`` - aggregates timings into histograms in each
+    process, which are written to ``SHOP_INSTRUMENTATION_DIR`` so that
+    the ``shop_metrics`` management command can report percentiles
+    across processes.
+  - ``StatsdSink`` - sends each timing and counter over UDP in the
+    statsd format to ``SHOP_INSTRUMENTATION_STATSD_ADDRESS``.
+
+A sink is any class with ``timing(name, ms)`` and
+``incr(name, count)`` methods, which are called with the name of the
+metric and the number of milliseconds or the count.
+"""
+
+import atexit
+import logging
+import os
+import socket
+from functools import wraps
+from glob import glob
+from math import ceil, log
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
+
+from mezzanine.conf import settings
+from mezzanine.utils.importing import import_dotted_path
+
+
+# Timings are counted in buckets that each cover a range this many
+# times larger than the previous, so percentiles are accurate to
+# within this factor.
+BUCKET_BASE = 1.1
+
+logger = logging.getLogger("cartridge.shop.instrumentation")
+
+_sinks = None
+_sinks_lock = Lock()
+
+
+def get_sinks():
+    """
+    Return the sinks set up from ``SHOP_INSTRUMENTATION_SINKS``,
+    creating them on first use.
+    """
+    global _sinks
+    if _sinks is None:
+        with _sinks_lock:
+            if _sinks is None:
+                _sinks = [import_dotted_path(path)() for path in
+                          settings.SHOP_INSTRUMENTATION_SINKS]
+    return _sinks
+
+
+def reset_sinks():
+    """
+    Discard the sinks so that they're set up again from
+    ``SHOP_INSTRUMENTATION_SINKS`` on next use.
+    """
+    global _sinks
+    with _sinks_lock:
+        _sinks = None
+
+
+def flush_sinks():
+    """
+    Flush any sinks that store what they've been given, which is done
+    when the process exits.
+    """
+    for sink in _sinks or []:
+        if hasattr(sink, "flush"):
+            sink.flush()
+
+atexit.register(flush_sinks)
+
+
+def timing(name, ms):
+    """
+    Record a timing in milliseconds with each of the sinks.
+    """
+    for sink in get_sinks():
+        sink.timing(name, ms)
+
+
+def incr(name, count=1):
+    """
+    Increase a counter with each of the sinks.
+    """
+    for sink in get_sinks():
+        sink.incr(name, count)
+
+
+class timer(object):
+    """
+    Context manager and decorator that records the time taken by the
+    code it wraps. When used as a decorator, the function is called
+    directly if there are no sinks.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not get_sinks():
+                return func(*args, **kwargs)
+            with timer(self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        timing(self.name, (time() - self.start) * 1000)
+
+
+class LogSink(object):
+    """
+    Logs each timing and counter.
+    """
+
+    def timing(self, name, ms):
+        logger.info("%s %.3fms" % (name, ms))
+
+    def incr(self, name, count):
+        logger.info("%s +%s" % (name, count))
+
+
+class StatsdSink(object):
+    """
+    Sends each timing and counter to a statsd server over UDP, with
+    the metric names prefixed by ``SHOP_INSTRUMENTATION_PREFIX``.
+    """
+
+    def __init__(self):
+        host, port = settings.SHOP_INSTRUMENTATION_STATSD_ADDRESS.split(":")
+        self.address = (host, int(port))
+        self.prefix = settings.SHOP_INSTRUMENTATION_PREFIX
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, kind):
+        if self.prefix:
+            name = "%s.%s" % (self.prefix, name)
+        try:
+            self.socket.sendto("%s:%s|%s" % (name, value, kind),
+                               self.address)
+        except socket.error:
+            pass
+
+    def timing(self, name, ms):
+        self.send(name, "%.3f" % ms, "ms")
+
+    def incr(self, name, count):
+        self.send(name, count, "c")
+
+
+def bucket(ms):
+    """
+    Return the histogram bucket for the given timing.
+    """
+    return int(ceil(log(max(ms, .001), BUCKET_BASE)))
+
+
+def bucket_ms(index):
+    """
+    Return the upper bound in milliseconds of the given bucket.
+    """
+    return BUCKET_BASE ** index
+
+
+class HistogramSink(object):
+    """
+    Aggregates timings into histograms and totals counters in memory.
+    If ``SHOP_INSTRUMENTATION_DIR`` is set, the aggregates for the
+    process are written to a file in it every
+    ``SHOP_INSTRUMENTATION_FLUSH_INTERVAL`` seconds and on exit.
+    """
+
+    def __init__(self):
+        self.directory = settings.SHOP_INSTRUMENTATION_DIR
+        self.interval = settings.SHOP_INSTRUMENTATION_FLUSH_INTERVAL
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        self.pid = os.getpid()
+        self.timings = {}
+        self.counters = {}
+        self.flushed = time()
+
+    def check_pid(self):
+        # Forked processes start again rather than reporting the
+        # parent's aggregates as their own.
+        if os.getpid() != self.pid:
+            self.clear()
+
+    def timing(self, name, ms):
+        with self.lock:
+            self.check_pid()
+            stats = self.timings.setdefault(name, {"count": 0, "total": 0,
+                                                   "max": 0, "buckets": {}})
+            stats["count"] += 1
+            stats["total"] += ms
+            stats["max"] = max(stats["max"], ms)
+            index = str(bucket(ms))
+            stats["buckets"][index] = stats["buckets"].get(index, 0) + 1
+        self.maybe_flush()
+
+    def incr(self, name, count):
+        with self.lock:
+            self.check_pid()
+            self.counters[name] = self.counters.get(name, 0) + count
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if self.directory and time() - self.flushed > self.interval:
+            self.flush()
+
+    def data(self):
+        return {"timings": self.timings, "counters": self.counters}
+
+    def flush(self):
+        """
+        Write the aggregates for the process to its file, under a
+        temporary name that's then renamed, so that the file is never
+        read partially written. Failing to write is only logged, since
+        metrics are never worth failing a request over.
+        """
+        if not self.directory:
+            return
+        with self.lock:
+            self.check_pid()
+            self.flushed = time()
+            data = simplejson.dumps(self.data())
+        name = "%s-%s.json" % (socket.gethostname(), self.pid)
+        try:
+            handle, temp_path = mkstemp(dir=self.directory)
+            with os.fdopen(handle, "w") as f:
+                f.write(data)
+            os.rename(temp_path, os.path.join(self.directory, name))
+        except (IOError, OSError), e:
+            logger.warning("Couldn't write metrics to %s: %s" %
+                           (self.directory, e))
+
+
+def merge(datas):
+    """
+    Combine the aggregates written by each ``HistogramSink``.
+    """
+    timings = {}
+    counters = {}
+    for data in datas:
+        for name, stats in data["timings"].items():
+            merged = timings.setdefault(name, {"count": 0, "total": 0,
+                                               "max": 0, "buckets": {}})
+            merged["count"] += stats["count"]
+            merged["total"] += stats["total"]
+            merged["max"] = max(merged["max"], stats["max"])
+            for index, count in stats["buckets"].items():
+                merged["buckets"][index] = (merged["buckets"].get(index, 0) +
+                                            count)
+        for name, count in data["counters"].items():
+            counters[name] = counters.get(name, 0) + count
+    return {"timings": timings, "counters": counters}
+
+
+def read_histograms(directory=None):
+    """
+    Read and combine the aggregates written to
+    ``SHOP_INSTRUMENTATION_DIR`` by each process.
+    """
+    datas = []
+    for path in glob(os.path.join(directory or
+                                  settings.SHOP_INSTRUMENTATION_DIR,
+                                  "*.json")):
+        try:
+            with open(path) as f:
+                datas.append(simplejson.load(f))
+        except (IOError, ValueError):
+            continue
+    return merge(datas)
+
+
+def percentiles(stats, points=(50, 90, 99)):
+    """
+    Return a dict of the timing percentiles for the given points,
+    from the histogram of a timing, along with its count, mean and
+    maximum.
+    """
+    summary = SortedDict()
+    summary["count"] = stats["count"]
+    summary["mean"] = stats["total"] / stats["count"]
+    buckets = sorted([(int(i), c) for i, c in stats["buckets"].items()])
+    for point in points:
+        target = stats["count"] * point / 100.
+        seen = 0
+        for index, count in buckets:
+            seen += count
+            if seen >= target:
+                break
+        # The bucket's upper bound may overstate the slowest timing.
+        summary["p%s" % point] = min(bucket_ms(index), stats["max"])
+    summary["max"] = stats["max"]
+    return summary
@@ -0,0 +1,224 @@
+"""
+PDF invoices for orders. Rendering a PDF is slow, so each invoice is
+rendered once for each version of its order, and stored either in the
+directory given by the ``SHOP_INVOICE_DIR`` setting, or in the cache
+if it isn't set. Invoices can be rendered ahead of time with the
+``invoices`` management command, or by deferring the ``order_invoice``
+task in ``cartridge.shop.tasks``, which requires ``SHOP_INVOICE_DIR``
+or a cache shared between processes, see ``shared_storage``.
+"""
+
+import os
+from glob import glob
+from hashlib import md5
+from multiprocessing import Pool
+from StringIO import StringIO
+from tempfile import mkstemp
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection
+from django.http import HttpRequest
+from django.template import RequestContext
+from django.template.defaultfilters import slugify
+from django.template.loader import get_template
+
+from mezzanine.conf import settings
+
+from cartridge.shop.editable import use_editable
+from cartridge.shop.models import Order
+
+
+INVOICE_TEMPLATE = "shop/order_invoice.html"
+
+
+def invoice_filename(order):
+    """
+    Name of the PDF file given when the invoice is downloaded.
+    """
+    name = slugify("%s-invoice-%s" % (settings.SITE_TITLE, order.id))
+    return "%s.pdf" % name
+
+
+def invoice_version(order, template=INVOICE_TEMPLATE):
+    """
+    Hash of the order's fields and items, and the template, which
+    changes whenever the order's invoice needs to be rendered again.
+    The values are read from the database rather than the order
+    instance, since the types of unsaved values may differ.
+    """
+    fields = list(Order.objects.filter(id=order.id).values_list())
+    items = list(order.items.order_by("id").values_list())
+    return md5(repr((template, fields, items))).hexdigest()
+
+
+def _invoice_path(order, version):
+    return os.path.join(settings.SHOP_INVOICE_DIR,
+                        "%s-%s.pdf" % (order.id, version))
+
+
+def _cache_key(order, version):
+    return "cartridge.invoice.%s.%s" % (order.id, version)
+
+
+def shared_storage():
+    """
+    Return whether invoices stored by one process can be read by
+    others, which isn't the case when they're stored in a cache that's
+    local to each process, or not stored at all.
+    """
+    local = isinstance(cache, (LocMemCache, DummyCache))
+    return bool(settings.SHOP_INVOICE_DIR) or not local
+
+
+def get_stored_invoice(order, version):
+    """
+    Return the stored PDF for the given version of the order's
+    invoice, or ``None`` if it hasn't been rendered.
+    """
+    if not settings.SHOP_INVOICE_DIR:
+        return cache.get(_cache_key(order, version))
+    try:
+        with open(_invoice_path(order, version), "rb") as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def store_invoice(order, version, data):
+    """
+    Store the PDF for the given version of the order's invoice. When
+    stored on disk, the file is written under a temporary name and
+    renamed, so that a partially written invoice is never served, and
+    the files for earlier versions of the order are removed.
+    """
+    if not settings.SHOP_INVOICE_DIR:
+        cache.set(_cache_key(order, version), data,
+                  settings.SHOP_INVOICE_CACHE_TIMEOUT)
+        return
+    path = _invoice_path(order, version)
+    previous = glob(os.path.join(settings.SHOP_INVOICE_DIR,
+                                 "%s-*.pdf" % order.id))
+    handle, temp_path = mkstemp(dir=settings.SHOP_INVOICE_DIR)
+    with os.fdopen(handle, "wb") as f:
+        f.write(data)
+    os.rename(temp_path, path)
+    for previous_path in previous:
+        if previous_path != path:
+            try:
+                os.remove(previous_path)
+            except OSError:
+                pass
+
+
+def invoice_context(order, request=None):
+    """
+    Return the context for the order's invoice, run through the
+    context processors for both the HTML invoice and the PDF. The PDF
+    is rendered with an anonymous request, so that it's the same
+    whether it's rendered when first downloaded, or ahead of time.
+    """
+    if request is None:
+        request = HttpRequest()
+        request.user = AnonymousUser()
+        request.session = {}
+    context = {"order": order}
+    context.update(order.details_as_dict())
+    return RequestContext(request, context)
+
+
+def render_invoice(order, template=INVOICE_TEMPLATE):
+    """
+    Render the PDF for the order's invoice.
+    """
+    use_editable()
+    html = get_template(template).render(invoice_context(order))
+    import ho.pisa
+    pdf = StringIO()
+    ho.pisa.CreatePDF(html, pdf)
+    return pdf.getvalue()
+
+
+def invoice_pdf(order, template=INVOICE_TEMPLATE):
+    """
+    Return the PDF for the order's invoice, rendering and storing it
+    if the current version of the order hasn't been rendered.
+    """
+    version = invoice_version(order, template)
+    data = get_stored_invoice(order, version)
+    if data is None:
+        data = render_invoice(order, template)
+        store_invoice(order, version, data)
+    return data
+
+
+def _invoice_for_order_id(order_id):
+    """
+    Return the file name and PDF for the order with the given ID. Run
+    in the worker processes of ``invoice_pool``.
+    """
+    order = Order.objects.get(id=order_id)
+    return invoice_filename(order), invoice_pdf(order)
+
+
+def _pregenerate_order_id(order_id):
+    """
+    Render and store the invoice for the order with the given ID,
+    returning True if it wasn't already stored. Run in the worker
+    processes of ``invoice_pool``.
+    """
+    order = Order.objects.get(id=order_id)
+    version = invoice_version(order)
+    if get_stored_invoice(order, version) is not None:
+        return False
+    store_invoice(order, version, render_invoice(order))
+    return True
+
+
+def invoice_pool(func, order_ids, processes=None):
+    """
+    Iterate the results of calling ``func`` with each of the order
+    IDs, in a pool of processes, or in the current process if
+    ``processes`` is 1. The database connection is closed before the
+    pool is created, so that each process opens its own.
+    """
+    if processes == 1:
+        for order_id in order_ids:
+            yield func(order_id)
+        return
+    connection.close()
+    pool = Pool(processes)
+    try:
+        for result in pool.imap(func, order_ids):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def pregenerate_invoices(orders, processes=None):
+    """
+    Render and store the invoices for the orders that haven't been
+    rendered, returning the number rendered.
+    """
+    order_ids = list(orders.values_list("id", flat=True))
+    results = invoice_pool(_pregenerate_order_id, order_ids, processes)
+    return len(filter(None, results))
+
+
+def invoice_zip(orders, fileobj, processes=None):
+    """
+    Write a zip file containing the invoices for the orders to the
+    given file object, returning the number of invoices written.
+    """
+    order_ids = list(orders.values_list("id", flat=True))
+    archive = ZipFile(fileobj, "w", ZIP_DEFLATED)
+    try:
+        for filename, data in invoice_pool(_invoice_for_order_id,
+                                           order_ids, processes):
+            archive.writestr(filename, data)
+    finally:
+        archive.close()
+    return len(order_ids)
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.models import Sale
+
+
+class Command(BaseCommand):
+    args = "[sale_id sale_id ...]"
+    help = _("Clears and reapplies the sale prices of all products for "
+             "the given sales, or all sales if none are given. Changes "
+             "to sales are otherwise applied only to the products "
+             "affected, so this rebuilds the sale prices if they're "
+             "ever out of sync.")
+
+    def handle(self, *sale_ids, **options):
+        sales = Sale.objects.all()
+        if sale_ids:
+            try:
+                sales = sales.filter(id__in=[int(i) for i in sale_ids])
+            except ValueError:
+                raise CommandError(_("Invalid sale IDs: %s") %
+                                   " ".join(sale_ids))
+        total = 0
+        for sale in sales:
+            sale.update_products()
+            total += 1
+        if int(options.get("verbosity", 1)) >= 1:
+            self.stdout.write(_("Sales applied: %s") % total)
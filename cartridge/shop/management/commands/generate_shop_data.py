@@ -0,0 +1,96 @@
+from optparse import make_option
+from time import time
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.generator import DataGenerator
+
+
+class Command(NoArgsCommand):
+    help = _("Generates categories, products, variations, sales, discount "
+             "codes, carts and orders for development and load testing, "
+             "without network access. The same seed always generates the "
+             "same data.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--seed",
+            type="int",
+            dest="seed",
+            default=0,
+            help=_("Seed for the random number generator.")),
+        make_option("--categories",
+            type="int",
+            dest="categories",
+            default=10,
+            help=_("Number of categories to create.")),
+        make_option("--products",
+            type="int",
+            dest="products",
+            default=100,
+            help=_("Number of products to create.")),
+        make_option("--options",
+            type="int",
+            dest="options",
+            default=5,
+            help=_("Number of options to create for each option type.")),
+        make_option("--max-values",
+            type="int",
+            dest="max_values",
+            default=3,
+            help=_("Maximum number of values of each option type per "
+                   "product. Each product has a variation for every "
+                   "combination of its option values.")),
+        make_option("--images",
+            type="int",
+            dest="images",
+            default=20,
+            help=_("Number of placeholder images to draw.")),
+        make_option("--sales",
+            type="int",
+            dest="sales",
+            default=5,
+            help=_("Number of sales to create.")),
+        make_option("--discount-codes",
+            type="int",
+            dest="discount_codes",
+            default=20,
+            help=_("Number of discount codes to create.")),
+        make_option("--carts",
+            type="int",
+            dest="carts",
+            default=100,
+            help=_("Number of carts to create.")),
+        make_option("--orders",
+            type="int",
+            dest="orders",
+            default=1000,
+            help=_("Number of orders to create.")),
+        make_option("--days",
+            type="int",
+            dest="days",
+            default=365,
+            help=_("Number of days in the past that orders are placed "
+                   "over.")),
+        make_option("--batch-size",
+            type="int",
+            dest="batch_size",
+            default=1000,
+            help=_("Number of rows inserted per query.")),
+    )
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        log = self.stdout.write if verbosity >= 2 else None
+        start = time()
+        generator = DataGenerator(options["seed"], options["batch_size"], log)
+        counts = generator.generate(**dict([(k, options[k]) for k in
+            ("categories", "products", "options", "max_values", "images",
+             "sales", "discount_codes", "carts", "orders", "days")]))
+        if verbosity >= 1:
+            for name, count in sorted(counts.items()):
+                self.stdout.write("%s: %s" % (name, count))
+            self.stdout.write(_("Generated in %.1f seconds") %
+                              (time() - start))
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.utils.timezone import get_current_timezone, make_aware
+from django.utils.translation import ugettext as _
+
+from mezzanine.conf import settings
+
+from cartridge.shop.invoices import invoice_zip, pregenerate_invoices
+from cartridge.shop.invoices import shared_storage
+from cartridge.shop.models import Order
+
+
+class Command(NoArgsCommand):
+    help = _("Renders and stores the PDF invoices for orders in the given "
+             "date range, or writes them to a zip file with --zip.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--from",
+            dest="from",
+            default=None,
+            help=_("First date of orders to include, as YYYY-MM-DD.")),
+        make_option("--to",
+            dest="to",
+            default=None,
+            help=_("Last date of orders to include, as YYYY-MM-DD.")),
+        make_option("--zip",
+            dest="zip",
+            default=None,
+            help=_("Path of a zip file to write the invoices to.")),
+        make_option("--processes",
+            type="int",
+            dest="processes",
+            default=None,
+            help=_("Number of processes to render invoices with. "
+                   "Defaults to the number of CPUs.")),
+    )
+
+    def parse_date(self, value):
+        try:
+            date = datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            raise CommandError(_("Invalid date: %s") % value)
+        if settings.USE_TZ:
+            date = make_aware(date, get_current_timezone())
+        return date
+
+    def handle_noargs(self, **options):
+        orders = Order.objects.all()
+        if options["from"]:
+            orders = orders.filter(time__gte=self.parse_date(options["from"]))
+        if options["to"]:
+            to = self.parse_date(options["to"]) + timedelta(days=1)
+            orders = orders.filter(time__lt=to)
+        processes = options["processes"]
+        if options["zip"]:
+            with open(options["zip"], "wb") as f:
+                total = invoice_zip(orders, f, processes)
+            message = _("Invoices written to %(zip)s: %(total)s")
+        else:
+            if not shared_storage():
+                raise CommandError(_("Invoices rendered by this command "
+                                     "can't be read by the site, unless "
+                                     "SHOP_INVOICE_DIR is set or the "
+                                     "cache is shared between processes."))
+            total = pregenerate_invoices(orders, processes)
+            message = _("Invoices rendered: %(total)s")
+        if int(options.get("verbosity", 1)) >= 1:
+            self.stdout.write(message % {"zip": options["zip"],
+                                         "total": total})
@@ -0,0 +1,41 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.models import OrderItem, ProductVariation
+
+
+# Number of SKUs looked up per query.
+CHUNK_SIZE = 500
+
+
+class Command(NoArgsCommand):
+    help = _("Stores the product ID and title against order items that "
+             "were created before these were stored at checkout.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--all",
+            action="store_true",
+            dest="all",
+            default=False,
+            help=_("Update all order items, not only those without a "
+                   "product ID.")),
+    )
+
+    def handle_noargs(self, **options):
+        items = OrderItem.objects.all()
+        if not options["all"]:
+            items = items.filter(product_id__isnull=True)
+        skus = list(set(items.values_list("sku", flat=True)))
+        updated = 0
+        for i in range(0, len(skus), CHUNK_SIZE):
+            variations = ProductVariation.objects.filter(
+                sku__in=skus[i:i + CHUNK_SIZE])
+            variations = variations.values_list("sku", "product_id",
+                                                "product__title")
+            for sku, product_id, title in variations:
+                updated += items.filter(sku=sku).update(
+                    product_id=product_id, product_title=title)
+        if int(options.get("verbosity", 1)) >= 1:
+            self.stdout.write(_("Order items updated: %s") % updated)
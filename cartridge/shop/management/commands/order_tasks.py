@@ -0,0 +1,42 @@
+from optparse import make_option
+from time import sleep
+
+from django.core.management.base import NoArgsCommand
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.tasks import run_pending
+
+
+class Command(NoArgsCommand):
+    help = _("Runs the order tasks deferred from the checkout process "
+             "via the SHOP_ORDER_TASKS_DEFERRED setting.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--loop",
+            action="store_true",
+            dest="loop",
+            default=False,
+            help=_("Keep running, checking for new tasks.")),
+        make_option("--interval",
+            type="int",
+            dest="interval",
+            default=5,
+            help=_("Seconds to wait between checks when using --loop.")),
+        make_option("--limit",
+            type="int",
+            dest="limit",
+            default=None,
+            help=_("Maximum number of tasks to run per check.")),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        while True:
+            completed, attempted = run_pending(options["limit"])
+            if verbosity >= 1 and attempted:
+                self.stdout.write(_("Order tasks completed: %s of %s") %
+                                  (completed, attempted))
+            if not options["loop"]:
+                break
+            if not attempted:
+                sleep(options["interval"])
@@ -0,0 +1,52 @@
+import os
+from optparse import make_option
+
+from django.core.management.base import LabelCommand, CommandError
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.pricefeed import CHUNK_SIZE, FORMATS, FeedError
+from cartridge.shop.pricefeed import apply_feed, read_feed
+
+
+class Command(LabelCommand):
+    args = "<feed_file>"
+    label = "feed file"
+    help = _("Updates the prices and stock of variations by SKU from a "
+             "CSV or JSONL feed, with sku, unit_price, num_in_stock, "
+             "sale_price, sale_from and sale_to columns or keys, then "
+             "copies the price fields from the default variation of "
+             "each product updated to the product.")
+
+    option_list = LabelCommand.option_list + (
+        make_option("--format",
+            dest="format",
+            default=None,
+            help=_("Format of the feed, csv or jsonl. Defaults to the "
+                   "file's extension.")),
+        make_option("--chunk-size",
+            type="int",
+            dest="chunk_size",
+            default=CHUNK_SIZE,
+            help=_("Number of rows applied per update statement.")),
+    )
+
+    def handle_label(self, path, **options):
+        format = options["format"]
+        if not format:
+            format = os.path.splitext(path)[1].lstrip(".").lower()
+        if format not in FORMATS:
+            raise CommandError(_("Unknown format: %s") % format)
+        try:
+            with open(path, "rb") as f:
+                result = apply_feed(read_feed(f, format),
+                                    options["chunk_size"])
+        except (IOError, FeedError), e:
+            raise CommandError(e)
+        verbosity = int(options.get("verbosity", 1))
+        if verbosity >= 1:
+            self.stdout.write(_("Variations updated: %s") % result["updated"])
+            self.stdout.write(_("Products updated: %s") % result["products"])
+            self.stdout.write(_("Unknown SKUs: %s") % len(result["unknown"]))
+        if verbosity >= 2:
+            for sku in result["unknown"]:
+                self.stdout.write(sku)
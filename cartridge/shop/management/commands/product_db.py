@@ -50,7 +50,9 @@ PRODUCT_IMAGE_DIR = os.path.join(settings.STATIC_ROOT, SITE_MEDIA_IMAGE_DIR)
 #TYPE_CHOICES = {choice:id for id, choice in settings.SHOP_OPTION_TYPE_CHOICES}
 TYPE_CHOICES = dict()
 for id, choice in settings.SHOP_OPTION_TYPE_CHOICES:
-    TYPE_CHOICES[choice] = id
+    # Option type names are lazy translations, which can't be used to
+    # look up the columns of rows read from the csv.
+    TYPE_CHOICES[unicode(choice)] = id
 
 fieldnames = [TITLE, CONTENT, DESCRIPTION, CATEGORY, SUB_CATEGORY,
     SKU, IMAGE, NUM_IN_STOCK, UNIT_PRICE,
@@ -190,15 +192,20 @@ def export_products(csv_file):
     for field in fieldnames:
         headers[field] = field
     writer.writerow(headers)
-    for pv in ProductVariation.objects.all():
+    # The current site's products and their categories are read up
+    # front, rather than for each variation.
+    products = Product.objects.prefetch_related("categories__parent")
+    products = dict([(p.id, p) for p in products])
+    for pv in ProductVariation.objects.select_related("image"):
+        product = products.get(pv.product_id) or pv.product
         row = dict()
-        row[TITLE] = pv.product.title
-        row[CONTENT] = pv.product.content
-        row[DESCRIPTION] = pv.product.description
+        row[TITLE] = product.title
+        row[CONTENT] = product.content
+        row[DESCRIPTION] = product.description
         row[SKU] = pv.sku
         row[IMAGE] = pv.image
         # TODO: handle multiple categories, and multiple levels of categories
-        cat = pv.product.categories.all()[0]
+        cat = product.categories.all()[0]
         if cat.parent:
             row[SUB_CATEGORY] = cat.title
             row[CATEGORY] = cat.parent.title
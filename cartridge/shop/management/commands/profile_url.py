@@ -0,0 +1,216 @@
+import re
+from cProfile import Profile
+from optparse import make_option
+from pstats import Stats
+from StringIO import StringIO
+from time import time
+
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management.base import LabelCommand, CommandError
+from django.core.signals import request_finished
+from django.db import close_connection, connection, reset_queries
+from django.db import transaction
+from django.db.models import Q
+from django.http import QueryDict
+from django.test.client import Client
+from django.utils.datastructures import SortedDict
+from django.utils.importlib import import_module
+from django.utils.timezone import now
+from django.utils.translation import ugettext as _
+
+from mezzanine.conf import settings
+
+from cartridge.shop.benchmarks import order_data
+from cartridge.shop.models import Cart, ProductVariation
+from cartridge.shop.utils import CheckoutState
+
+
+# Literal values in queries, replaced to find queries that only
+# differ by their parameters.
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def normalize_sql(sql):
+    """
+    Replace the literal values in the query with placeholders.
+    """
+    return LITERALS.sub("?", sql)
+
+
+def query_summary(queries):
+    """
+    Group the queries run, given as dicts with ``sql`` and ``time``
+    keys, by their SQL with literal values replaced. Returns a list of
+    dicts for each group, with the number of queries, the number of
+    exact duplicates, and the total time, most frequent first.
+    """
+    groups = SortedDict()
+    for query in queries:
+        group = groups.setdefault(normalize_sql(query["sql"]), {
+            "count": 0, "time": 0, "distinct": set()})
+        group["count"] += 1
+        group["time"] += float(query["time"])
+        group["distinct"].add(query["sql"])
+    summary = []
+    for sql, group in groups.items():
+        summary.append({"sql": sql, "count": group["count"],
+                        "duplicates": group["count"] - len(group["distinct"]),
+                        "time": group["time"]})
+    summary.sort(key=lambda group: -group["count"])
+    return summary
+
+
+class Command(LabelCommand):
+    args = "<url>"
+    label = "URL"
+    help = _("Requests a URL in the shop a number of times with the "
+             "test client, writing a cProfile dump and a log of the "
+             "queries run, and reporting the slowest functions and any "
+             "repeated queries. Each request can be given a session "
+             "with a cart of products, and is rolled back once done.")
+
+    option_list = LabelCommand.option_list + (
+        make_option("--repeat",
+            type="int",
+            dest="repeat",
+            default=10,
+            help=_("Number of times to request the URL.")),
+        make_option("--data",
+            dest="data",
+            default=None,
+            help=_("Query string of data to post to the URL, rather than "
+                   "making a GET request.")),
+        make_option("--checkout-data",
+            action="store_true",
+            dest="checkout_data",
+            default=False,
+            help=_("Post valid data for the final checkout step, along "
+                   "with any given by --data.")),
+        make_option("--cart-items",
+            type="int",
+            dest="cart_items",
+            default=0,
+            help=_("Number of variations in stock to add to a new cart "
+                   "in the session for each request.")),
+        make_option("--user",
+            dest="user",
+            default=None,
+            help=_("Username of the user to log in as for each request.")),
+        make_option("--output",
+            dest="output",
+            default="profile",
+            help=_("Prefix of the files to write, with .pstats added "
+                   "for the cProfile dump and .sql for the query log.")),
+        make_option("--top",
+            type="int",
+            dest="top",
+            default=20,
+            help=_("Number of functions to report.")),
+        make_option("--sort",
+            dest="sort",
+            default="cumulative",
+            help=_("Order to report the functions in, such as "
+                   "cumulative, time or calls.")),
+        make_option("--commit",
+            action="store_true",
+            dest="commit",
+            default=False,
+            help=_("Commit the changes made by the requests, rather than "
+                   "rolling them back.")),
+    )
+
+    def handle_label(self, url, **options):
+        data = None
+        if options["data"] or options["checkout_data"]:
+            data = order_data() if options["checkout_data"] else {}
+            data.update(QueryDict(options["data"] or "").items())
+        user = None
+        if options["user"]:
+            try:
+                user = User.objects.get(username=options["user"])
+            except User.DoesNotExist:
+                raise CommandError(_("Unknown user: %s") % options["user"])
+        engine = import_module(settings.SESSION_ENGINE)
+        variations = ProductVariation.objects.filter(
+            Q(num_in_stock__gt=0) | Q(num_in_stock__isnull=True))
+        variations = list(variations[:options["cart_items"]])
+
+        # The test client closes the connection at the end of each
+        # request, which would end the transaction.
+        receivers = len(request_finished.receivers)
+        request_finished.disconnect(close_connection)
+        disconnected = len(request_finished.receivers) < receivers
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        connection.use_debug_cursor = True
+        profile = Profile()
+        times = []
+        queries = []
+        try:
+            for i in range(options["repeat"]):
+                client = Client()
+                session = engine.SessionStore()
+                if variations:
+                    cart = Cart.objects.create(last_updated=now())
+                    for variation in variations:
+                        cart.add_item(variation, 1)
+                    CheckoutState(session).update(cart=cart.id)
+                if user:
+                    session[SESSION_KEY] = user.id
+                    session[BACKEND_SESSION_KEY] = \
+                        "django.contrib.auth.backends.ModelBackend"
+                session.save()
+                client.cookies[settings.SESSION_COOKIE_NAME] = \
+                    session.session_key
+                reset_queries()
+                start = time()
+                profile.enable()
+                if data is None:
+                    response = client.get(url)
+                else:
+                    response = client.post(url, data)
+                profile.disable()
+                times.append(time() - start)
+                queries.append(list(connection.queries))
+        finally:
+            if options["commit"]:
+                transaction.commit()
+            else:
+                transaction.rollback()
+            transaction.leave_transaction_management()
+            if disconnected:
+                request_finished.connect(close_connection)
+
+        profile.dump_stats("%s.pstats" % options["output"])
+        with open("%s.sql" % options["output"], "w") as f:
+            for i, request_queries in enumerate(queries):
+                f.write("-- Request %s\n" % (i + 1))
+                for query in request_queries:
+                    f.write("-- %ss\n%s;\n" % (query["time"], query["sql"]))
+            f.write("\n-- Queries per request, grouped\n")
+            for group in query_summary(queries[-1]):
+                f.write("-- %(count)s queries, %(duplicates)s duplicates, "
+                        "%(time).3fs\n%(sql)s;\n" % group)
+
+        times.sort()
+        self.stdout.write(_("%(method)s %(url)s: %(status)s") % {
+            "method": "GET" if data is None else "POST", "url": url,
+            "status": response.status_code})
+        self.stdout.write(_("Time: %(median).4fs median, %(min).4fs min, "
+                            "%(max).4fs max") % {
+            "median": times[len(times) // 2], "min": times[0],
+            "max": times[-1]})
+        self.stdout.write(_("Queries per request: %s") % len(queries[-1]))
+        for group in query_summary(queries[-1]):
+            if group["count"] > 1:
+                self.stdout.write(_("%(count)s similar queries, "
+                                    "%(duplicates)s duplicates: "
+                                    "%(sql)s") % dict(group,
+                                    sql=group["sql"][:200]))
+        self.stdout.write(_("Wrote %(output)s.pstats and %(output)s.sql") %
+                          {"output": options["output"]})
+        output = StringIO()
+        stats = Stats(profile, stream=output)
+        stats.sort_stats(options["sort"]).print_stats(options["top"])
+        self.stdout.write(output.getvalue())
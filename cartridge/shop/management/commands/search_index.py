@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.utils.translation import ugettext as _
+
+from mezzanine.conf import settings
+
+from cartridge.shop.search import build, is_stale
+
+
+class Command(NoArgsCommand):
+    help = _("Builds the product search index in SHOP_SEARCH_INDEX_DIR, "
+             "replacing any existing index. Products changed once it's "
+             "built are indexed again as they're saved, until too many "
+             "have changed and the index is marked as stale, so it "
+             "should be rebuilt periodically with --stale, and after "
+             "importing or changing products in bulk.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--stale",
+            action="store_true",
+            dest="stale",
+            default=False,
+            help=_("Only build the index if it's been marked as stale.")),
+    )
+
+    def handle_noargs(self, **options):
+        if not settings.SHOP_SEARCH_INDEX_DIR:
+            raise CommandError(_("SHOP_SEARCH_INDEX_DIR isn't set"))
+        if options["stale"] and not is_stale():
+            self.stdout.write(_("The index isn't stale"))
+            return
+        total = build()
+        self.stdout.write(_("Indexed %s products") % total)
@@ -0,0 +1,135 @@
+from datetime import datetime
+from optparse import make_option
+
+import django
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment
+from django.utils import simplejson
+from django.utils.translation import ugettext as _
+
+from mezzanine.conf import settings
+
+from cartridge.shop.benchmarks import BENCHMARKS, compare, run_benchmarks
+from cartridge.shop.generator import DataGenerator
+
+
+class Command(NoArgsCommand):
+    help = _("Runs the shop benchmarks against generated data in a test "
+             "database, and writes the wall time, number of queries and "
+             "peak memory for each as JSON. Available benchmarks are: %s") % (
+             ", ".join(BENCHMARKS.keys()))
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--output",
+            dest="output",
+            default=None,
+            help=_("File to write the results to, rather than stdout.")),
+        make_option("--compare",
+            dest="compare",
+            default=None,
+            help=_("Results file from a previous run to compare against. "
+                   "The command fails if there are any regressions.")),
+        make_option("--tolerance",
+            type="float",
+            dest="tolerance",
+            default=.2,
+            help=_("Fraction that time and memory can increase by before "
+                   "it's considered a regression.")),
+        make_option("--benchmark",
+            action="append",
+            dest="benchmarks",
+            default=[],
+            help=_("Name of a benchmark to run, which can be given more "
+                   "than once. Defaults to all benchmarks.")),
+        make_option("--repeat",
+            type="int",
+            dest="repeat",
+            default=5,
+            help=_("Number of times to run each benchmark.")),
+        make_option("--cart-items",
+            type="int",
+            dest="cart_items",
+            default=10,
+            help=_("Number of items in the carts and wishlist used.")),
+        make_option("--seed",
+            type="int",
+            dest="seed",
+            default=0,
+            help=_("Seed for generating data.")),
+        make_option("--products",
+            type="int",
+            dest="products",
+            default=500,
+            help=_("Number of products to generate.")),
+        make_option("--orders",
+            type="int",
+            dest="orders",
+            default=1000,
+            help=_("Number of orders to generate.")),
+        make_option("--existing",
+            action="store_true",
+            dest="existing",
+            default=False,
+            help=_("Use the data in the current database rather than "
+                   "generating it in a test database. Note that the "
+                   "benchmarks create carts, orders and products.")),
+        make_option("--no-fork",
+            action="store_false",
+            dest="fork",
+            default=True,
+            help=_("Run each benchmark in the current process, rather "
+                   "than a forked process.")),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        log = self.stderr.write if verbosity >= 2 else None
+        unknown = set(options["benchmarks"]) - set(BENCHMARKS.keys())
+        if unknown:
+            raise CommandError(_("Unknown benchmarks: %s") %
+                               ", ".join(unknown))
+        setup_test_environment()
+        if not options["existing"]:
+            if "south" in settings.INSTALLED_APPS:
+                from south.management.commands import patch_for_test_db_setup
+                patch_for_test_db_setup()
+            old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            if not options["existing"]:
+                generator = DataGenerator(options["seed"], log=log)
+                generator.generate(products=options["products"],
+                                   orders=options["orders"], images=0)
+            results = run_benchmarks(options["benchmarks"],
+                                     options["repeat"],
+                                     options["cart_items"],
+                                     options["fork"], log)
+        finally:
+            if not options["existing"]:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+        output = {
+            "time": datetime.now().isoformat(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "options": dict([(k, options[k]) for k in ("seed", "products",
+                "orders", "repeat", "cart_items", "existing")]),
+            "results": results,
+        }
+        json = simplejson.dumps(output, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(json)
+        else:
+            self.stdout.write(json)
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                previous = simplejson.load(f)["results"]
+            regressions = compare(previous, results, options["tolerance"])
+            if regressions:
+                raise CommandError(_("Regressions found:\n%s") %
+                                   "\n".join(regressions))
+        failed = [n for n, r in results.items() if "error" in r]
+        if failed:
+            for name in failed:
+                self.stderr.write("%s\n%s" % (name, results[name]["error"]))
+            raise CommandError(_("Benchmarks failed: %s") % ", ".join(failed))
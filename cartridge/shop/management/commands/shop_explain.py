@@ -0,0 +1,50 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.explain import check, lookups
+
+
+class Command(BaseCommand):
+    args = "[lookup lookup ...]"
+    help = _("Runs EXPLAIN on the configured database for the shop's "
+             "main lookups, and reports the lookups that scan a whole "
+             "table rather than using an index. The lookups to check "
+             "can be given by name, otherwise all are checked. Use "
+             "--verbosity=2 to show the query plans.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--fail",
+            action="store_true",
+            dest="fail",
+            default=False,
+            help=_("Exit with an error if any sequential scans are "
+                   "found.")),
+    )
+
+    def handle(self, *names, **options):
+        unknown = set(names) - set(lookups().keys())
+        if unknown:
+            raise CommandError(_("Unknown lookups: %s") %
+                               ", ".join(sorted(unknown)))
+        try:
+            results = check(names)
+        except NotImplementedError, e:
+            raise CommandError(e)
+        verbosity = int(options.get("verbosity", 1))
+        width = max([len(name) for name, plan, tables in results])
+        scanned = 0
+        for name, plan, tables in results:
+            if tables:
+                scanned += 1
+                status = _("sequential scan on %s") % ", ".join(tables)
+            else:
+                status = _("ok")
+            self.stdout.write("%s %s" % (name.ljust(width), status))
+            if verbosity > 1:
+                for line in plan:
+                    self.stdout.write("    %s" % line)
+        if scanned and options["fail"]:
+            raise CommandError(_("%s of %s lookups scan whole tables") %
+                               (scanned, len(results)))
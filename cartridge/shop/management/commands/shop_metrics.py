@@ -0,0 +1,67 @@
+import os
+from glob import glob
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.utils.translation import ugettext as _
+
+from mezzanine.conf import settings
+
+from cartridge.shop.instrumentation import percentiles, read_histograms
+
+
+class Command(NoArgsCommand):
+    help = _("Reports the percentiles of the timings, and the totals of "
+             "the counters, recorded by each process with the "
+             "HistogramSink in SHOP_INSTRUMENTATION_DIR.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--percentiles",
+            dest="percentiles",
+            default="50,90,99",
+            help=_("Comma separated percentiles to report.")),
+        make_option("--reset",
+            action="store_true",
+            dest="reset",
+            default=False,
+            help=_("Remove the recorded timings and counters once "
+                   "reported.")),
+    )
+
+    def handle_noargs(self, **options):
+        directory = settings.SHOP_INSTRUMENTATION_DIR
+        if not directory:
+            raise CommandError(_("SHOP_INSTRUMENTATION_DIR isn't set"))
+        try:
+            points = [float(p) for p in options["percentiles"].split(",")]
+        except ValueError:
+            raise CommandError(_("Invalid percentiles: %s") %
+                               options["percentiles"])
+        points = [int(p) if p == int(p) else p for p in points]
+        data = read_histograms(directory)
+        if data["timings"]:
+            label = _("Timing (ms)")
+            width = max([len(n) for n in data["timings"]] + [len(label)])
+            columns = ["count", "mean"] + ["p%s" % p for p in points] + [
+                       "max"]
+            self.stdout.write("%s %s" % (label.ljust(width),
+                " ".join([c.rjust(10) for c in columns])))
+            for name in sorted(data["timings"]):
+                summary = percentiles(data["timings"][name], points)
+                values = ["%s" % summary["count"]] + ["%.3f" % summary[c]
+                                                      for c in columns[1:]]
+                self.stdout.write("%s %s" % (name.ljust(width),
+                    " ".join([v.rjust(10) for v in values])))
+        if data["counters"]:
+            label = _("Counter")
+            width = max([len(n) for n in data["counters"]] + [len(label)])
+            self.stdout.write("\n%s %s" % (label.ljust(width),
+                                             _("total").rjust(10)))
+            for name in sorted(data["counters"]):
+                self.stdout.write("%s %s" % (name.ljust(width),
+                    str(data["counters"][name]).rjust(10)))
+        if not data["timings"] and not data["counters"]:
+            self.stdout.write(_("Nothing has been recorded."))
+        if options["reset"]:
+            for path in glob(os.path.join(directory, "*.json")):
+                os.remove(path)
@@ -1,16 +1,21 @@
 
 from collections import defaultdict
 from datetime import datetime, timedelta
+from operator import ior
 
-from django.db.models import Manager, Q
+from django.db import IntegrityError, connection, transaction
+from django.db.models import AutoField, F, Manager, Q, Sum
 from django.utils.datastructures import SortedDict
 from django.utils.timezone import now
 
 from mezzanine.conf import settings
 
+from cartridge.shop.instrumentation import timer
+
 
 class CartManager(Manager):
 
+    @timer("cart.from_request")
     def from_request(self, request):
         """
         Return a cart by ID stored in the session, creating it if not
@@ -20,13 +25,15 @@ class CartManager(Manager):
         n = now()
         expiry_minutes = timedelta(minutes=settings.SHOP_CART_EXPIRY_MINUTES)
         expiry_time = n - expiry_minutes
-        cart_id = request.session.get("cart", None)
+        from cartridge.shop.utils import EmptyCart, checkout_state
+        state = checkout_state(request)
+        cart_id = state.get("cart")
         cart = None
         if cart_id:
             try:
                 cart = self.get(last_updated__gte=expiry_time, id=cart_id)
             except self.model.DoesNotExist:
-                request.session["cart"] = None
+                state.clear("cart")
             else:
                 # Update timestamp and clear out old carts.
                 cart.last_updated = n
@@ -34,16 +41,77 @@ class CartManager(Manager):
                 self.filter(last_updated__lt=expiry_time).delete()
         if not cart:
             # Forget what checkout step we were up to.
-            try:
-                del request.session["order"]["step"]
-                request.session.modified = True
-            except KeyError:
-                pass
-            from cartridge.shop.utils import EmptyCart
+            state.clear("step")
             cart = EmptyCart(request)
         return cart
 
 
+class WishlistItemManager(Manager):
+
+    def skus_for(self, user):
+        """
+        Returns the SKUs in the user's wishlist, in the order they
+        were added.
+        """
+        items = self.filter(user_id=user.id).order_by("id")
+        return list(items.values_list("sku", flat=True))
+
+    def add_skus(self, user, skus):
+        """
+        Adds the SKUs given to the user's wishlist, skipping those
+        already in it, and those that aren't the SKU of a variation,
+        since they can come from the wishlist cookie.
+        """
+        from cartridge.shop.models import ProductVariation
+        valid = ProductVariation.objects.filter(sku__in=skus)
+        valid = set(valid.values_list("sku", flat=True))
+        existing = self.filter(user_id=user.id, sku__in=valid)
+        existing = set(existing.values_list("sku", flat=True))
+        new = []
+        for sku in skus:
+            if sku in valid and sku not in existing:
+                new.append(self.model(user_id=user.id, sku=sku))
+                existing.add(sku)
+        if new:
+            self._insert(new)
+
+    def _insert(self, items):
+        """
+        Inserts the wishlist items, in a single query where possible.
+        If any of them have been added by another request at the same
+        time, the items are inserted one at a time instead, skipping
+        those that already exist.
+        """
+        fields = [f for f in self.model._meta.local_fields
+                  if not isinstance(f, AutoField)]
+        batch_size = connection.ops.bulk_batch_size(fields, items)
+        with transaction.commit_on_success():
+            sid = transaction.savepoint()
+            try:
+                self.bulk_create(items, batch_size=batch_size)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.savepoint_commit(sid)
+                return
+            for item in items:
+                sid = transaction.savepoint()
+                try:
+                    item.save()
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+                else:
+                    transaction.savepoint_commit(sid)
+
+    def set_skus(self, user, skus):
+        """
+        Makes the user's wishlist contain the SKUs given, removing
+        any others.
+        """
+        self.filter(user_id=user.id).exclude(sku__in=skus).delete()
+        self.add_skus(user, skus)
+
+
 class OrderManager(Manager):
 
     def from_request(self, request):
@@ -58,6 +126,37 @@ class OrderManager(Manager):
         raise self.model.DoesNotExist
 
 
+class OrderTaskManager(Manager):
+
+    def defer(self, order, name):
+        """
+        Queue the task with the given name for the order, to be run
+        by the ``order_tasks`` management command.
+        """
+        return self.create(order=order, name=name, run_after=now())
+
+    def pending(self):
+        """
+        Tasks that are due to run, and haven't completed or used up
+        their attempts.
+        """
+        return self.filter(completed=False, run_after__lte=now(),
+                           attempts__lt=settings.SHOP_ORDER_TASK_ATTEMPTS)
+
+    def claim(self, task):
+        """
+        Claim the task for running by moving ``run_after`` forward,
+        which also acts as the delay before a failed task is retried.
+        The update is conditional on ``run_after`` being unchanged, so
+        only one worker can claim the task. Returns True if claimed.
+        """
+        retry = now() + timedelta(minutes=2 ** task.attempts)
+        lookup = {"id": task.id, "run_after": task.run_after,
+                  "completed": False}
+        update = {"run_after": retry, "attempts": F("attempts") + 1}
+        return self.filter(**lookup).update(**update) == 1
+
+
 class ProductOptionManager(Manager):
 
     def as_fields(self):
@@ -86,24 +185,93 @@ class ProductVariationManager(Manager):
 
     def create_from_options(self, options):
         """
-        Create all unique variations from the selected options.
+        Create all unique variations from the selected options. The
+        existing combinations are read in a single query, and the
+        missing ones are inserted in bulk and given their IDs as SKUs.
+        Inserting in bulk doesn't send the ``post_save`` signal, so
+        the SKUs resolved for discounts are discarded here.
         """
         if options:
             options = SortedDict(options)
+            names = [f.name for f in self.model.option_fields()]
+            # Unspecified options are null, so each combination is
+            # compared with the values of all option fields.
+            existing = set(self.values_list(*names))
             # Build all combinations of options.
             variations = [[]]
             for values_list in options.values():
                 variations = [x + [y] for x in variations for y in values_list]
+            new = []
             for variation in variations:
-                # Lookup unspecified options as null to ensure a
-                # unique filter.
                 variation = dict(zip(options.keys(), variation))
-                lookup = dict(variation)
-                lookup.update(self._empty_options_lookup(exclude=variation))
-                try:
-                    self.get(**lookup)
-                except self.model.DoesNotExist:
-                    self.create(**variation)
+                combination = tuple([variation.get(name) for name in names])
+                if combination not in existing:
+                    existing.add(combination)
+                    new.append(self.model(product=self.instance, **variation))
+            if new:
+                fields = [f for f in self.model._meta.local_fields
+                          if not isinstance(f, AutoField)]
+                batch_size = connection.ops.bulk_batch_size(fields, new)
+                self.bulk_create(new, batch_size=batch_size)
+                # Use the IDs as SKUs, as ProductVariation.save does,
+                # for just the variations created, which are found by
+                # their options since they're unique for the product.
+                blank = Q(sku__isnull=True) | Q(sku="")
+                size = connection.ops.bulk_batch_size(names, new)
+                for i in range(0, len(new), size):
+                    created = []
+                    for variation in new[i:i + size]:
+                        lookup = {}
+                        for name in names:
+                            value = getattr(variation, name)
+                            if value is None:
+                                lookup["%s__isnull" % name] = True
+                            else:
+                                lookup[name] = value
+                        created.append(Q(**lookup))
+                    created = reduce(ior, created)
+                    self.filter(blank, created).update(sku=F("id"))
+                from cartridge.shop import discounts
+                discounts.invalidate()
+
+    def with_live_stock(self, skus):
+        """
+        Return the variations with the given SKUs as a dict keyed by
+        SKU, with the quantities in carts for all of them totalled in
+        a single query, and cached as their live number in stock, as
+        given by ``ProductVariation.live_num_in_stock``.
+        """
+        from cartridge.shop.models import CartItem
+        variations = dict([(v.sku, v) for v in self.filter(sku__in=skus)])
+        in_carts = CartItem.objects.filter(sku__in=variations.keys())
+        in_carts = dict(in_carts.values_list("sku").annotate(Sum("quantity")))
+        for sku, variation in variations.items():
+            if variation.num_in_stock is not None:
+                variation._cached_num_in_stock = (variation.num_in_stock -
+                                                  in_carts.get(sku, 0))
+        return variations
+
+    def update_stock_bulk(self, quantities):
+        """
+        Update the stock levels of many variations, given a dict
+        mapping each variation to the quantity to change its stock by,
+        as ``ProductVariation.update_stock`` does for one variation,
+        with an update for each distinct quantity.
+        """
+        from cartridge.shop.models import Product
+        variations, defaults = defaultdict(list), defaultdict(list)
+        for variation, quantity in quantities.items():
+            if variation.num_in_stock is not None:
+                variations[quantity].append(variation.id)
+                if variation.default:
+                    defaults[quantity].append(variation.product_id)
+                variation.num_in_stock += quantity
+        for quantity, ids in variations.items():
+            num_in_stock = F("num_in_stock") + quantity
+            self.filter(id__in=ids).update(num_in_stock=num_in_stock)
+            if defaults[quantity]:
+                Product.objects.filter(id__in=defaults[quantity]).update(
+                    num_in_stock=num_in_stock)
 
     def manage_empty(self):
         """
@@ -130,22 +298,13 @@ class ProductVariationManager(Manager):
         doesn't have an image. Also remove any images that have been
         deleted via the admin to avoid invalid image selections.
         """
-        variations = self.all()
-        if not variations:
-            return
-        image = variations[0].product.images.exclude(id__in=deleted_image_ids)
-        if image:
-            image = image[0]
-        for variation in variations:
-            save = False
-            if unicode(variation.image_id) in deleted_image_ids:
-                variation.image = None
-                save = True
-            if image and not variation.image:
-                variation.image = image
-                save = True
-            if save:
-                variation.save()
+        deleted_image_ids = [i for i in deleted_image_ids if i]
+        if deleted_image_ids:
+            self.filter(image__in=deleted_image_ids).update(image=None)
+        images = self.instance.images.exclude(id__in=deleted_image_ids)
+        image_ids = list(images.values_list("id", flat=True)[:1])
+        if image_ids:
+            self.filter(image__isnull=True).update(image=image_ids[0])
 
 
 class ProductActionManager(Manager):
@@ -169,12 +328,54 @@ class ProductActionManager(Manager):
         """
         self._action_for_field("total_cart")
 
+    def _bulk_action_for_field(self, field, product_ids):
+        """
+        Increase the given field for each of the given products, by the
+        number of times each product is given, with an update for each
+        distinct number for the products that already have an action
+        for today, and a bulk insert for the rest.
+        """
+        timestamp = datetime.today().toordinal()
+        counts = defaultdict(int)
+        for product_id in product_ids:
+            counts[product_id] += 1
+        actions = self.filter(product__in=counts.keys(), timestamp=timestamp)
+        existing = set(actions.values_list("product_id", flat=True))
+        by_count = defaultdict(list)
+        for product_id in existing:
+            by_count[counts[product_id]].append(product_id)
+        for count, ids in by_count.items():
+            actions.filter(product__in=ids).update(
+                **{field: F(field) + count})
+        new = [self.model(product_id=product_id, timestamp=timestamp,
+                          **{field: count})
+               for product_id, count in counts.items()
+               if product_id not in existing]
+        if new:
+            fields = [f for f in self.model._meta.local_fields
+                      if not isinstance(f, AutoField)]
+            batch_size = connection.ops.bulk_batch_size(fields, new)
+            self.bulk_create(new, batch_size=batch_size)
+
+    def added_to_cart_bulk(self, product_ids):
+        """
+        Increase total_cart once for each of the given products.
+        """
+        self._bulk_action_for_field("total_cart", set(product_ids))
+
     def purchased(self):
         """
         Increase total_purchased when product is purchased.
         """
         self._action_for_field("total_purchase")
 
+    def purchased_bulk(self, product_ids):
+        """
+        Increase total_purchased for each of the given products, once
+        for each time the product is given.
+        """
+        self._bulk_action_for_field("total_purchase", product_ids)
+
 
 class DiscountCodeManager(Manager):
 
@@ -189,6 +390,7 @@ class DiscountCodeManager(Manager):
         valid = self.filter(valid_from, valid_to, active=True)
         return valid.exclude(uses_remaining=0)
 
+    @timer("discount.get_valid")
     def get_valid(self, code, cart):
         """
         Items flagged as active and within date range as well checking
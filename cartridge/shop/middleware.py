@@ -1,7 +1,13 @@
 
+from operator import contains
+
+from django.utils.functional import SimpleLazyObject, new_method_proxy
+
 from mezzanine.conf import settings
 
-from cartridge.shop.models import Cart
+from cartridge.shop import cacheable, search
+from cartridge.shop.models import Cart, WishlistItem
+from cartridge.shop.utils import CheckoutState
 
 
 class SSLRedirect(object):
@@ -23,13 +29,63 @@ class SSLRedirect(object):
                 break
 
 
+class LazyCart(SimpleLazyObject):
+    """
+    The cart for the request, only loaded once it's used.
+    """
+    __iter__ = new_method_proxy(iter)
+
+
+class LazyWishlist(SimpleLazyObject):
+    """
+    The list of SKUs in the wishlist of an authenticated user, only
+    loaded once it's used.
+    """
+    __iter__ = new_method_proxy(iter)
+    __len__ = new_method_proxy(len)
+    __contains__ = new_method_proxy(contains)
+    __nonzero__ = new_method_proxy(bool)
+
+
 class ShopMiddleware(SSLRedirect):
     """
-    Adds cart and wishlist attributes to the current request.
+    Adds cart and wishlist attributes to the current request. When
+    ``SHOP_CACHEABLE_PAGES`` is ``True``, the cart is only loaded once
+    it's used, since cacheable pages don't use it, and the caching
+    headers are added to the responses for them.
+
+    The wishlist is stored in a cookie for anonymous users, and in the
+    database for authenticated users, with the cookie's SKUs added to
+    it and the cookie removed once they've logged in.
+
+    Changes to the catalogue during the request are applied to the
+    version of the catalogue used for caching, and products changed
+    are indexed again for product search, once the response is ready.
     """
     def process_request(self, request):
-        request.cart = Cart.objects.from_request(request)
+        cacheable.defer()
+        search.defer()
+        request.checkout_state = CheckoutState(request.session)
+        if settings.SHOP_CACHEABLE_PAGES:
+            request.cart = LazyCart(
+                lambda: Cart.objects.from_request(request))
+        else:
+            request.cart = Cart.objects.from_request(request)
         wishlist = request.COOKIES.get("wishlist", "").split(",")
         if not wishlist[0]:
             wishlist = []
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated():
+            if wishlist:
+                WishlistItem.objects.add_skus(user, wishlist)
+                request._wishlist_merged = True
+            wishlist = LazyWishlist(
+                lambda: WishlistItem.objects.skus_for(user))
         request.wishlist = wishlist
+
+    def process_response(self, request, response):
+        cacheable.flush()
+        search.flush()
+        if getattr(request, "_wishlist_merged", False):
+            response.delete_cookie("wishlist")
+        return cacheable.add_headers(request, response)
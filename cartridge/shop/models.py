@@ -1,17 +1,20 @@
+from collections import defaultdict
 from decimal import Decimal
 from operator import iand, ior
 
 from django.core.urlresolvers import reverse
-from django.db import models
-from django.db.models.signals import m2m_changed
+from django.db import connection, models
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.db.models import CharField, F, Q
 from django.db.models.base import ModelBase
 from django.db.utils import DatabaseError
 from django.dispatch import receiver
+from django.utils.datastructures import SortedDict
 from django.utils.timezone import now
 from django.utils.translation import ugettext, ugettext_lazy as _
 
 from mezzanine.conf import settings
+from mezzanine.conf.models import Setting
 from mezzanine.core.fields import FileField
 from mezzanine.core.managers import DisplayableManager
 from mezzanine.core.models import Displayable, RichText, Orderable
@@ -20,6 +23,8 @@ from mezzanine.pages.models import Page
 from mezzanine.utils.models import AdminThumbMixin, upload_to
 
 from cartridge.shop import fields, managers
+from cartridge.shop.instrumentation import incr, timer
+from cartridge.shop.utils import checkout_state
 
 try:
     from _mysql_exceptions import OperationalError
@@ -38,7 +43,7 @@ class Priced(models.Model):
     """
 
     unit_price = fields.MoneyField(_("Unit price"))
-    sale_id = models.IntegerField(null=True)
+    sale_id = models.IntegerField(null=True, db_index=True)
     sale_price = fields.MoneyField(_("Sale price"))
     sale_from = models.DateTimeField(_("Sale start"), blank=True, null=True)
     sale_to = models.DateTimeField(_("Sale end"), blank=True, null=True)
@@ -272,13 +277,17 @@ class ProductVariation(Priced):
         if self.num_in_stock is None:
             return None
         if not hasattr(self, "_cached_num_in_stock"):
-            num_in_stock = self.num_in_stock
-            items = CartItem.objects.filter(sku=self.sku)
-            aggregate = items.aggregate(quantity_sum=models.Sum("quantity"))
-            num_in_carts = aggregate["quantity_sum"]
-            if num_in_carts is not None:
-                num_in_stock = num_in_stock - num_in_carts
-            self._cached_num_in_stock = num_in_stock
+            with timer("stock.live_num_in_stock"):
+                num_in_stock = self.num_in_stock
+                items = CartItem.objects.filter(sku=self.sku)
+                aggregate = items.aggregate(
+                    quantity_sum=models.Sum("quantity"))
+                num_in_carts = aggregate["quantity_sum"]
+                if num_in_carts is not None:
+                    num_in_stock = num_in_stock - num_in_carts
+                self._cached_num_in_stock = num_in_stock
+        else:
+            incr("stock.live_num_in_stock.cached")
         return self._cached_num_in_stock
 
     def has_stock(self, quantity=1):
@@ -298,11 +307,18 @@ class ProductVariation(Priced):
         this is the default variation.
         """
         if self.num_in_stock is not None:
+            # Stock levels are updated in place rather than saved, so
+            # that concurrent orders don't overwrite each other, and so
+            # that orders don't change the version of the catalogue
+            # used by ``SHOP_CACHEABLE_PAGES``.
+            num_in_stock = F("num_in_stock") + quantity
+            ProductVariation.objects.filter(id=self.id).update(
+                num_in_stock=num_in_stock)
             self.num_in_stock += quantity
-            self.save()
             if self.default:
+                Product.objects.filter(id=self.product_id).update(
+                    num_in_stock=num_in_stock)
                 self.product.num_in_stock = self.num_in_stock
-                self.product.save()
 
 
 class Category(Page, RichText):
@@ -332,6 +348,7 @@ class Category(Page, RichText):
         verbose_name = _("Product category")
         verbose_name_plural = _("Product categories")
 
+    @timer("category.filters")
     def filters(self):
         """
         Returns product filters as a Q object for the category.
@@ -403,7 +420,7 @@ class Order(models.Model):
     additional_instructions = models.TextField(_("Additional instructions"),
                                                blank=True)
     time = models.DateTimeField(_("Time"), auto_now_add=True, null=True)
-    key = CharField(max_length=40)
+    key = CharField(max_length=40, db_index=True)
     user_id = models.IntegerField(blank=True, null=True)
     shipping_type = CharField(_("Shipping type"), max_length=50, blank=True)
     shipping_total = fields.MoneyField(_("Shipping total"))
@@ -414,7 +431,9 @@ class Order(models.Model):
     discount_total = fields.MoneyField(_("Discount total"))
     total = fields.MoneyField(_("Order total"))
     transaction_id = CharField(_("Transaction ID"), max_length=255, null=True,
-                               blank=True)
+                               blank=True, db_index=True)
+    checkout_token = CharField(max_length=32, unique=True, null=True,
+                               blank=True, editable=False)
 
     status = models.IntegerField(_("Status"),
                             choices=settings.SHOP_ORDER_STATUS_CHOICES,
@@ -422,8 +441,9 @@ class Order(models.Model):
 
     objects = managers.OrderManager()
 
-    # These are fields that are stored in the session. They're copied to
-    # the order in setup() and removed from the session in complete().
+    # These are fields that are stored in the session's checkout state.
+    # They're copied to the order in setup() and removed from the
+    # checkout state in complete().
     session_fields = ("shipping_type", "shipping_total", "discount_total",
                       "discount_code", "tax_type", "tax_total")
 
@@ -431,6 +451,9 @@ class Order(models.Model):
         verbose_name = _("Order")
         verbose_name_plural = _("Orders")
         ordering = ("-id",)
+        # Order history for a user, and the admin's filtering by status,
+        # are both listed by time.
+        index_together = (("user_id", "time"), ("status", "time"))
 
     def __unicode__(self):
         return "#%s %s %s" % (self.id, self.billing_name(), self.time)
@@ -448,47 +471,60 @@ class Order(models.Model):
         """
         self.key = request.session.session_key
         self.user_id = request.user.id
+        state = checkout_state(request)
         for field in self.session_fields:
-            if field in request.session:
-                setattr(self, field, request.session[field])
+            if field in state:
+                setattr(self, field, state.get(field))
         self.total = self.item_total = request.cart.total_price()
         if self.shipping_total is not None:
-            self.shipping_total = Decimal(str(self.shipping_total))
             self.total += self.shipping_total
         if self.discount_total is not None:
             self.total -= self.discount_total
         if self.tax_total is not None:
             self.total += self.tax_total
         self.save()  # We need an ID before we can add related items.
+        # Store the product ID and title against each item, so that
+        # the order can be displayed without querying for variations,
+        # and after the products have been changed or deleted.
+        skus = request.cart.skus()
+        variations = ProductVariation.objects.filter(sku__in=skus)
+        variations = variations.values_list("sku", "product_id",
+                                             "product__title")
+        products = dict([(v[0], v[1:]) for v in variations])
+        product_fields = [f.name for f in SelectedProduct._meta.fields]
+        items = []
         for item in request.cart:
-            product_fields = [f.name for f in SelectedProduct._meta.fields]
             item = dict([(f, getattr(item, f)) for f in product_fields])
-            self.items.create(**item)
+            item["product_id"], item["product_title"] = products.get(
+                item["sku"], (None, ""))
+            items.append(OrderItem(order=self, **item))
+        if items:
+            fields = [f for f in OrderItem._meta.local_fields
+                      if not isinstance(f, models.AutoField)]
+            batch_size = connection.ops.bulk_batch_size(fields, items)
+            OrderItem.objects.bulk_create(items, batch_size=batch_size)
 
     def complete(self, request):
         """
         Remove order fields that are stored in the session, reduce the
         stock level for the items in the order, decrement the uses
         remaining count for discount code (if applicable) and then
-        delete the cart.
+        delete the cart. Recording purchases against products is
+        handled separately as one of the tasks in
+        ``cartridge.shop.tasks``.
         """
         self.save()  # Save the transaction ID.
-        for field in self.session_fields:
-            if field in request.session:
-                del request.session[field]
-        try:
-            del request.session["order"]
-        except KeyError:
-            pass
+        state = checkout_state(request)
+        code = state.get("discount_code")
+        state.clear("order", "step", *self.session_fields)
+        skus = request.cart.skus()
+        variations = ProductVariation.objects.filter(sku__in=skus)
+        variations = dict([(v.sku, v) for v in variations])
+        quantities = defaultdict(int)
         for item in request.cart:
-            try:
-                variation = ProductVariation.objects.get(sku=item.sku)
-            except ProductVariation.DoesNotExist:
-                pass
-            else:
-                variation.update_stock(item.quantity * -1)
-                variation.product.actions.purchased()
-        code = request.session.get('discount_code')
+            if item.sku in variations:
+                quantities[variations[item.sku]] -= item.quantity
+        ProductVariation.objects.update_stock_bulk(quantities)
         if code:
             DiscountCode.objects.active().filter(code=code).update(
                 uses_remaining=F('uses_remaining') - 1)
@@ -522,7 +558,8 @@ class Order(models.Model):
 
 class Cart(models.Model):
 
-    last_updated = models.DateTimeField(_("Last updated"), null=True)
+    last_updated = models.DateTimeField(_("Last updated"), null=True,
+                                        db_index=True)
 
     objects = managers.CartManager()
 
@@ -553,6 +590,51 @@ class Cart(models.Model):
         item.quantity += quantity
         item.save()
 
+    def add_items(self, items):
+        """
+        Add each of the ``(variation, quantity)`` pairs given, as
+        ``add_item`` does, with the existing items for each quantity
+        updated together, and the new items created in bulk. The
+        variations should have their products and images selected.
+        """
+        quantities = SortedDict()
+        variations = {}
+        for variation, quantity in items:
+            key = (variation.sku, variation.price())
+            quantities[key] = quantities.get(key, 0) + quantity
+            variations[key] = variation
+        skus = [sku for sku, unit_price in quantities]
+        added = {}
+        for item in self.items.filter(sku__in=skus):
+            quantity = quantities.pop((item.sku, item.unit_price), None)
+            if quantity is not None:
+                added.setdefault(quantity, []).append(item.id)
+        for quantity, ids in added.items():
+            total = F("quantity") + quantity
+            self.items.filter(id__in=ids).update(
+                quantity=total, total_price=F("unit_price") * total)
+        new = []
+        for (sku, unit_price), quantity in quantities.items():
+            variation = variations[(sku, unit_price)]
+            item = CartItem(cart=self, sku=sku, unit_price=unit_price,
+                            quantity=quantity,
+                            total_price=unit_price * quantity,
+                            description=unicode(variation),
+                            url=variation.product.get_absolute_url())
+            if variation.image is not None:
+                item.image = unicode(variation.image.file)
+            new.append(item)
+        if new:
+            fields = [f for f in CartItem._meta.local_fields
+                      if not isinstance(f, models.AutoField)]
+            batch_size = connection.ops.bulk_batch_size(fields, new)
+            CartItem.objects.bulk_create(new, batch_size=batch_size)
+            product_ids = [variations[(item.sku, item.unit_price)].product_id
+                           for item in new]
+            ProductAction.objects.added_to_cart_bulk(product_ids)
+        if hasattr(self, "_cached_items"):
+            del self._cached_items
+
     def has_items(self):
         """
         Template helper function - does the cart have items?
@@ -591,22 +673,12 @@ class Cart(models.Model):
     def calculate_discount(self, discount):
         """
         Calculates the discount based on the items in a cart, some
-        might have the discount, others might not.
-        """
-        # Discount applies to cart total if not product specific.
-        products = discount.all_products()
-        if products.count() == 0:
-            return discount.calculate(self.total_price())
-        total = Decimal("0")
-        # Create a list of skus in the cart that are applicable to
-        # the discount, and total the discount for appllicable items.
-        lookup = {"product__in": products, "sku__in": self.skus()}
-        discount_variations = ProductVariation.objects.filter(**lookup)
-        discount_skus = discount_variations.values_list("sku", flat=True)
-        for item in self:
-            if item.sku in discount_skus:
-                total += discount.calculate(item.unit_price) * item.quantity
-        return total
+        might have the discount, others might not. The SKUs the
+        discount applies to are only resolved from the catalogue when
+        the discount or catalogue changes.
+        """
+        from cartridge.shop.discounts import calculate_discount
+        return calculate_discount(discount, self, self.total_price())
 
 
 class SelectedProduct(models.Model):
@@ -645,15 +717,67 @@ class CartItem(SelectedProduct):
     url = CharField(max_length=200)
     image = CharField(max_length=200, null=True)
 
+    class Meta:
+        # Stock levels total the quantities in carts by SKU.
+        index_together = (("sku", "cart"),)
+
     def get_absolute_url(self):
         return self.url
 
 
+class WishlistItem(models.Model):
+    """
+    A SKU in the wishlist of an authenticated user. The wishlists of
+    anonymous users are stored in the ``wishlist`` cookie, and added
+    to these when they log in.
+    """
+
+    user_id = models.IntegerField()
+    sku = fields.SKUField()
+
+    objects = managers.WishlistItemManager()
+
+    class Meta:
+        verbose_name = _("Wishlist item")
+        verbose_name_plural = _("Wishlist items")
+        unique_together = ("user_id", "sku")
+
+
 class OrderItem(SelectedProduct):
     """
     A selected product in a completed order.
     """
     order = models.ForeignKey("Order", related_name="items")
+    product_id = models.IntegerField(blank=True, null=True)
+    product_title = CharField(_("Product"), max_length=500, blank=True)
+
+
+class OrderTask(models.Model):
+    """
+    A task for a complete order that has been deferred from the
+    checkout process, via the ``SHOP_ORDER_TASKS_DEFERRED`` setting.
+    Run by the ``order_tasks`` management command, with ``run_after``
+    moved forward each time the task is attempted, so that it isn't
+    picked up by other workers, and failed tasks are retried with an
+    increasing delay.
+    """
+
+    order = models.ForeignKey("Order", related_name="tasks")
+    name = CharField(_("Name"), max_length=50)
+    run_after = models.DateTimeField(_("Run after"))
+    attempts = models.IntegerField(_("Attempts"), default=0)
+    completed = models.BooleanField(_("Completed"), default=False)
+    error = models.TextField(_("Error"), blank=True)
+
+    objects = managers.OrderTaskManager()
+
+    class Meta:
+        verbose_name = _("Order task")
+        verbose_name_plural = _("Order tasks")
+        ordering = ("run_after",)
+
+    def __unicode__(self):
+        return "%s #%s" % (self.name, self.order_id)
 
 
 class ProductAction(models.Model):
@@ -721,67 +845,145 @@ class Sale(Discount):
     selected categories and products for the sale.
     """
 
+    # Fields that determine the sale prices of the products the sale
+    # is applied to.
+    price_fields = ("active", "discount_deduct", "discount_percent",
+                    "discount_exact", "valid_from", "valid_to")
+
+    # Number of products added to or removed from the sale that are
+    # updated per query by ``sync_products``.
+    sync_chunk_size = 500
+
     class Meta:
         verbose_name = _("Sale")
         verbose_name_plural = _("Sales")
 
     def save(self, *args, **kwargs):
+        """
+        Reapply the sale to all of its products when it's first saved,
+        or when any of the fields that determine its sale prices have
+        changed. Changes to the products and categories for the sale
+        are applied by the ``sale_update_products`` signal.
+        """
+        changed = True
+        if self.id is not None:
+            saved = Sale.objects.filter(id=self.id).values(*self.price_fields)
+            for fields in saved:
+                changed = any([getattr(self, f) != fields[f]
+                               for f in self.price_fields])
         super(Sale, self).save(*args, **kwargs)
-        self.update_products()
+        if changed:
+            self.update_products()
 
     def update_products(self):
         """
         Apply sales field value to products and variations according
-        to the selected categories and products for the sale.
+        to the selected categories and products for the sale. This
+        clears and rewrites every product for the sale, and is only
+        needed when the sale's prices change, or to rebuild the sale
+        prices with the ``apply_sales`` management command, since
+        ``sync_products`` handles changes to the products in the sale.
         """
         self._clear()
         if self.active:
-            extra_filter = {}
-            if self.discount_deduct is not None:
-                # Don't apply to prices that would be negative
-                # after deduction.
-                extra_filter["unit_price__gt"] = self.discount_deduct
-                sale_price = models.F("unit_price") - self.discount_deduct
-            elif self.discount_percent is not None:
-                sale_price = models.F("unit_price") - (
-                    models.F("unit_price") / "100.0" * self.discount_percent)
-            elif self.discount_exact is not None:
-                # Don't apply to prices that are cheaper than the sale
-                # amount.
-                extra_filter["unit_price__gt"] = self.discount_exact
-                sale_price = self.discount_exact
-            else:
-                return
-            products = self.all_products()
-            variations = ProductVariation.objects.filter(product__in=products)
-            for priced_objects in (products, variations):
-                # MySQL will raise a 'Data truncated' warning here in
-                # some scenarios, presumably when doing a calculation
-                # that exceeds the precision of the price column. In
-                # this case it's safe to ignore it and the calculation
-                # will still be applied.
-                try:
-                    update = {"sale_id": self.id,
-                              "sale_price": sale_price,
-                              "sale_to": self.valid_to,
-                              "sale_from": self.valid_from}
-                    priced_objects.filter(**extra_filter).update(**update)
-                except (OperationalError, DatabaseError):
-                    # Work around for MySQL which does not allow update
-                    # to operate on subquery where the FROM clause would
-                    # have it operate on the same table.
-                    #
-                    # http://dev.mysql.com/
-                    # doc/refman/5.0/en/subquery-errors.html
-                    for priced in priced_objects.filter(**extra_filter):
-                        for field, value in update.items():
-                            setattr(priced, field, value)
-                        try:
-                            priced.save()
-                        except Warning:
-                            pass
-                except Warning:
-                    pass
+            self._apply(self.all_products())
+        self._sale_prices_changed()
+
+    def sync_products(self):
+        """
+        Apply the sale to the products that are now in the sale, and
+        clear it from those that no longer are, without touching the
+        products it's already applied to.
+        """
+        if not self.active:
+            self._clear()
+            self._sale_prices_changed()
+            return
+        product_ids = set(self.all_products().values_list("id", flat=True))
+        applied = Product.objects.filter(sale_id=self.id)
+        variations = ProductVariation.objects.filter(sale_id=self.id)
+        applied = set(applied.values_list("id", flat=True))
+        applied.update(variations.values_list("product_id", flat=True))
+        removed = list(applied - product_ids)
+        added = list(product_ids - applied)
+        size = self.sync_chunk_size
+        for i in range(0, len(removed), size):
+            self._clear(removed[i:i + size])
+        for i in range(0, len(added), size):
+            self._apply(Product.objects.filter(id__in=added[i:i + size]))
+        if removed or added:
+            self._sale_prices_changed()
+
+    def reapply(self, product_ids):
+        """
+        Reapply the sale to the given products after their prices have
+        changed, such as from a price feed, without touching the other
+        products in the sale. The sale is cleared from the products
+        and applied again to those still in it, so that variations
+        whose prices no longer pass the sale's price filter lose their
+        sale prices, and those that now pass it, or products that are
+        now selected by the price filters of its categories, get them.
+        """
+        product_ids = list(product_ids)
+        size = self.sync_chunk_size
+        for i in range(0, len(product_ids), size):
+            ids = product_ids[i:i + size]
+            self._clear(ids)
+            if self.active:
+                self._apply(self.all_products().filter(id__in=ids))
+        if product_ids:
+            self._sale_prices_changed()
+
+    def _apply(self, products):
+        """
+        Apply the sales field values to the given products and their
+        variations.
+        """
+        extra_filter = {}
+        if self.discount_deduct is not None:
+            # Don't apply to prices that would be negative
+            # after deduction.
+            extra_filter["unit_price__gt"] = self.discount_deduct
+            sale_price = models.F("unit_price") - self.discount_deduct
+        elif self.discount_percent is not None:
+            sale_price = models.F("unit_price") - (
+                models.F("unit_price") / "100.0" * self.discount_percent)
+        elif self.discount_exact is not None:
+            # Don't apply to prices that are cheaper than the sale
+            # amount.
+            extra_filter["unit_price__gt"] = self.discount_exact
+            sale_price = self.discount_exact
+        else:
+            return
+        variations = ProductVariation.objects.filter(product__in=products)
+        for priced_objects in (products, variations):
+            # MySQL will raise a 'Data truncated' warning here in
+            # some scenarios, presumably when doing a calculation
+            # that exceeds the precision of the price column. In
+            # this case it's safe to ignore it and the calculation
+            # will still be applied.
+            try:
+                update = {"sale_id": self.id,
+                          "sale_price": sale_price,
+                          "sale_to": self.valid_to,
+                          "sale_from": self.valid_from}
+                priced_objects.filter(**extra_filter).update(**update)
+            except (OperationalError, DatabaseError):
+                # Work around for MySQL which does not allow update
+                # to operate on subquery where the FROM clause would
+                # have it operate on the same table.
+                #
+                # http://dev.mysql.com/
+                # doc/refman/5.0/en/subquery-errors.html
+                for priced in priced_objects.filter(**extra_filter):
+                    for field, value in update.items():
+                        setattr(priced, field, value)
+                    try:
+                        priced.save()
+                    except Warning:
+                        pass
+            except Warning:
+                pass
 
     def delete(self, *args, **kwargs):
         """
@@ -790,25 +992,51 @@ class Sale(Discount):
         self._clear()
         super(Sale, self).delete(*args, **kwargs)
 
-    def _clear(self):
+    def _sale_prices_changed(self):
+        """
+        Discard the SKUs resolved for discounts, since categories can
+        select products by their sale and sale prices, and change the
+        version of the catalogue for cacheable pages.
+        """
+        from cartridge.shop import cacheable, discounts
+        discounts.invalidate()
+        cacheable.changed()
+
+    def _clear(self, product_ids=None):
         """
         Clears previously applied sale field values from products prior
-        to updating the sale, when deactivating it or deleting it.
+        to updating the sale, when deactivating it or deleting it, or
+        from the given products when they're removed from the sale.
         """
         update = {"sale_id": None, "sale_price": None,
                   "sale_from": None, "sale_to": None}
-        for priced_model in (Product, ProductVariation):
-            priced_model.objects.filter(sale_id=self.id).update(**update)
+        products = Product.objects.filter(sale_id=self.id)
+        variations = ProductVariation.objects.filter(sale_id=self.id)
+        if product_ids is not None:
+            products = products.filter(id__in=product_ids)
+            variations = variations.filter(product__in=product_ids)
+        for priced_objects in (products, variations):
+            priced_objects.update(**update)
 
 
+@receiver(m2m_changed, sender=Sale.categories.through)
 @receiver(m2m_changed, sender=Sale.products.through)
 def sale_update_products(sender, instance, action, *args, **kwargs):
     """
-    Signal for updating products for the sale - needed since the
-    products won't be assigned to the sale when it is first saved.
+    Signal for applying the sale to products added to it, directly or
+    via its categories, and clearing it from products removed - needed
+    since the products won't be assigned to the sale when it is first
+    saved. Clearing the products or categories is ignored, since the
+    admin clears them before adding those selected, and
+    ``SaleAdmin`` syncs the sale once they've been saved.
     """
-    if action == "post_add":
-        instance.update_products()
+    if action in ("post_add", "post_remove"):
+        if kwargs.get("reverse"):
+            sales = Sale.objects.filter(id__in=kwargs.get("pk_set") or [])
+        else:
+            sales = [instance]
+        for sale in sales:
+            sale.sync_products()
 
 
 class DiscountCode(Discount):
@@ -843,3 +1071,229 @@ class DiscountCode(Discount):
     class Meta:
         verbose_name = _("Discount code")
         verbose_name_plural = _("Discount codes")
+        index_together = (("active", "valid_from", "valid_to"),)
+
+
+class ShippingZone(models.Model):
+    """
+    A region that shipping and tax rates apply to, given by a list of
+    countries and optionally ranges of postcodes. When an address is
+    within several zones, the most specific is used, with zones that
+    have postcode ranges first, then zones with countries, and then
+    zones for everywhere. Rates are looked up from an index built by
+    ``cartridge.shop.rates``, rather than queried at checkout.
+    """
+
+    title = CharField(_("Title"), max_length=100)
+    countries = models.TextField(_("Countries"), blank=True,
+        help_text=_("Names or codes of countries as entered at checkout, "
+                    "separated by commas or lines. Leave blank for all "
+                    "countries."))
+
+    class Meta:
+        verbose_name = _("Shipping zone")
+        verbose_name_plural = _("Shipping zones")
+        ordering = ("id",)
+
+    def __unicode__(self):
+        return self.title
+
+    def country_list(self):
+        """
+        Returns the zone's countries, normalised for matching.
+        """
+        countries = self.countries.replace("\n", ",").split(",")
+        return [c.strip().lower() for c in countries if c.strip()]
+
+
+class ShippingPostcodeRange(models.Model):
+    """
+    A range of postcodes within a shipping zone.
+    """
+
+    zone = models.ForeignKey("ShippingZone", related_name="postcodes")
+    start = CharField(_("From"), max_length=10)
+    end = CharField(_("To"), max_length=10, blank=True,
+                    help_text=_("Leave blank for a single postcode."))
+
+    class Meta:
+        verbose_name = _("Postcode range")
+        verbose_name_plural = _("Postcode ranges")
+
+    def __unicode__(self):
+        if self.end:
+            return "%s - %s" % (self.start, self.end)
+        return self.start
+
+
+class ShippingRate(models.Model):
+    """
+    An amount charged for shipping to a zone, for orders within a
+    range of totals and item quantities. When several rates apply to
+    an order, the cheapest is used.
+    """
+
+    zone = models.ForeignKey("ShippingZone", related_name="shipping_rates")
+    title = CharField(_("Title"), max_length=100)
+    amount = fields.MoneyField(_("Amount"))
+    min_total = fields.MoneyField(_("Minimum total"))
+    max_total = fields.MoneyField(_("Maximum total"),
+        help_text=_("Applies to totals less than this amount."))
+    min_quantity = models.IntegerField(_("Minimum quantity"), blank=True,
+                                       null=True)
+    max_quantity = models.IntegerField(_("Maximum quantity"), blank=True,
+                                       null=True)
+
+    class Meta:
+        verbose_name = _("Shipping rate")
+        verbose_name_plural = _("Shipping rates")
+
+    def __unicode__(self):
+        return self.title
+
+    def applies_to(self, total, quantity):
+        """
+        Returns whether the rate applies to an order with the given
+        item total and quantity.
+        """
+        return ((self.min_total is None or total >= self.min_total) and
+                (self.max_total is None or total < self.max_total) and
+                (self.min_quantity is None or quantity >= self.min_quantity)
+                and (self.max_quantity is None or
+                     quantity <= self.max_quantity))
+
+
+class TaxRate(models.Model):
+    """
+    A percentage of the order charged as tax, either for a shipping
+    zone, or for addresses within zones without their own tax rates
+    when no zone is given. Each of the rates that apply is charged.
+    """
+
+    zone = models.ForeignKey("ShippingZone", related_name="tax_rates",
+                             blank=True, null=True)
+    title = CharField(_("Title"), max_length=100)
+    rate = fields.PercentageField(_("Rate"), max_digits=5, decimal_places=2)
+    includes_shipping = models.BooleanField(_("Applies to shipping"))
+
+    class Meta:
+        verbose_name = _("Tax rate")
+        verbose_name_plural = _("Tax rates")
+        ordering = ("id",)
+
+    def __unicode__(self):
+        return self.title
+
+
+def rates_changed(sender, **kwargs):
+    """
+    Rebuild the index of shipping and tax rates when they're changed.
+    """
+    from cartridge.shop.rates import invalidate_index
+    invalidate_index()
+
+for model in (ShippingZone, ShippingPostcodeRange, ShippingRate, TaxRate):
+    post_save.connect(rates_changed, sender=model)
+    post_delete.connect(rates_changed, sender=model)
+
+
+def discounts_changed(sender, **kwargs):
+    """
+    Discard the SKUs resolved for discounts when the discounts, or
+    the products and categories they select, are changed. Categories
+    select variations by their options, prices and sales, so changes
+    to variations that only save other fields, such as the number in
+    stock, are skipped.
+    """
+    update_fields = kwargs.get("update_fields")
+    if sender is ProductVariation and update_fields:
+        selected = [f.name for f in ProductVariation.option_fields()]
+        selected += ["sku", "unit_price", "sale_id", "sale_price",
+                     "sale_from", "sale_to", "product"]
+        if not set(selected) & set(update_fields):
+            return
+    from cartridge.shop.discounts import invalidate
+    invalidate()
+
+for model in (DiscountCode, Category, ProductVariation):
+    post_save.connect(discounts_changed, sender=model)
+    post_delete.connect(discounts_changed, sender=model)
+for model in (DiscountCode.products.through, DiscountCode.categories.through,
+              Category.products.through, Category.options.through):
+    m2m_changed.connect(discounts_changed, sender=model)
+
+
+def editable_changed(sender, **kwargs):
+    """
+    Take a new snapshot of the editable settings when they're changed.
+    """
+    from cartridge.shop.editable import invalidate
+    invalidate()
+
+post_save.connect(editable_changed, sender=Setting)
+post_delete.connect(editable_changed, sender=Setting)
+
+
+def catalogue_changed(sender, instance=None, **kwargs):
+    """
+    Change the version of the catalogue used by
+    ``SHOP_CACHEABLE_PAGES`` when products, pages or settings are
+    changed, once the response is ready if this is during a request.
+    Any model can be the sender, since pages are subclassed.
+    """
+    models = (Page, Product, ProductVariation, ProductImage, ProductOption,
+              Setting)
+    if isinstance(instance, models):
+        from cartridge.shop.cacheable import changed
+        changed()
+
+post_save.connect(catalogue_changed)
+post_delete.connect(catalogue_changed)
+for model in (Product.categories.through, Product.related_products.through,
+              Product.upsell_products.through, Category.options.through):
+    m2m_changed.connect(catalogue_changed, sender=model)
+
+
+def search_changed(sender, instance=None, **kwargs):
+    """
+    Mark products to be indexed again for product search when they,
+    their variations, or the categories they're in are changed.
+    Deleting a category removes it from its products without sending
+    any signals for them, so all of the products are marked.
+    """
+    if not settings.SHOP_SEARCH_INDEX_DIR:
+        return
+    from cartridge.shop.search import changed
+    if isinstance(instance, Product):
+        changed([instance.id])
+    elif isinstance(instance, ProductVariation):
+        changed([instance.product_id])
+    elif kwargs.get("signal") is post_delete:
+        changed()
+    else:
+        changed(instance.product_set.values_list("id", flat=True))
+
+for model in (Product, ProductVariation, Category):
+    post_save.connect(search_changed, sender=model)
+    post_delete.connect(search_changed, sender=model)
+
+
+def search_categories_changed(sender, instance=None, action=None,
+                              reverse=False, pk_set=None, **kwargs):
+    """
+    Mark products to be indexed again for product search when they're
+    added to or removed from categories.
+    """
+    if (not settings.SHOP_SEARCH_INDEX_DIR or
+            action not in ("post_add", "post_remove", "post_clear")):
+        return
+    from cartridge.shop.search import changed
+    if not reverse:
+        changed([instance.id])
+    elif pk_set is not None:
+        changed(pk_set)
+    else:
+        changed()
+
+m2m_changed.connect(search_categories_changed,
+                    sender=Product.categories.through)
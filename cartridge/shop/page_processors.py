@@ -5,6 +5,8 @@ from mezzanine.conf import settings
 from mezzanine.pages.page_processors import processor_for
 from mezzanine.utils.views import paginate
 
+from cartridge.shop.cacheable import conditional_response
+from cartridge.shop.editable import use_editable
 from cartridge.shop.models import Category, Product
 
 
@@ -13,7 +15,10 @@ def category_processor(request, page):
     """
     Add paging/sorting to the products for the category.
     """
-    settings.use_editable()
+    not_modified = conditional_response(request)
+    if not_modified is not None:
+        return not_modified
+    use_editable(request)
     products = Product.objects.published(for_user=request.user
                                 ).filter(page.category.filters()).distinct()
     sort_options = [(slugify(option[0]), option[1])
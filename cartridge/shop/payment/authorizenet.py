@@ -1,10 +1,9 @@
-import urllib2
-
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.http import urlencode
 from mezzanine.conf import settings
 
 from cartridge.shop.checkout import CheckoutError
+from cartridge.shop.payment import transport
 
 
 AUTH_NET_LIVE = 'https://secure.authorize.net/gateway/transact.dll'
@@ -82,13 +81,11 @@ def process(request, order_form, order):
     trans['postString'] = (part1 + urlencode(trans['transactionData']) +
                            part2 + part3)
 
-    conn = urllib2.Request(url=trans['connection'], data=trans['postString'])
     # useful for debugging transactions
     #print trans['postString']
     try:
-        f = urllib2.urlopen(conn)
-        all_results = f.read()
-    except urllib2.URLError:
+        all_results = transport.post(trans['connection'], trans['postString'])
+    except transport.TransportError:
         raise CheckoutError("Could not talk to authorize.net payment gateway")
 
     parsed_results = all_results.split(trans['configuration']['x_delim_char'])
@@ -1,4 +1,3 @@
-import urllib2
 import locale
 
 from django.core.exceptions import ImproperlyConfigured
@@ -7,6 +6,7 @@ from django.utils.http import urlencode
 from mezzanine.conf import settings
 
 from cartridge.shop.checkout import CheckoutError
+from cartridge.shop.payment import transport
 
 
 PAYPAL_NVP_API_ENDPOINT_SANDBOX = 'https://api-3t.sandbox.paypal.com/nvp'
@@ -111,13 +111,11 @@ def process(request, order_form, order):
     part3 = "&" + urlencode(trans['custShipData'])
     trans['postString'] = (part1 + urlencode(trans['transactionData']) +
                            part2 + part3)
-    conn = urllib2.Request(url=trans['connection'], data=trans['postString'])
     # useful for debugging transactions
     # print trans['postString']
     try:
-        f = urllib2.urlopen(conn)
-        all_results = f.read()
-    except urllib2.URLError:
+        all_results = transport.post(trans['connection'], trans['postString'])
+    except transport.TransportError:
         raise CheckoutError("Could not talk to PayPal payment gateway")
     parsed_results = QueryDict(all_results)
     state = parsed_results['ACK']
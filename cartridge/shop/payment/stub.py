@@ -0,0 +1,107 @@
+"""
+A local HTTP server standing in for a payment gateway, for testing
+the payment modules and the transport in
+``cartridge.shop.payment.transport`` without network access. It
+supports keep-alive connections, responds with a configured sequence
+of status codes and bodies, can delay each response, can drop each
+connection after responding, and records the requests it receives.
+It can also be run directly for manual testing::
+
+    $ python -m cartridge.shop.payment.stub 8001
+"""
+
+import sys
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+from time import sleep
+
+
+# Default response, which the PayPal module treats as a successful
+# payment.
+DEFAULT_RESPONSE = (200, "ACK=Success&TRANSACTIONID=STUB")
+
+
+class StubGatewayHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else ""
+        self.server.requests.append({
+            "client": self.client_address,
+            "method": self.command,
+            "path": self.path,
+            "body": body,
+        })
+        if self.server.delay:
+            sleep(self.server.delay)
+        if self.server.responses:
+            status, data = self.server.responses.pop(0)
+        else:
+            status, data = self.server.default_response
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        if self.server.drop_connections:
+            # Close the connection without telling the client, as
+            # gateways do with keep-alive connections left idle.
+            self.close_connection = 1
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class StubGatewayServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded server bound to localhost. ``responses`` is a list of
+    ``(status, body)`` pairs used in turn for each request, after
+    which ``default_response`` is used. With ``drop_connections``,
+    each connection is closed once a response has been sent on it.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, responses=None, delay=0,
+                 default_response=DEFAULT_RESPONSE, drop_connections=False):
+        HTTPServer.__init__(self, ("127.0.0.1", port), StubGatewayHandler)
+        self.responses = list(responses or [])
+        self.default_response = default_response
+        self.delay = delay
+        self.drop_connections = drop_connections
+        self.requests = []
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%s/" % self.server_address[1]
+
+    def start(self):
+        """
+        Serve requests in a background thread.
+        """
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        """
+        Ignore clients disconnecting, such as after timing out.
+        """
+        pass
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8001
+    server = StubGatewayServer(port=port)
+    print "Stub payment gateway running at %s" % server.url
+    server.serve_forever()
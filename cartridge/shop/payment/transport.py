@@ -0,0 +1,283 @@
+"""
+HTTP transport shared by the payment gateway modules. Each gateway
+host gets a ``Transport`` instance via ``get_transport``, which keeps
+a small pool of keep-alive connections to the host, applies connect
+and read timeouts, retries failed requests when it's safe to do so,
+and stops calling a gateway for a period once it has failed several
+times in a row.
+
+Requests that aren't idempotent (such as a payment) are only retried
+when they were never sent, that is when the connection to the gateway
+couldn't be established, or when a connection reused from the pool
+failed while the request was being written to it, since the gateway
+has most likely closed it while it was idle. Pooled connections the
+gateway has already closed are discarded before they're used. Once a
+request has been sent, a failure while waiting for the response is
+raised, since the gateway may have processed the request.
+"""
+
+import httplib
+import socket
+from select import select
+from threading import Lock
+from time import time
+from urlparse import urlsplit
+
+from mezzanine.conf import settings
+
+from cartridge.shop.instrumentation import incr, timer
+
+
+class TransportError(Exception):
+    """
+    Raised when a request to a gateway fails, or the gateway responds
+    with an error status.
+    """
+    pass
+
+
+class CircuitOpenError(TransportError):
+    """
+    Raised without contacting the gateway when it has recently failed
+    ``SHOP_PAYMENT_CIRCUIT_FAILURES`` times in a row.
+    """
+    pass
+
+
+class Transport(object):
+    """
+    Pool of connections to a single gateway host, along with the
+    state of its circuit breaker.
+    """
+
+    def __init__(self, url, connect_timeout=None, read_timeout=None,
+                 max_idle=None, idle_timeout=None, retries=None,
+                 circuit_failures=None, circuit_reset=None):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+
+        def option(value, name):
+            # Fall back to the setting if no value is given.
+            return getattr(settings, name) if value is None else value
+
+        self.connect_timeout = option(connect_timeout,
+                                      "SHOP_PAYMENT_CONNECT_TIMEOUT")
+        self.read_timeout = option(read_timeout, "SHOP_PAYMENT_READ_TIMEOUT")
+        self.max_idle = option(max_idle, "SHOP_PAYMENT_MAX_IDLE")
+        self.idle_timeout = option(idle_timeout, "SHOP_PAYMENT_IDLE_TIMEOUT")
+        self.retries = option(retries, "SHOP_PAYMENT_RETRIES")
+        self.circuit_failures = option(circuit_failures,
+                                       "SHOP_PAYMENT_CIRCUIT_FAILURES")
+        self.circuit_reset = option(circuit_reset,
+                                    "SHOP_PAYMENT_CIRCUIT_RESET")
+        self._idle = []
+        self._failures = 0
+        self._open_until = 0
+        self._lock = Lock()
+
+    def _connect(self):
+        """
+        Open a new connection, with the read timeout applied to the
+        socket once connected.
+        """
+        if self.scheme == "https":
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        connection = connection_class(self.host, self.port,
+                                      timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+    def _acquire(self):
+        """
+        Return an idle connection from the pool, discarding any that
+        have been idle for too long, or a new connection if there are
+        none, along with whether the connection was reused.
+        """
+        n = time()
+        with self._lock:
+            while self._idle:
+                connection, released = self._idle.pop()
+                if (n - released < self.idle_timeout and
+                    not self._dropped(connection)):
+                    return connection, True
+                connection.close()
+        return self._connect(), False
+
+    def _dropped(self, connection):
+        """
+        Return whether an idle connection has been closed by the
+        gateway. An idle connection shouldn't have anything to read,
+        so if it's readable, it's either at EOF or out of sync.
+        """
+        if connection.sock is None:
+            return True
+        try:
+            return bool(select([connection.sock], [], [], 0)[0])
+        except (socket.error, ValueError):
+            return True
+
+    def _release(self, connection):
+        """
+        Return the connection to the pool if there's room for it.
+        """
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((connection, time()))
+                return
+        connection.close()
+
+    def _check_circuit(self):
+        """
+        Raise ``CircuitOpenError`` if the gateway is being skipped.
+        Once the reset period is over, requests are let through again,
+        and the circuit opens again on the next failure.
+        """
+        with self._lock:
+            if self._open_until > time():
+                raise CircuitOpenError("%s is unavailable" % self.host)
+
+    def _record(self, success):
+        """
+        Track consecutive failures, opening the circuit when there
+        are too many.
+        """
+        with self._lock:
+            if success:
+                self._failures = 0
+                self._open_until = 0
+            else:
+                self._failures += 1
+                if self._failures >= self.circuit_failures:
+                    self._open_until = time() + self.circuit_reset
+
+    def _send(self, method, path, body, headers, idempotent=False,
+              new=False):
+        """
+        Make a single request, returning the response body. Raises
+        ``TransportError`` with a ``sent`` attribute indicating
+        whether the request may have reached the gateway.
+
+        If a connection reused from the pool fails while the request
+        is being written, or for idempotent requests, before the
+        status line of the response is read, other than by timing
+        out, the gateway has closed it, so the request is made once
+        more on a new connection.
+        """
+        try:
+            if new:
+                connection, reused = self._connect(), False
+            else:
+                connection, reused = self._acquire()
+        except (socket.error, httplib.HTTPException), e:
+            error = TransportError("Could not connect to %s: %s" %
+                                   (self.host, e))
+            error.sent = False
+            raise error
+        sent = False
+        response = None
+        try:
+            connection.request(method, path, body, headers)
+            sent = True
+            response = connection.getresponse()
+            data = response.read()
+        except (socket.error, httplib.HTTPException), e:
+            connection.close()
+            stale = (reused and response is None and
+                     (idempotent or not sent) and
+                     not isinstance(e, socket.timeout))
+            if stale:
+                incr("payment.stale_connections")
+                return self._send(method, path, body, headers,
+                                  idempotent, new=True)
+            error = TransportError("Request to %s failed: %s" %
+                                   (self.host, e))
+            error.sent = True
+            raise error
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+        if response.status >= 400:
+            error = TransportError("%s responded with status %s" %
+                                   (self.host, response.status))
+            error.sent = True
+            error.status = response.status
+            raise error
+        return data
+
+    def request(self, method, path, body=None, headers=None,
+                idempotent=False):
+        """
+        Make a request to the gateway and return the response body,
+        retrying up to ``retries`` times, if the request is idempotent
+        or the failure occurred before it was sent. Client errors
+        aren't retried, and since the gateway is still responding,
+        they don't count towards opening the circuit.
+        """
+        self._check_circuit()
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                with timer("payment.request"):
+                    data = self._send(method, path, body, headers or {},
+                                      idempotent)
+            except TransportError, e:
+                incr("payment.errors")
+                client_error = 400 <= getattr(e, "status", 0) < 500
+                if (client_error or attempts > self.retries or
+                    (e.sent and not idempotent)):
+                    self._record(client_error)
+                    raise
+            else:
+                self._record(True)
+                return data
+
+    def post(self, path, data):
+        """
+        Post form encoded data, as used by the gateways for payments.
+        """
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        return self.request("POST", path, data, headers)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            for connection, released in self._idle:
+                connection.close()
+            self._idle = []
+
+
+_transports = {}
+_transports_lock = Lock()
+
+
+def get_transport(url):
+    """
+    Return the shared ``Transport`` for the host of the given URL.
+    """
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    with _transports_lock:
+        if key not in _transports:
+            _transports[key] = Transport(url)
+        return _transports[key]
+
+
+def post(url, data):
+    """
+    Post form encoded data to the given URL using its host's shared
+    transport, returning the response body.
+    """
+    parts = urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    return get_transport(url).post(path, data)
@@ -0,0 +1,255 @@
+"""
+Bulk updates of variation prices and stock from a feed, such as one
+exported nightly from a stock control system. Each row of the feed is
+a SKU along with any of the ``unit_price``, ``num_in_stock``,
+``sale_price``, ``sale_from`` and ``sale_to`` fields, given as the
+columns of a CSV file, or the keys of each JSON object in a file with
+one object per line (JSONL). Fields that aren't given for a row are
+left unchanged, and empty values are stored as nulls.
+
+Rather than saving each variation and then each product, the rows are
+applied in chunks with a single update statement per chunk, and the
+denormalised ``Priced`` fields on each product are then copied from
+its default variation with a single update statement per chunk of
+products. Active sales are then reapplied to just the products whose
+unit prices changed, so that their sale prices follow, and variations
+that now pass or fail a sale's price filter gain or lose the sale.
+Used by the ``price_feed`` management command.
+"""
+
+import csv
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection, transaction
+from django.db.models import AutoField
+from django.utils import simplejson
+from django.utils.dateparse import parse_datetime
+from django.utils.datastructures import SortedDict
+from django.utils.timezone import get_current_timezone, is_naive
+from django.utils.timezone import make_aware
+from django.utils.translation import ugettext as _
+
+from mezzanine.conf import settings
+
+from cartridge.shop import cacheable, discounts
+from cartridge.shop.models import Priced, Product, ProductVariation, Sale
+
+
+# Number of rows applied per update statement, further limited to the
+# number of query parameters the database backend supports.
+CHUNK_SIZE = 1000
+
+FORMATS = ("csv", "jsonl")
+
+
+class FeedError(Exception):
+    """
+    Raised when a row of a feed can't be read.
+    """
+    pass
+
+
+def parse_decimal(value):
+    return Decimal(str(value))
+
+
+def parse_int(value):
+    return int(value)
+
+
+def parse_date(value):
+    date = parse_datetime(value)
+    if date is None:
+        raise ValueError(value)
+    if settings.USE_TZ and is_naive(date):
+        date = make_aware(date, get_current_timezone())
+    return date
+
+
+FIELDS = SortedDict((
+    ("unit_price", parse_decimal),
+    ("num_in_stock", parse_int),
+    ("sale_price", parse_decimal),
+    ("sale_from", parse_date),
+    ("sale_to", parse_date),
+))
+
+
+def parse_row(row, line):
+    """
+    Returns the SKU and the dict of fields to update for a row read
+    from the feed, with each value converted to its field's type.
+    """
+    sku = unicode(row.get("sku") or "").strip()
+    if not sku:
+        raise FeedError(_("Line %s: no SKU given") % line)
+    fields = {}
+    for name, parse in FIELDS.items():
+        if name not in row:
+            continue
+        value = row[name]
+        if isinstance(value, basestring):
+            value = value.strip()
+        if value is None or value == "":
+            fields[name] = None
+            continue
+        try:
+            fields[name] = parse(value)
+        except (ValueError, TypeError, InvalidOperation):
+            raise FeedError(_("Line %(line)s: invalid %(field)s: %(value)s")
+                            % {"line": line, "field": name, "value": value})
+    return sku, fields
+
+
+def read_feed(f, format):
+    """
+    Yields the SKU and the fields to update for each row of the feed
+    in the given file, in the given format.
+    """
+    if format not in FORMATS:
+        raise FeedError(_("Unknown format: %s") % format)
+    if format == "csv":
+        for i, row in enumerate(csv.DictReader(f)):
+            row = dict([(name, value.decode("utf-8"))
+                        for name, value in row.items() if value is not None])
+            yield parse_row(row, i + 2)
+    else:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                row = simplejson.loads(line)
+            except ValueError:
+                raise FeedError(_("Line %s: invalid JSON") % (i + 1))
+            if not isinstance(row, dict):
+                raise FeedError(_("Line %s: not an object") % (i + 1))
+            yield parse_row(row, i + 1)
+
+
+def chunks(items, size):
+    """
+    Yields lists of up to the given number of items.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def quote(name):
+    return connection.ops.quote_name(name)
+
+
+def update_variations(rows):
+    """
+    Updates the variations for the SKUs and fields in the dict of
+    rows, with each field set by a ``CASE`` on the SKU. Returns the
+    variations updated as ``(sku, product_id, sale_id)`` tuples.
+    """
+    meta = ProductVariation._meta
+    variations = ProductVariation.objects.filter(sku__in=rows.keys())
+    variations = list(variations.values_list("sku", "product_id",
+                                             "sale_id"))
+    if not variations:
+        return []
+    skus = [sku for sku, product_id, sale_id in variations]
+    sku_column = quote(meta.get_field("sku").column)
+    assignments = []
+    params = []
+    for name in FIELDS:
+        field = meta.get_field(name)
+        column = quote(field.column)
+        cases = []
+        for sku in skus:
+            if name in rows[sku]:
+                cases.append("WHEN %s THEN %s")
+                value = field.get_db_prep_save(rows[sku][name],
+                                               connection=connection)
+                params.extend([sku, value])
+        if cases:
+            assignments.append("%s = CASE %s %s ELSE %s END" % (
+                column, sku_column, " ".join(cases), column))
+    if assignments:
+        sql = "UPDATE %s SET %s WHERE %s IN (%s)" % (
+            quote(meta.db_table), ", ".join(assignments), sku_column,
+            ", ".join(["%s"] * len(skus)))
+        connection.cursor().execute(sql, params + skus)
+    return variations
+
+
+def sync_products(product_ids):
+    """
+    Copies the ``Priced`` fields from the default variation of each
+    of the given products to the product, as
+    ``Priced.copy_price_fields_to`` does, with a correlated subquery
+    for each field.
+    """
+    variation_meta = ProductVariation._meta
+    variation_table = quote(variation_meta.db_table)
+    product_table = quote(Product._meta.db_table)
+    product_id = quote(Product._meta.pk.column)
+    default = "%s.%s = %s.%s AND %s.%s = %%s" % (
+        variation_table, quote(variation_meta.get_field("product").column),
+        product_table, product_id, variation_table,
+        quote(variation_meta.get_field("default").column))
+    assignments = []
+    params = []
+    for field in Priced._meta.fields:
+        if not isinstance(field, AutoField):
+            assignments.append("%s = (SELECT %s.%s FROM %s WHERE %s)" % (
+                quote(field.column), variation_table, quote(field.column),
+                variation_table, default))
+            params.append(True)
+    size = connection.ops.bulk_batch_size(["id"] * (len(params) + 1),
+                                          [None] * CHUNK_SIZE)
+    for ids in chunks(product_ids, min(size, CHUNK_SIZE)):
+        sql = "UPDATE %s SET %s WHERE %s IN (%s) AND EXISTS (SELECT 1 " \
+              "FROM %s WHERE %s)" % (product_table, ", ".join(assignments),
+                                     product_id, ", ".join(["%s"] * len(ids)),
+                                     variation_table, default)
+        connection.cursor().execute(sql, params + ids + [True])
+
+
+@transaction.commit_on_success
+def apply_feed(rows, chunk_size=CHUNK_SIZE):
+    """
+    Applies the ``(sku, fields)`` rows given, such as those read by
+    ``read_feed``, in a single transaction. Returns a dict of the
+    number of variations updated, the number of products synced, and
+    the SKUs that weren't found.
+    """
+    # Each row uses up to two parameters for each field, plus one
+    # for the SKU.
+    size = connection.ops.bulk_batch_size(["sku"] * (len(FIELDS) * 2 + 1),
+                                          [None] * chunk_size)
+    size = min(size, chunk_size)
+    updated = 0
+    unknown = []
+    product_ids = set()
+    priced_ids = set()
+    for chunk in chunks(rows, size):
+        chunk = dict(chunk)
+        variations = update_variations(chunk)
+        updated += len(variations)
+        for sku, product_id, sale_id in variations:
+            product_ids.add(product_id)
+            if "unit_price" in chunk[sku]:
+                priced_ids.add(product_id)
+        found = set([sku for sku, product_id, sale_id in variations])
+        unknown.extend([sku for sku in chunk if sku not in found])
+    sync_products(product_ids)
+    if priced_ids:
+        # Any active sale may now apply to the new prices, not just
+        # those already applied to the variations.
+        for sale in Sale.objects.filter(active=True):
+            sale.reapply(priced_ids)
+    # Categories can select products by their prices, and the prices
+    # are shown on cacheable pages.
+    discounts.invalidate()
+    cacheable.changed()
+    return {"updated": updated, "products": len(product_ids),
+            "unknown": sorted(unknown)}
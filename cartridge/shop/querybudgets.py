@@ -0,0 +1,181 @@
+"""
+Query budgets for the shop's views and model methods, used by the
+test suite to catch regressions such as queries run in a loop for
+each cart item or variation.
+
+A budget is given as a number of queries, or as the name of one of
+the budgets in ``QUERY_BUDGETS``, which are made up of a fixed number
+of queries plus a number for each cart item and each variation of
+the product involved. ``query_budget`` can be used as a context
+manager or a decorator, and raises ``QueryBudgetExceeded`` when more
+queries than the budget allows are run, listing the queries grouped
+by the line of code that ran them::
+
+    with query_budget("cart", cart_items=3):
+        self.client.get(reverse("shop_cart"))
+"""
+
+import os
+from copy import copy
+from functools import wraps
+from traceback import extract_stack
+
+import django
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.datastructures import SortedDict
+
+
+# Queries allowed for each view and model method, as a tuple of fixed
+# queries, queries per cart item, and queries per product variation.
+# The shop's views and methods read and write the items and variations
+# they deal with together, so none of them are allowed queries per
+# item or variation.
+QUERY_BUDGETS = {
+    "product": (27, 0, 0),
+    "category": (30, 0, 0),
+    "product_add": (27, 0, 0),
+    "cart": (27, 0, 0),
+    "cart_update": (20, 0, 0),
+    "cart_add_json": (27, 0, 0),
+    "cart_update_json": (20, 0, 0),
+    "cart_add_items": (21, 0, 0),
+    "wishlist": (22, 0, 0),
+    "checkout_steps": (36, 0, 0),
+    "complete": (19, 0, 0),
+    "invoice": (12, 0, 0),
+    "order_history": (19, 0, 0),
+    "Cart.add_item": (9, 0, 0),
+    "ProductVariation.create_from_options": (3, 0, 0),
+    "ProductVariation.set_default_images": (3, 0, 0),
+    "export_products": (7, 0, 0),
+}
+
+# Frames from these directories are skipped when finding the line of
+# code that ran a query.
+SKIP_PATHS = (os.path.dirname(django.__file__),
+              os.path.splitext(__file__)[0])
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def get_budget(name, cart_items=0, variations=0):
+    """
+    Return the number of queries allowed by the named budget, for the
+    given number of cart items and variations.
+    """
+    fixed, per_item, per_variation = QUERY_BUDGETS[name]
+    return fixed + per_item * cart_items + per_variation * variations
+
+
+def callsite():
+    """
+    Return the file, line and function of the innermost frame in the
+    current stack that isn't within Django or this module.
+    """
+    for path, line, func, text in reversed(extract_stack()):
+        if not path.startswith(SKIP_PATHS):
+            cwd = os.getcwd() + os.sep
+            if path.startswith(cwd):
+                path = path[len(cwd):]
+            return "%s:%s in %s" % (path, line, func)
+    return "unknown"
+
+
+class RecordingCursor(object):
+    """
+    Cursor wrapper that records each query and where it was run from
+    with the ``query_budget`` using it.
+    """
+
+    def __init__(self, cursor, budget):
+        self.cursor = cursor
+        self.budget = budget
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, params=()):
+        self.budget.record(sql, params)
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.budget.record(sql, param_list)
+        return self.cursor.executemany(sql, param_list)
+
+
+class query_budget(object):
+    """
+    Context manager and decorator that fails with
+    ``QueryBudgetExceeded`` when the code it wraps runs more queries
+    than the given budget, which is either a number of queries or the
+    name of a budget in ``QUERY_BUDGETS``.
+    """
+
+    def __init__(self, budget, cart_items=0, variations=0,
+                 using=DEFAULT_DB_ALIAS):
+        if isinstance(budget, basestring):
+            self.name = budget
+            budget = get_budget(budget, cart_items, variations)
+        else:
+            self.name = None
+        self.budget = budget
+        self.using = using
+        self.queries = []
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            # Use a copy so that the budget can be nested or reentered.
+            with copy(self):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        connection = connections[self.using]
+        self.queries = []
+        self.cursor = connection.__dict__.get("cursor")
+        original = connection.cursor
+        connection.cursor = lambda: RecordingCursor(original(), self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection = connections[self.using]
+        if self.cursor is None:
+            del connection.cursor
+        else:
+            connection.cursor = self.cursor
+        if exc_type is None and len(self.queries) > self.budget:
+            raise QueryBudgetExceeded(self.report())
+
+    def record(self, sql, params):
+        self.queries.append((callsite(), sql))
+
+    def report(self):
+        """
+        Description of the queries run, grouped by where they were
+        run from, with the lines that ran the most queries first.
+        """
+        name = " '%s'" % self.name if self.name else ""
+        lines = ["Query budget%s exceeded: %s queries run, budget is %s" %
+                 (name, len(self.queries), self.budget)]
+        grouped = SortedDict()
+        for site, sql in self.queries:
+            grouped.setdefault(site, []).append(sql)
+        by_count = lambda site: -len(grouped[site])
+        for site in sorted(grouped.keys(), key=by_count):
+            queries = grouped[site]
+            lines.append("%s queries at %s" % (len(queries), site))
+            distinct = []
+            for sql in queries:
+                if sql not in distinct:
+                    distinct.append(sql)
+            for sql in distinct[:3]:
+                lines.append("    %s" % sql)
+            if len(distinct) > 3:
+                lines.append("    ... and %s more" % (len(distinct) - 3))
+        return "\n".join(lines)
@@ -0,0 +1,241 @@
+"""
+Table driven shipping and tax rates. The ``ShippingZone``,
+``ShippingPostcodeRange``, ``ShippingRate`` and ``TaxRate`` models are
+read once and compiled into a ``RateIndex``, so that quoting shipping
+and tax at checkout doesn't query the database. The index is rebuilt
+when any of the models are saved or deleted, and a version number
+stored in the cache lets other processes know to rebuild theirs.
+
+``billship_handler`` and ``tax_handler`` can be used for the
+``SHOP_HANDLER_BILLING_SHIPPING`` and ``SHOP_HANDLER_TAX`` settings.
+"""
+
+from bisect import bisect_right
+from decimal import Decimal, ROUND_HALF_UP
+from threading import Lock
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.utils.translation import ugettext as _
+
+from mezzanine.conf import settings
+
+from cartridge.shop.checkout import CheckoutError
+from cartridge.shop.editable import use_editable
+from cartridge.shop.models import ShippingPostcodeRange, ShippingRate
+from cartridge.shop.models import ShippingZone, TaxRate
+from cartridge.shop.utils import checkout_state, set_shipping, set_tax
+
+
+VERSION_KEY = "cartridge.shop.rates.version"
+
+
+def postcode_key(postcode):
+    """
+    Returns a sortable key for the postcode, so that numeric postcodes
+    are compared as numbers and others alphabetically.
+    """
+    postcode = postcode.replace(" ", "").upper()
+    if postcode.isdigit():
+        return (0, int(postcode), "")
+    return (1, 0, postcode)
+
+
+class IntervalIndex(object):
+    """
+    Intervals sorted by their start, along with the largest end of the
+    intervals up to each, so that a lookup only checks the intervals
+    that could contain the key.
+    """
+
+    def __init__(self, intervals):
+        self.intervals = sorted(intervals)
+        self.starts = [start for start, end, value in self.intervals]
+        self.max_ends = []
+        for start, end, value in self.intervals:
+            self.max_ends.append(max(end, self.max_ends[-1])
+                                 if self.max_ends else end)
+
+    def find(self, key):
+        """
+        Returns the values of the intervals containing the key.
+        """
+        values = []
+        i = bisect_right(self.starts, key) - 1
+        while i >= 0 and self.max_ends[i] >= key:
+            start, end, value = self.intervals[i]
+            if end >= key:
+                values.append(value)
+            i -= 1
+        return values
+
+
+class RateIndex(object):
+    """
+    Shipping zones indexed by country and postcode, along with the
+    shipping and tax rates for each zone.
+    """
+
+    def __init__(self, zones, postcodes, shipping_rates, tax_rates):
+        self.version = None
+        self.zones = dict([(zone.id, zone) for zone in zones])
+        ranges = {}
+        for postcode in postcodes:
+            start = postcode_key(postcode.start)
+            end = postcode_key(postcode.end) if postcode.end else start
+            ranges.setdefault(postcode.zone_id, []).append((start, end))
+        # Zones with postcode ranges are indexed by country, and by ""
+        # for zones without countries. Zones with only countries are
+        # mapped to the first for each country.
+        intervals = {}
+        self.country_zones = {}
+        self.any_zone = None
+        for zone in sorted(zones, key=lambda zone: zone.id):
+            countries = zone.country_list() or [""]
+            for country in countries:
+                if zone.id in ranges:
+                    for start, end in ranges[zone.id]:
+                        intervals.setdefault(country, []).append(
+                            (start, end, zone.id))
+                elif country:
+                    self.country_zones.setdefault(country, zone)
+                elif self.any_zone is None:
+                    self.any_zone = zone
+        self.postcode_zones = dict([(country, IntervalIndex(i))
+                                    for country, i in intervals.items()])
+        self.shipping_rates = {}
+        for rate in sorted(shipping_rates, key=lambda rate: rate.amount or 0):
+            self.shipping_rates.setdefault(rate.zone_id, []).append(rate)
+        self.tax_rates = {}
+        for rate in tax_rates:
+            self.tax_rates.setdefault(rate.zone_id, []).append(rate)
+
+    @classmethod
+    def build(cls):
+        """
+        Load the rates from the database and build the index.
+        """
+        return cls(list(ShippingZone.objects.all()),
+                   list(ShippingPostcodeRange.objects.all()),
+                   list(ShippingRate.objects.all()),
+                   list(TaxRate.objects.all()))
+
+    def zone_for(self, country, postcode):
+        """
+        Returns the most specific zone for the address, or ``None``.
+        """
+        country = (country or "").strip().lower()
+        key = postcode_key(postcode or "")
+        for indexed_country in (country, ""):
+            if indexed_country in self.postcode_zones:
+                zone_ids = self.postcode_zones[indexed_country].find(key)
+                if zone_ids:
+                    return self.zones[min(zone_ids)]
+        return self.country_zones.get(country, self.any_zone)
+
+    def shipping_rate(self, zone, total, quantity):
+        """
+        Returns the cheapest shipping rate for the zone that applies to
+        the order total and quantity, or ``None``.
+        """
+        if zone is not None:
+            for rate in self.shipping_rates.get(zone.id, []):
+                if rate.applies_to(total, quantity):
+                    return rate
+        return None
+
+    def tax(self, zone):
+        """
+        Returns the tax rates for the zone, or for everywhere if the
+        zone has none.
+        """
+        if zone is not None and zone.id in self.tax_rates:
+            return self.tax_rates[zone.id]
+        return self.tax_rates.get(None, [])
+
+
+_index = None
+_index_lock = Lock()
+
+
+def get_index():
+    """
+    Returns the current ``RateIndex``, building it if it hasn't been
+    built, or has been changed by another process.
+    """
+    global _index
+    version = cache.get(VERSION_KEY)
+    index = _index
+    if index is None or index.version != version:
+        with _index_lock:
+            index = RateIndex.build()
+            if version is None:
+                cache.add(VERSION_KEY, uuid4().hex)
+                version = cache.get(VERSION_KEY)
+            index.version = version
+            _index = index
+    return index
+
+
+def invalidate_index():
+    """
+    Discard the index in this process, and change the version in the
+    cache so that other processes discard theirs.
+    """
+    global _index
+    with _index_lock:
+        _index = None
+    cache.set(VERSION_KEY, uuid4().hex)
+
+
+def shipping_address(order_form):
+    """
+    Returns the country and postcode of the shipping address.
+    """
+    data = order_form.cleaned_data
+    return (data.get("shipping_detail_country", ""),
+            data.get("shipping_detail_postcode", ""))
+
+
+def billship_handler(request, order_form):
+    """
+    Billing/shipping handler that sets the shipping for the zone the
+    shipping address is in. If there are no shipping zones, the flat
+    rate given by ``SHOP_DEFAULT_SHIPPING_VALUE`` is used.
+    """
+    if checkout_state(request).get("free_shipping"):
+        return
+    index = get_index()
+    if not index.zones:
+        use_editable(request)
+        set_shipping(request, _("Flat rate shipping"),
+                     settings.SHOP_DEFAULT_SHIPPING_VALUE)
+        return
+    zone = index.zone_for(*shipping_address(order_form))
+    rate = index.shipping_rate(zone, request.cart.total_price(),
+                               request.cart.total_quantity())
+    if rate is None:
+        raise CheckoutError(_("Sorry, we don't ship to the address given"))
+    set_shipping(request, rate.title, rate.amount or 0)
+
+
+def tax_handler(request, order_form):
+    """
+    Tax handler that sets the tax for the zone the shipping address
+    is in, on the item total less any discount, and on shipping for
+    tax rates that apply to it.
+    """
+    index = get_index()
+    zone = index.zone_for(*shipping_address(order_form))
+    state = checkout_state(request)
+    taxable = (request.cart.total_price() -
+               state.get("discount_total", Decimal("0")))
+    shipping = state.get("shipping_total", Decimal("0"))
+    total = Decimal("0")
+    titles = []
+    for rate in index.tax(zone):
+        amount = taxable + shipping if rate.includes_shipping else taxable
+        total += amount * rate.rate / Decimal("100")
+        titles.append(rate.title)
+    total = total.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    set_tax(request, ", ".join(titles) or _("Tax"), total)
@@ -0,0 +1,495 @@
+"""
+Product search over an inverted index of the words in each product's
+title, description, content, category titles, option values and
+SKUs. The index is built by the ``search_index`` management command
+into ``SHOP_SEARCH_INDEX_DIR``, in a compact binary format that each
+process memory maps, so that searching only queries the database for
+the products that are published, and for those on the page shown.
+
+Products that are changed once the index is built are marked by the
+model signals, and indexed again into a small delta index, which
+replaces their entries in the main index. During a request, the
+products changed are kept for the request's thread, and indexed once
+the response is ready, so that a product saved along with its
+variations and categories is only indexed once. Once the delta would
+have more than ``MAX_DELTA`` products, or when all of the products
+need indexing again, the index is marked as stale rather than being
+rebuilt during the request, and the ``search_index`` command rebuilds
+it. Writing the index files is serialized across processes with a
+lock on a file in the index's directory. As with the shipping and tax
+rates index, a version number stored in the cache lets other
+processes know to map the index again.
+
+Each index file starts with a header giving the number of products
+and words it contains, followed by the sorted IDs of the products,
+an entry for each word in sorted order giving the offsets of the
+word and of its postings, the words themselves encoded as UTF-8, and
+the postings for each word - the ID of each product it appears in,
+along with its weight for the product.
+"""
+
+import os
+import re
+import struct
+from contextlib import contextmanager
+from math import log
+from mmap import ACCESS_READ, mmap
+from tempfile import mkstemp
+from threading import Lock, local
+from uuid import uuid4
+try:
+    from fcntl import flock, LOCK_EX, LOCK_UN
+except ImportError:
+    flock = None
+
+from django.core.cache import cache
+from django.utils.encoding import force_unicode
+from django.utils.html import strip_tags
+
+from mezzanine.conf import settings
+
+from cartridge.shop.models import Product, ProductVariation
+
+
+VERSION_KEY = "cartridge.shop.search.version"
+
+# Products indexed into the delta before the index needs rebuilding.
+MAX_DELTA = 100
+
+# Number of matching products over which all of the published products
+# are loaded, rather than looking up the matching products by ID.
+MAX_LOOKUP = 500
+
+# Weight of a word for each field it appears in.
+WEIGHTS = {
+    "title": 8,
+    "sku": 8,
+    "categories": 3,
+    "options": 3,
+    "description": 1,
+    "content": 1,
+}
+
+# Words in a query at least this long also match the words they start,
+# with their score reduced by ``PREFIX_FACTOR``.
+MIN_PREFIX = 3
+PREFIX_FACTOR = 0.5
+
+MAGIC = "CSI1"
+HEADER = struct.Struct("<4sII")
+PRODUCT = struct.Struct("<I")
+TERM = struct.Struct("<IHII")
+POSTING = struct.Struct("<IH")
+MAX_WEIGHT = 0xffff
+
+WORDS = re.compile(r"\w+", re.UNICODE)
+
+
+def words(text):
+    """
+    Returns the lowercase words in the text, with any HTML removed.
+    """
+    return WORDS.findall(strip_tags(force_unicode(text or "")).lower())
+
+
+def add_words(document, text, field):
+    """
+    Adds the weight of the field to each of the words in the text, for
+    the document of a product.
+    """
+    for word in words(text):
+        document[word] = document.get(word, 0) + WEIGHTS[field]
+
+
+def documents(product_ids=None):
+    """
+    Returns the words for all of the products, or for those with the
+    given IDs, as a dict mapping each product's ID to a dict of its
+    words and their weights.
+    """
+    products = Product.objects.all()
+    categories = Product.categories.through.objects.all()
+    variations = ProductVariation.objects.all()
+    if product_ids is not None:
+        products = products.filter(id__in=product_ids)
+        categories = categories.filter(product__in=product_ids)
+        variations = variations.filter(product__in=product_ids)
+    docs = {}
+    fields = ("title", "description", "content")
+    for product in products.values_list("id", *fields):
+        document = docs[product[0]] = {}
+        for field, text in zip(fields, product[1:]):
+            add_words(document, text, field)
+    categories = categories.values_list("product_id", "category__title")
+    for product_id, title in categories:
+        if product_id in docs:
+            add_words(docs[product_id], title, "categories")
+    options = [field.name for field in ProductVariation.option_fields()]
+    for variation in variations.values_list("product_id", "sku", *options):
+        document = docs.get(variation[0])
+        if document is None:
+            continue
+        sku = force_unicode(variation[1] or "").lower()
+        if sku:
+            # SKUs are also indexed whole, so that SKUs containing
+            # punctuation can be searched for as they're written.
+            add_words(document, sku, "sku")
+            if words(sku) != [sku]:
+                document[sku] = document.get(sku, 0) + WEIGHTS["sku"]
+        for value in variation[2:]:
+            add_words(document, value, "options")
+    return docs
+
+
+def write(path, docs, product_ids):
+    """
+    Writes the words for the products given by ``documents`` to the
+    index file at the path, along with the IDs of the products, which
+    may include IDs of products that have been deleted.
+    """
+    postings = {}
+    for product_id, document in docs.items():
+        for word, weight in document.items():
+            postings.setdefault(word.encode("utf-8"), []).append(
+                (product_id, min(weight, MAX_WEIGHT)))
+    terms = sorted(postings)
+    product_ids = sorted(product_ids)
+    term_offset = (HEADER.size + PRODUCT.size * len(product_ids) +
+                   TERM.size * len(terms))
+    posting_offset = term_offset + sum([len(term) for term in terms])
+    parts = [HEADER.pack(MAGIC, len(product_ids), len(terms))]
+    parts.extend([PRODUCT.pack(product_id) for product_id in product_ids])
+    for term in terms:
+        count = len(postings[term])
+        parts.append(TERM.pack(term_offset, len(term), posting_offset, count))
+        term_offset += len(term)
+        posting_offset += POSTING.size * count
+    parts.extend(terms)
+    for term in terms:
+        for posting in sorted(postings[term]):
+            parts.append(POSTING.pack(*posting))
+    # Written to a temporary file and moved into place, so that other
+    # processes never map a partly written file.
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fd, temp_path = mkstemp(dir=directory)
+    f = os.fdopen(fd, "wb")
+    try:
+        f.write("".join(parts))
+    finally:
+        f.close()
+    os.chmod(temp_path, 0644)
+    os.rename(temp_path, path)
+
+
+class Segment(object):
+    """
+    An index file written by ``write``, memory mapped.
+    """
+
+    def __init__(self, path):
+        f = open(path, "rb")
+        try:
+            self.data = mmap(f.fileno(), 0, access=ACCESS_READ)
+        finally:
+            f.close()
+        magic, self.num_products, self.num_terms = HEADER.unpack_from(
+            self.data)
+        if magic != MAGIC:
+            raise ValueError("%s isn't a search index" % path)
+        self.terms_start = HEADER.size + PRODUCT.size * self.num_products
+
+    def products(self):
+        """
+        Returns the set of IDs of the products in the index.
+        """
+        return frozenset(struct.unpack_from("<%sI" % self.num_products,
+                                            self.data, HEADER.size))
+
+    def entry(self, i):
+        return TERM.unpack_from(self.data, self.terms_start + TERM.size * i)
+
+    def term(self, i):
+        offset, length = self.entry(i)[:2]
+        return self.data[offset:offset + length]
+
+    def matches(self, word, prefix=False):
+        """
+        Yields the words in the index matching the given UTF-8 encoded
+        word - only the word itself, or when ``prefix`` is ``True``,
+        every word starting with it - along with their postings, as
+        lists of product IDs and weights.
+        """
+        low, high = 0, self.num_terms
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(middle) < word:
+                low = middle + 1
+            else:
+                high = middle
+        for i in xrange(low, self.num_terms):
+            term = self.term(i)
+            if term != word and not (prefix and term.startswith(word)):
+                break
+            offset, count = self.entry(i)[2:]
+            yield term, [POSTING.unpack_from(self.data,
+                                             offset + POSTING.size * j)
+                         for j in xrange(count)]
+
+
+class SearchIndex(object):
+    """
+    The main index, along with the delta index of the products that
+    have been indexed again since it was built.
+    """
+
+    def __init__(self, main, delta=None):
+        self.version = None
+        self.main = main
+        self.delta = delta
+        self.replaced = delta.products() if delta else frozenset()
+
+    def scores(self, word):
+        """
+        Returns the score for each product matching the word, as a
+        dict mapping product IDs to scores. Words that appear in fewer
+        products score higher, and each product's score is the best
+        for the words matched.
+        """
+        prefix = len(word) >= MIN_PREFIX
+        word = word.encode("utf-8")
+        total = float(max(self.main.num_products, 1))
+        matches = {}
+        for segment in (self.main, self.delta):
+            if segment is None:
+                continue
+            replaced = self.replaced if segment is self.main else ()
+            for term, postings in segment.matches(word, prefix):
+                matches.setdefault(term, []).extend([posting
+                    for posting in postings if posting[0] not in replaced])
+        scores = {}
+        for term, postings in matches.items():
+            if not postings:
+                continue
+            factor = log(1 + total / len(postings))
+            if term != word:
+                factor *= PREFIX_FACTOR
+            for product_id, weight in postings:
+                score = weight * factor
+                if score > scores.get(product_id, 0):
+                    scores[product_id] = score
+        return scores
+
+    def search(self, query):
+        """
+        Returns the IDs of the products matching all of the words in
+        the query, best matches first.
+        """
+        scores = None
+        for word in set(words(query)):
+            word_scores = self.scores(word)
+            if scores is not None:
+                word_scores = dict([(i, score + scores[i])
+                                    for i, score in word_scores.items()
+                                    if i in scores])
+            scores = word_scores
+            if not scores:
+                return []
+        if scores is None:
+            return []
+        return sorted(scores, key=lambda product_id: (-scores[product_id],
+                                                      product_id))
+
+
+_index = None
+_index_lock = Lock()
+_write_lock = Lock()
+
+# Whether changes are being kept for the current request, and the IDs
+# of the products changed, including ``None`` when they all have.
+_changes = local()
+
+
+def paths():
+    """
+    Returns the paths of the main and delta index files.
+    """
+    directory = settings.SHOP_SEARCH_INDEX_DIR
+    return (os.path.join(directory, "products.idx"),
+            os.path.join(directory, "products-delta.idx"))
+
+
+def stale_path():
+    """
+    Returns the path of the file marking the index as stale.
+    """
+    return os.path.join(settings.SHOP_SEARCH_INDEX_DIR, "products.stale")
+
+
+def is_stale():
+    """
+    Returns whether products have been changed that couldn't be
+    indexed into the delta, so the index needs rebuilding.
+    """
+    return os.path.exists(stale_path())
+
+
+@contextmanager
+def write_lock():
+    """
+    Hold the lock for writing the index files, shared between threads
+    with a lock in this process, and between processes with a lock on
+    a file in the index's directory, where ``fcntl`` is available.
+    The directory is created if it doesn't exist yet.
+    """
+    with _write_lock:
+        directory = settings.SHOP_SEARCH_INDEX_DIR
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if flock is None:
+            yield
+            return
+        path = os.path.join(directory, "products.lock")
+        with open(path, "a") as f:
+            flock(f.fileno(), LOCK_EX)
+            try:
+                yield
+            finally:
+                flock(f.fileno(), LOCK_UN)
+
+
+def get_index():
+    """
+    Returns the current ``SearchIndex``, mapping the index files if
+    they haven't been mapped, or have been changed by another process.
+    Returns ``None`` if the index hasn't been built.
+    """
+    global _index
+    if not settings.SHOP_SEARCH_INDEX_DIR:
+        return None
+    version = cache.get(VERSION_KEY)
+    index = _index
+    if index is None or index.version != version:
+        main_path, delta_path = paths()
+        with _index_lock:
+            try:
+                main = Segment(main_path)
+            except (IOError, ValueError):
+                return None
+            try:
+                delta = Segment(delta_path)
+            except (IOError, ValueError):
+                delta = None
+            index = SearchIndex(main, delta)
+            if version is None:
+                cache.add(VERSION_KEY, uuid4().hex)
+                version = cache.get(VERSION_KEY)
+            index.version = version
+            _index = index
+    return index
+
+
+def invalidate():
+    """
+    Discard the mapped index in this process, and change the version
+    in the cache so that other processes discard theirs.
+    """
+    global _index
+    with _index_lock:
+        _index = None
+    cache.set(VERSION_KEY, uuid4().hex)
+
+
+def build():
+    """
+    Index all of the products, replacing the index and any delta, and
+    return the number of products indexed.
+    """
+    main_path, delta_path = paths()
+    with write_lock():
+        docs = documents()
+        write(main_path, docs, docs.keys())
+        for path in (delta_path, stale_path()):
+            if os.path.exists(path):
+                os.remove(path)
+    invalidate()
+    return len(docs)
+
+
+def update(product_ids=None):
+    """
+    Index the products with the given IDs again into the delta. When
+    no IDs are given, or the delta would have more than ``MAX_DELTA``
+    products, the index is marked as stale instead, to be rebuilt by
+    the ``search_index`` command. Does nothing if the index hasn't
+    been built.
+    """
+    main_path, delta_path = paths()
+    if not settings.SHOP_SEARCH_INDEX_DIR or not os.path.exists(main_path):
+        return
+    with write_lock():
+        if product_ids is not None:
+            product_ids = set(product_ids)
+            try:
+                product_ids |= Segment(delta_path).products()
+            except (IOError, ValueError):
+                pass
+        if product_ids is None or len(product_ids) > MAX_DELTA:
+            open(stale_path(), "a").close()
+            return
+        write(delta_path, documents(product_ids), product_ids)
+    invalidate()
+
+
+def defer():
+    """
+    Keep the products changed from here on for the current request,
+    rather than indexing them straight away. Called by
+    ``ShopMiddleware`` at the start of each request.
+    """
+    _changes.product_ids = set()
+
+
+def changed(product_ids=None):
+    """
+    Marks the products with the given IDs as changed, or all of them
+    when no IDs are given. During a request, they're indexed again by
+    ``flush``, otherwise straight away.
+    """
+    pending = getattr(_changes, "product_ids", None)
+    if pending is None:
+        update(product_ids)
+    elif product_ids is None:
+        pending.add(None)
+    else:
+        pending.update(product_ids)
+
+
+def flush():
+    """
+    Index the products changed during the current request again.
+    Called by ``ShopMiddleware`` once the response is ready.
+    """
+    product_ids = getattr(_changes, "product_ids", None)
+    _changes.product_ids = None
+    if product_ids:
+        update(None if None in product_ids else product_ids)
+
+
+def search_products(query, for_user=None):
+    """
+    Returns the IDs of the published products matching the query,
+    best matches first, or ``None`` if the index hasn't been built.
+    """
+    index = get_index()
+    if index is None:
+        return None
+    product_ids = index.search(query)
+    if not product_ids:
+        return product_ids
+    published = Product.objects.published(for_user=for_user)
+    if len(product_ids) <= MAX_LOOKUP:
+        published = published.filter(id__in=product_ids)
+    published = set(published.values_list("id", flat=True))
+    return [i for i in product_ids if i in published]
@@ -0,0 +1,34 @@
+$(function() {
+
+    // Product and category pages are rendered without anything
+    // particular to the visitor when SHOP_CACHEABLE_PAGES is True, so
+    // load the user panel, CSRF token and stock levels here.
+    var panel = $('#cart-state');
+    var form = $('#add-cart');
+    var data = {};
+    if (form.data('product')) {
+        data.product = form.data('product');
+    }
+
+    $.getJSON(panel.data('url'), data, function(state) {
+        panel.replaceWith(state.panel);
+        $('form[method=post]').each(function() {
+            var token = $(this).find('input[name=csrfmiddlewaretoken]');
+            if (token.length == 0) {
+                token = $('<input type="hidden" name="csrfmiddlewaretoken">');
+                $(this).prepend(token);
+            }
+            token.val(state.csrf_token);
+        });
+        if (state.in_stock) {
+            $.each(state.in_stock, function(sku, inStock) {
+                if (!inStock) {
+                    var message = $('<p class="out-of-stock"></p>');
+                    message.text(form.data('out-of-stock'));
+                    $('#variation-' + sku).append(message);
+                }
+            });
+        }
+    });
+
+});
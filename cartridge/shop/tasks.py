@@ -0,0 +1,117 @@
+"""
+Tasks run for an order once it's complete. By default these run
+within the final request of the checkout process, but each can be
+deferred by adding its name to the ``SHOP_ORDER_TASKS_DEFERRED``
+setting, in which case it's queued as an ``OrderTask`` and run by
+the ``order_tasks`` management command.
+
+Deferred tasks are run without the request and order form, so each
+task is called with ``None`` for these, including the custom order
+handler defined by ``SHOP_HANDLER_ORDER``. Tasks named in
+``DEFERRED_ONLY`` aren't run at all unless they're deferred.
+"""
+
+from traceback import format_exc
+
+from django.utils.datastructures import SortedDict
+
+from mezzanine.conf import settings
+from mezzanine.utils.importing import import_dotted_path
+
+from cartridge.shop.checkout import send_order_email
+from cartridge.shop.instrumentation import timer
+from cartridge.shop.invoices import invoice_pdf
+from cartridge.shop.models import OrderTask, Product, ProductAction
+
+
+def product_actions(request, order_form, order):
+    """
+    Record the purchase of each product in the order.
+    """
+    product_ids = order.items.values_list("product_id", flat=True)
+    product_ids = [product_id for product_id in product_ids if product_id]
+    products = Product.objects.filter(id__in=product_ids)
+    existing = set(products.values_list("id", flat=True))
+    product_ids = [p for p in product_ids if p in existing]
+    ProductAction.objects.purchased_bulk(product_ids)
+
+
+def order_handler(request, order_form, order):
+    """
+    Call the custom order handler defined by ``SHOP_HANDLER_ORDER``.
+    """
+    if settings.SHOP_HANDLER_ORDER:
+        handler = import_dotted_path(settings.SHOP_HANDLER_ORDER)
+        with timer("checkout.order_handler"):
+            handler(request, order_form, order)
+
+
+def order_email(request, order_form, order):
+    """
+    Send the order receipt email.
+    """
+    send_order_email(request, order)
+
+
+def order_invoice(request, order_form, order):
+    """
+    Render and store the PDF invoice, so that it's ready when it's
+    first downloaded.
+    """
+    invoice_pdf(order)
+
+
+TASKS = SortedDict((
+    ("product_actions", product_actions),
+    ("order_handler", order_handler),
+    ("order_email", order_email),
+    ("order_invoice", order_invoice),
+))
+
+# Rendering the invoice is only worthwhile outside of the checkout
+# request.
+DEFERRED_ONLY = ("order_invoice",)
+
+
+def run_order_tasks(request, order_form, order):
+    """
+    Called from the final step of the checkout process once the order
+    is complete. Runs each of the tasks for the order, or queues those
+    named in ``SHOP_ORDER_TASKS_DEFERRED``.
+    """
+    for name, task in TASKS.items():
+        if name in settings.SHOP_ORDER_TASKS_DEFERRED:
+            OrderTask.objects.defer(order, name)
+        elif name not in DEFERRED_ONLY:
+            task(request, order_form, order)
+
+
+def run_task(task):
+    """
+    Run a deferred ``OrderTask``, returning True if it completed.
+    If the task has already been claimed by another worker, it's
+    skipped. If the task fails, the error is stored against it and
+    it will be retried once its ``run_after`` time is reached, until
+    ``SHOP_ORDER_TASK_ATTEMPTS`` is exceeded.
+    """
+    if not OrderTask.objects.claim(task):
+        return False
+    try:
+        TASKS[task.name](None, None, task.order)
+    except Exception:
+        OrderTask.objects.filter(id=task.id).update(error=format_exc())
+        return False
+    OrderTask.objects.filter(id=task.id).update(completed=True, error="")
+    return True
+
+
+def run_pending(limit=None):
+    """
+    Run the deferred tasks that are due, returning the number of
+    tasks that completed and the number that were attempted.
+    """
+    tasks = OrderTask.objects.pending().select_related("order")
+    if limit:
+        tasks = tasks[:limit]
+    tasks = list(tasks)
+    return len(filter(None, [run_task(task) for task in tasks])), len(tasks)
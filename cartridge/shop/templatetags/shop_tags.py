@@ -4,7 +4,7 @@ import platform
 
 from django import template
 
-from cartridge.shop.utils import set_locale
+from cartridge.shop.utils import checkout_state, set_locale
 
 
 register = template.Library()
@@ -52,9 +52,10 @@ def _order_totals(context):
             context["tax_total"] = context["discount_total"] = \
                 context["shipping_total"] = 0
         else:
+            state = checkout_state(context["request"])
             for f in ("shipping_type", "shipping_total", "discount_total",
                       "tax_type", "tax_total"):
-                context[f] = context["request"].session.get(f, None)
+                context[f] = state.get(f)
     context["order_total"] = context.get("item_total", None)
     if context.get("shipping_total", None) is not None:
         context["order_total"] += Decimal(str(context["shipping_total"]))
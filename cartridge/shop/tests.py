@@ -1,23 +1,69 @@
 
+import errno
+import os
+import socket
+import sys
+from contextlib import contextmanager
 from datetime import timedelta
 from decimal import Decimal
+from glob import glob
 from operator import mul
-
+from select import select
+from shutil import copy, rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from time import time
+from zipfile import ZipFile
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core import mail
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, IntegrityError
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase
 from django.test.client import RequestFactory
+from django.utils import simplejson
 from django.utils.timezone import now
 from django.utils.unittest import skipUnless
 from mezzanine.conf import settings
+from mezzanine.conf.models import Setting
+from mezzanine.core.models import CONTENT_STATUS_DRAFT
 from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
 from mezzanine.utils.tests import run_pyflakes_for_package
 from mezzanine.utils.tests import run_pep8_for_package
 
+from cartridge.shop import cacheable, discounts, editable, pricefeed, rates
+from cartridge.shop import search
 from cartridge.shop.models import Product, ProductOption, ProductVariation
 from cartridge.shop.models import Category, Cart, Order, DiscountCode
-from cartridge.shop.models import Sale
+from cartridge.shop.models import Sale, ShippingRate, ShippingZone, TaxRate
+from cartridge.shop.models import WishlistItem
 from cartridge.shop.forms import OrderForm
-from cartridge.shop.checkout import CHECKOUT_STEPS
+from cartridge.shop.checkout import CHECKOUT_STEPS, CLAIM_TOKEN_ATTEMPTS
+from cartridge.shop.checkout import CheckoutError, setup_order
+from cartridge.shop.benchmarks import compare, run_benchmarks
+from cartridge.shop.explain import check
+from cartridge.shop.generator import DataGenerator
+from cartridge.shop.instrumentation import get_sinks, incr, percentiles
+from cartridge.shop.instrumentation import read_histograms, reset_sinks
+from cartridge.shop.instrumentation import timer
+from cartridge.shop.invoices import get_stored_invoice, invoice_filename
+from cartridge.shop.invoices import invoice_version, invoice_zip
+from cartridge.shop.invoices import invoice_context, store_invoice
+from cartridge.shop.management.commands import product_db
+from cartridge.shop.management.commands.profile_url import query_summary
+from cartridge.shop.payment.stub import DEFAULT_RESPONSE, StubGatewayServer
+from cartridge.shop.payment.transport import CircuitOpenError, Transport
+from cartridge.shop.payment.transport import TransportError
+from cartridge.shop.querybudgets import QueryBudgetExceeded, query_budget
+from cartridge.shop.search import search_products
+from cartridge.shop.tasks import run_order_tasks, run_pending
+from cartridge.shop.utils import CheckoutState
 
 
 TEST_STOCK = 5
@@ -69,16 +115,40 @@ class ShopTests(TestCase):
         # Create single empty variation.
         self._product.variations.manage_empty()
         self.assertEqual(self._product.variations.count(), 1)
+        # Only the variations created are given SKUs.
+        empty = self._product.variations.all()
+        empty.update(sku=None)
+        empty = empty[0]
         # Create variations from all options.
         self._product.variations.create_from_options(self._options)
         # Should do nothing.
         self._product.variations.create_from_options(self._options)
         # All options plus empty.
         self.assertEqual(self._product.variations.count(), total + 1)
+        # Variations are given their IDs as SKUs.
+        for variation in self._product.variations.exclude(id=empty.id):
+            self.assertEqual(variation.sku, str(variation.id))
+        self.assertEqual(self._product.variations.get(id=empty.id).sku, None)
         # Remove empty.
         self._product.variations.manage_empty()
         self.assertEqual(self._product.variations.count(), total)
 
+    def test_default_images(self):
+        """
+        Test images are assigned to variations without one, and removed
+        from variations when deleted.
+        """
+        self._product.variations.create_from_options(self._options)
+        image1 = self._product.images.create(file="image1.jpg")
+        image2 = self._product.images.create(file="image2.jpg")
+        variations = self._product.variations
+        with query_budget("ProductVariation.set_default_images"):
+            variations.set_default_images([])
+        self.assertEqual(variations.exclude(image=image1).count(), 0)
+        with query_budget("ProductVariation.set_default_images"):
+            variations.set_default_images([str(image1.id)])
+        self.assertEqual(variations.exclude(image=image2).count(), 0)
+
     def test_stock(self):
         """
         Test stock checking on product variations.
@@ -254,6 +324,159 @@ class ShopTests(TestCase):
         self.assertEqual(cart.total_quantity(), 0)
         self.assertEqual(cart.total_price(), Decimal("0"))
 
+        # Update quantities, which are validated against the stock
+        # levels, and remove items given a quantity of zero.
+        self._add_to_cart(variation, TEST_STOCK)
+        cart = Cart.objects.from_request(self.client)
+        response = self._update_cart(cart, [TEST_STOCK * 2 + 1])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(cart.total_quantity(), TEST_STOCK)
+        self._update_cart(cart, [TEST_STOCK * 2])
+        self.assertEqual(cart.total_quantity(), TEST_STOCK * 2)
+        self.assertEqual(cart.total_price(), TEST_PRICE * TEST_STOCK * 2)
+        self._update_cart(cart, [0])
+        self.assertFalse(cart.has_items())
+
+    def _update_cart(self, cart, quantities):
+        """
+        Posts the cart form with the given quantity for each item in
+        the cart, and returns the response.
+        """
+        data = {"items-INITIAL_FORMS": 0, "items-TOTAL_FORMS": 0,
+                "update_cart": 1}
+        for i, (item, quantity) in enumerate(zip(cart, quantities)):
+            data["items-INITIAL_FORMS"] += 1
+            data["items-TOTAL_FORMS"] += 1
+            data["items-%s-id" % i] = item.id
+            data["items-%s-quantity" % i] = quantity
+        response = self.client.post(reverse("shop_cart"), data)
+        if hasattr(cart, "_cached_items"):
+            del cart._cached_items
+        return response
+
+    def test_cart_json(self):
+        """
+        Test adding, updating and removing cart items, and applying
+        discount codes, with the JSON cart views.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        field_names = [f.name for f in ProductVariation.option_fields()]
+        data = dict(zip(field_names, variation.options()))
+        data.update({"product": self._product.id, "quantity": 2})
+        response = self.client.post(reverse("shop_cart_add"), data)
+        cart = simplejson.loads(response.content)
+        self.assertEqual(cart["quantity"], 2)
+        self.assertEqual(cart["items"][0]["sku"], variation.sku)
+        item = {"item": cart["items"][0]["id"]}
+        # Stock is validated as for the product and cart forms.
+        data = dict(item, quantity=TEST_STOCK * 3)
+        response = self.client.post(reverse("shop_cart_update"), data)
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(simplejson.loads(response.content)["errors"])
+        data = dict(item, quantity=1)
+        response = self.client.post(reverse("shop_cart_update"), data)
+        self.assertEqual(simplejson.loads(response.content)["quantity"], 1)
+        data = {"discount_code": "invalid"}
+        response = self.client.post(reverse("shop_cart_discount"), data)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse("shop_cart_remove"), item)
+        self.assertEqual(simplejson.loads(response.content)["items"], [])
+        # IDs must be ASCII digits, and SKUs must be of published
+        # products.
+        response = self.client.post(reverse("shop_cart_add"),
+                                    {"product": u"\u00b2"})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post(reverse("shop_cart_remove"),
+                                    {"item": u"\u00b2"})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse("shop_cart_state"),
+                                   {"product": u"\u00b2"})
+        self.assertFalse("in_stock" in simplejson.loads(response.content))
+        draft = Product.objects.create(status=CONTENT_STATUS_DRAFT)
+        draft.variations.create(sku="DRAFT", unit_price=TEST_PRICE)
+        data = {"sku": "DRAFT", "quantity": 1}
+        response = self.client.post(reverse("shop_cart_add"), data)
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post(reverse("shop_cart_remove"), item)
+        self.assertEqual(response.status_code, 404)
+
+    def test_quick_order(self):
+        """
+        Test adding many SKUs to the cart at once, with errors for each
+        line that can't be added.
+        """
+        self._reset_variations()
+        variations = list(self._product.variations.all()[:3])
+        for variation in variations:
+            variation.unit_price = TEST_PRICE
+            variation.num_in_stock = TEST_STOCK * 2
+            variation.save()
+        url = reverse("shop_cart_add_items")
+        lines = ["%s 1" % variations[0].sku, "", "%s, 2" % variations[1].sku,
+                 "invalid 1", "%s x" % variations[2].sku,
+                 "%s %s" % (variations[2].sku, TEST_STOCK * 2 + 1),
+                 "%s 00" % variations[2].sku,
+                 u"%s \u00b2" % variations[2].sku]
+        response = self.client.post(url, {"items": "\n".join(lines)})
+        self.assertEqual(response.status_code, 400)
+        errors = simplejson.loads(response.content)["errors"]["items"]
+        self.assertEqual(len(errors), 5)
+        self.assertTrue(errors[0].startswith("Line 4: invalid"))
+        self.assertEqual(Cart.objects.from_request(self.client).skus(), [])
+        lines = ["%s %s" % (variation.sku, i + 1)
+                 for i, variation in enumerate(variations)]
+        with query_budget("cart_add_items"):
+            self.client.post(url, {"items": "\n".join(lines)})
+        lines.append(variations[0].sku)
+        with query_budget("cart_add_items"):
+            response = self.client.post(url, {"items": "\n".join(lines)})
+        cart = simplejson.loads(response.content)
+        self.assertEqual(cart["quantity"], 13)
+        self.assertEqual([item["quantity"] for item in cart["items"]],
+                         [3, 4, 6])
+        cart = Cart.objects.from_request(self.client)
+        self.assertEqual(cart.total_price(), TEST_PRICE * 13)
+        response = self.client.post(reverse("shop_quick_order"),
+                                    {"items": variations[0].sku})
+        self.assertRedirects(response, reverse("shop_cart"))
+
+    def test_wishlist(self):
+        """
+        Test that the wishlist is stored in the database for
+        authenticated users, with the cookie's SKUs added on login.
+        """
+        self._reset_variations()
+        variations = list(self._product.variations.all()[:3])
+        for variation in variations:
+            variation.unit_price = TEST_PRICE
+            variation.save()
+        skus = [variation.sku for variation in variations]
+        self.client.cookies["wishlist"] = ",".join(reversed(skus[:2]))
+        User.objects.create_user("test", "test@example.com", "test")
+        self.client.login(username="test", password="test")
+        response = self.client.get(reverse("shop_wishlist"))
+        self.assertEqual(response.cookies["wishlist"].value, "")
+        items = [item.sku for item in response.context["wishlist_items"]]
+        self.assertEqual(items, list(reversed(skus[:2])))
+        field_names = [f.name for f in ProductVariation.option_fields()]
+        data = dict(zip(field_names, variations[2].options()))
+        data.update({"quantity": 1, "add_wishlist": 1})
+        self.client.post(self._product.get_absolute_url(), data)
+        data = {"sku": skus[1], "remove_wishlist": 1}
+        self.client.post(reverse("shop_wishlist"), data)
+        user = User.objects.get(username="test")
+        self.assertEqual(WishlistItem.objects.skus_for(user),
+                         [skus[0], skus[2]])
+        # SKUs that don't exist are skipped, as are those added by
+        # another request at the same time.
+        WishlistItem.objects.add_skus(user, ["unknown", skus[1]])
+        skus = [skus[0], skus[2], skus[1]]
+        self.assertEqual(WishlistItem.objects.skus_for(user), skus)
+        items = [WishlistItem(user_id=user.id, sku=sku) for sku in skus]
+        WishlistItem.objects._insert(items)
+        self.assertEqual(WishlistItem.objects.skus_for(user), skus)
+
     def test_discount_codes(self):
         """
         Test that all types of discount codes are applied.
@@ -288,7 +511,8 @@ class ShopTests(TestCase):
                     discount.products.add(variation.product)
                 post_data = {"discount_code": code}
                 self.client.post(reverse("shop_cart"), post_data)
-                discount_total = self.client.session["discount_total"]
+                state = CheckoutState(self.client.session)
+                discount_total = state.get("discount_total")
                 if discount_type == "percent":
                     expected = TEST_PRICE / Decimal("100") * discount_value
                     if discount_target == "cart":
@@ -304,9 +528,119 @@ class ShopTests(TestCase):
                     self._empty_cart(cart)
                     self._add_to_cart(invalid_variation, 1)
                     self.client.post(reverse("shop_cart"), post_data)
-                    discount_total = self.client.session.get("discount_total")
+                    state = CheckoutState(self.client.session)
+                    discount_total = state.get("discount_total")
                     self.assertEqual(discount_total, None)
 
+        # The SKUs for a discount are only resolved again once the
+        # discount changes.
+        discount = DiscountCode.objects.get(code="item_percent")
+        cart = Cart.objects.from_request(self.client)
+        self.assertEqual(cart.calculate_discount(discount), 0)
+        with query_budget(0):
+            self.assertEqual(cart.calculate_discount(discount), 0)
+        discount.products.add(invalid_product)
+        self.assertEqual(cart.calculate_discount(discount),
+                         TEST_PRICE / Decimal("100") * discount_value)
+        # Saving a variation's options, prices or sale also resolves
+        # them again, but saving its stock level doesn't.
+        invalid_variation.save(update_fields=["num_in_stock"])
+        with query_budget(0):
+            discounts.eligible_skus(discount)
+        for update_fields in (["unit_price"], None):
+            invalid_variation.save(update_fields=update_fields)
+            with self.assertRaises(QueryBudgetExceeded):
+                with query_budget(0):
+                    discounts.eligible_skus(discount)
+        # As does creating variations in bulk.
+        option_field = ProductVariation.option_fields()[0].name
+        invalid_product.variations.create_from_options(
+            {option_field: ["extra"]})
+        skus = invalid_product.variations.values_list("sku", flat=True)
+        self.assertTrue(set(skus) <= discounts.eligible_skus(discount))
+
+    def test_editable_settings(self):
+        """
+        Test that editable settings and whether discount codes are
+        active are only loaded again once they've changed.
+        """
+        request = RequestFactory().get("/")
+        request.site_id = settings.SITE_ID
+        editable.use_editable(request)
+        self.assertFalse(discounts.any_active_codes())
+        with query_budget(0):
+            editable.use_editable(request)
+            self.assertEqual(settings.SHOP_DEFAULT_SHIPPING_VALUE, 10)
+            self.assertFalse(discounts.any_active_codes())
+        setting = Setting.objects.create(name="SHOP_DEFAULT_SHIPPING_VALUE",
+                                         value="12")
+        DiscountCode.objects.create(code="test", active=True)
+        try:
+            editable.use_editable()
+            self.assertEqual(settings.SHOP_DEFAULT_SHIPPING_VALUE, 12)
+            self.assertTrue(discounts.any_active_codes())
+        finally:
+            setting.delete()
+        editable.use_editable()
+        self.assertEqual(settings.SHOP_DEFAULT_SHIPPING_VALUE, 10)
+
+    def test_cacheable_pages(self):
+        """
+        Test that product pages are rendered without the cart and CSRF
+        token, and revalidated against the version of the catalogue,
+        when ``SHOP_CACHEABLE_PAGES`` is ``True``.
+        """
+        self._product.variations.manage_empty()
+        variation = self._product.variations.all()[0]
+        variation.unit_price = TEST_PRICE
+        variation.num_in_stock = 1
+        variation.save()
+        self._product.available = True
+        self._product.save()
+        cacheable_pages = settings.SHOP_CACHEABLE_PAGES
+        settings.SHOP_CACHEABLE_PAGES = True
+        try:
+            url = self._product.get_absolute_url()
+            response = self.client.get(url)
+            self.assertContains(response, "add-cart")
+            self.assertNotContains(response, "csrfmiddlewaretoken")
+            etag = response["ETag"]
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            # Stock levels aren't part of the page.
+            variation.update_stock(-1)
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            # Changes made during a request only change the version
+            # once the response is ready.
+            version = cacheable.get_version()
+            cacheable.defer()
+            self._product.save()
+            self.assertEqual(cacheable.get_version(), version)
+            cacheable.flush()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(reverse("shop_cart_state"),
+                                       {"product": self._product.id})
+            state = simplejson.loads(response.content)
+            self.assertEqual(state["cart_quantity"], 0)
+            self.assertEqual(state["in_stock"], {variation.sku: False})
+            self.assertTrue(state["csrf_token"])
+            # The next date a product is published is found once for
+            # each version, and changes the version once it's passed.
+            publish_date = now() + timedelta(days=1)
+            Product.objects.create(publish_date=publish_date)
+            version = cacheable.get_version()
+            self.assertEqual(cacheable.get_change(version),
+                             cacheable.timestamp(publish_date))
+            with query_budget(0):
+                cacheable.get_change(version)
+            cache.set(cacheable.CHANGE_KEY, (version, time() - 1))
+            self.client.get(url)
+            self.assertNotEqual(cacheable.get_version(), version)
+        finally:
+            settings.SHOP_CACHEABLE_PAGES = cacheable_pages
+
     def test_order(self):
         """
         Test that a completed order contains cart items and that
@@ -342,6 +676,377 @@ class ShopTests(TestCase):
         self.assertEqual(items[0].quantity, TEST_STOCK)
         self.assertEqual(variation.num_in_stock, TEST_STOCK)
         self.assertEqual(order.item_total, TEST_PRICE * TEST_STOCK)
+        self.assertEqual(items[0].product_id, self._product.id)
+        self.assertEqual(items[0].product_title, self._product.title)
+        self.assertFalse("order" in CheckoutState(self.client.session))
+        response = self.client.get(reverse("shop_complete"))
+        self.assertEqual(response.status_code, 200)
+
+    def test_checkout_state(self):
+        """
+        Test that the checkout state is stored as a single compact
+        value, that's only written when it changes, is ignored when
+        stored with another version, and is converted from sessions
+        that stored each field under its own key.
+        """
+
+        class Session(dict):
+            writes = 0
+
+            def __setitem__(self, key, value):
+                self.writes += 1
+                super(Session, self).__setitem__(key, value)
+
+        session = Session()
+        state = CheckoutState(session)
+        state.update(cart=1, shipping_type="Standard", shipping_total=10)
+        state.update(shipping_total=Decimal("10"), discount_total=None)
+        self.assertEqual(session.writes, 1)
+        self.assertEqual(session.keys(), [CheckoutState.session_key])
+        self.assertEqual(session[CheckoutState.session_key],
+                         '[1,1,null,null,"Standard","10"]')
+        state = CheckoutState(session)
+        self.assertEqual(state.get("shipping_total"), Decimal("10"))
+        self.assertFalse("step" in state)
+        state.update(step=2, order={"billing_detail_email": "a@b.c"})
+        state.clear("shipping_type", "shipping_total")
+        self.assertEqual(session.writes, 3)
+        state = CheckoutState(session)
+        self.assertEqual(state.step, 2)
+        self.assertEqual(state.get("order"), {"billing_detail_email": "a@b.c"})
+        self.assertEqual(state.get("shipping_type"), None)
+        session[CheckoutState.session_key] = '[0,1,2]'
+        self.assertEqual(CheckoutState(session).get("cart"), None)
+        # Sessions with the fields stored under their own keys.
+        session = Session(cart=1, order={"step": 2, "billing_detail_email":
+                                         "a@b.c"}, tax_total=Decimal("1.5"))
+        state = CheckoutState(session)
+        self.assertEqual(state.step, 2)
+        self.assertEqual(state.get("order"), {"billing_detail_email": "a@b.c"})
+        self.assertEqual(state.get("tax_total"), Decimal("1.5"))
+        self.assertEqual(session.keys(), [CheckoutState.session_key])
+        self.assertEqual(CheckoutState(session).get("cart"), 1)
+
+    def test_checkout_token(self):
+        """
+        Test that a token is issued with the final checkout step, and
+        that submitting it again while the first submission is being
+        processed doesn't create another order, but waits for the
+        first submission on the processing page.
+        """
+        form = OrderForm(None, len(CHECKOUT_STEPS), initial={})
+        self.assertTrue(form.initial["checkout_token"])
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        self._add_to_cart(variation, 1)
+        cart = Cart.objects.from_request(self.client)
+        token = "0" * 32
+        data = self._checkout_data(token)
+        processing = "%s?token=%s" % (reverse("shop_checkout_processing"),
+                                      token)
+        # Order for a first submission that's still being processed.
+        first = Order.objects.create(checkout_token=token,
+                                     key=self.client.session.session_key)
+        response = self.client.post(reverse("shop_checkout"), data)
+        self.assertRedirects(response, processing)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(cart.items.count(), 1)
+        response = self.client.get(processing)
+        self.assertEqual(response.status_code, 200)
+        # Payment failed for the first submission.
+        first.delete()
+        response = self.client.get(processing)
+        self.assertRedirects(response, reverse("shop_checkout"))
+        self.client.post(reverse("shop_checkout"), data)
+        order = Order.objects.get(checkout_token=token)
+        self.assertEqual(order.items.count(), 1)
+        self.assertEqual(cart.items.count(), 0)
+        # The first submission has completed.
+        response = self.client.get(processing)
+        self.assertRedirects(response, reverse("shop_complete"))
+
+    def _checkout_data(self, token):
+        """
+        Returns POST data for the final checkout step with the given
+        checkout token.
+        """
+        data = {
+            "step": len(CHECKOUT_STEPS),
+            "billing_detail_email": "example@example.com",
+            "discount_code": "",
+            "checkout_token": token,
+        }
+        for field_name, field in OrderForm(None, None).fields.items():
+            value = field.choices[-1][1] if hasattr(field, "choices") else "1"
+            data.setdefault(field_name, value)
+        return data
+
+    def test_order_history(self):
+        """
+        Test the total quantity of items is given for each order in
+        the order history.
+        """
+        user = User.objects.create_user("test", "test@example.com", "test")
+        self.client.login(username="test", password="test")
+        orders = []
+        for quantities in ((1, 2), (TEST_STOCK,), ()):
+            order = Order.objects.create(user_id=user.id)
+            for i, quantity in enumerate(quantities):
+                order.items.create(sku=str(i), quantity=quantity)
+            orders.append((order.id, sum(quantities)))
+        response = self.client.get(reverse("shop_order_history"))
+        self.assertEqual(response.status_code, 200)
+        history = response.context["orders"].object_list
+        self.assertEqual(len(history), len(orders))
+        for order in history:
+            self.assertEqual(order.quantity_total, dict(orders)[order.id])
+
+    def test_invoice(self):
+        """
+        Test that a stored PDF invoice is served, only for the version
+        of the order it was rendered for, in both the cache and the
+        invoice directory.
+        """
+        User.objects.create_superuser("staff", "staff@example.com", "staff")
+        self.client.login(username="staff", password="staff")
+        order = Order.objects.create(billing_detail_email="a@example.com")
+        order.items.create(sku="1", quantity=1)
+        url = reverse("shop_invoice", args=(order.id,)) + "?format=pdf"
+        invoice_dir = settings.SHOP_INVOICE_DIR
+        temp_dir = mkdtemp()
+        try:
+            for directory, data in (("", "cached"), (temp_dir, "stored")):
+                settings.SHOP_INVOICE_DIR = directory
+                version = invoice_version(order)
+                store_invoice(order, version, data)
+                response = self.client.get(url)
+                self.assertEqual(response.content, data)
+                archive = StringIO()
+                invoice_zip(Order.objects.filter(id=order.id), archive, 1)
+                archive = ZipFile(archive)
+                self.assertEqual(archive.read(invoice_filename(order)), data)
+                order.items.create(sku=directory, quantity=1)
+                new_version = invoice_version(order)
+                self.assertNotEqual(new_version, version)
+                self.assertEqual(get_stored_invoice(order, new_version), None)
+            # Invoices can't be rendered ahead of time into the local
+            # memory cache of another process.
+            if isinstance(cache, LocMemCache):
+                settings.SHOP_INVOICE_DIR = ""
+                self.assertRaises(CommandError, call_command, "invoices")
+        finally:
+            settings.SHOP_INVOICE_DIR = invoice_dir
+            rmtree(temp_dir)
+        # The PDF is rendered with the same context processors as the
+        # HTML invoice, without the customer's request.
+        context = invoice_context(order)
+        response = self.client.get(url.split("?")[0])
+        for name in ("settings", "STATIC_URL", "LANGUAGE_BIDI", "order"):
+            self.assertTrue(name in context)
+            self.assertTrue(name in response.context)
+        self.assertFalse(context["user"].is_authenticated())
+
+    def test_order_tasks(self):
+        """
+        Test that deferred order tasks are queued rather than run, and
+        are then run once by the worker.
+        """
+        order = Order.objects.create(billing_detail_email="a@example.com")
+        for sku in ("1", "2"):
+            order.items.create(sku=sku, quantity=1,
+                               product_id=self._product.id)
+        deferred = settings.SHOP_ORDER_TASKS_DEFERRED
+        settings.SHOP_ORDER_TASKS_DEFERRED = ("product_actions",
+                                              "order_email")
+        try:
+            run_order_tasks(None, None, order)
+        finally:
+            settings.SHOP_ORDER_TASKS_DEFERRED = deferred
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(order.tasks.count(), 2)
+        self.assertEqual(run_pending(), (2, 2))
+        self.assertEqual(run_pending(), (0, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        actions = self._product.actions.all()
+        # A purchase is recorded for each item of the product.
+        self.assertEqual([a.total_purchase for a in actions], [2])
+
+    def test_profile_url(self):
+        """
+        Test that profiling a URL writes the profile and query log,
+        and reports repeated queries.
+        """
+        self._reset_variations()
+        directory = mkdtemp()
+        output = StringIO()
+        prefix = os.path.join(directory, "profile")
+        try:
+            call_command("profile_url", reverse("shop_cart"), repeat=2,
+                         cart_items=1, output=prefix, stdout=output)
+            self.assertTrue(os.path.exists(prefix + ".pstats"))
+            with open(prefix + ".sql") as f:
+                self.assertTrue("shop_cartitem" in f.read())
+        finally:
+            rmtree(directory)
+        self.assertTrue("GET %s: 200" % reverse("shop_cart") in
+                        output.getvalue())
+        queries = [{"sql": "SELECT 1 WHERE id = %s" % i, "time": "0.001"}
+                   for i in (1, 2, 2)]
+        summary = query_summary(queries)
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]["count"], 3)
+        self.assertEqual(summary[0]["duplicates"], 1)
+
+    def test_price_feed(self):
+        """
+        Test that a price and stock feed updates variations by SKU,
+        copies the price fields of default variations to products, and
+        reapplies sales to the new prices.
+        """
+        self._reset_variations()
+        self._product.variations.manage_empty()
+        default = self._product.variations.get(default=True)
+        other = self._product.variations.filter(default=False)[0]
+        # Fields not given are left unchanged, and nulls are stored.
+        feed = StringIO('{"sku": "%s", "num_in_stock": null}\n'
+                        '{"sku": "%s", "unit_price": "4.5"}\n' %
+                        (default.sku, other.sku))
+        with query_budget(6):
+            result = pricefeed.apply_feed(pricefeed.read_feed(feed, "jsonl"),
+                                          chunk_size=1)
+        self.assertEqual(result, {"updated": 2, "products": 1,
+                                  "unknown": []})
+        default = ProductVariation.objects.get(id=default.id)
+        self.assertEqual(default.num_in_stock, None)
+        self.assertEqual(default.unit_price, TEST_PRICE)
+        other = ProductVariation.objects.get(id=other.id)
+        self.assertEqual(other.unit_price, Decimal("4.5"))
+        # CSV feed via the management command.
+        sale = Sale.objects.create(title="Sale", active=True,
+                                   discount_percent=50)
+        sale.products.add(self._product)
+        directory = mkdtemp()
+        path = os.path.join(directory, "feed.csv")
+        output = StringIO()
+        try:
+            with open(path, "w") as f:
+                f.write("sku,unit_price,num_in_stock\n%s,10.00,3\n"
+                        "unknown,1,1\n" % default.sku)
+            call_command("price_feed", path, stdout=output)
+        finally:
+            rmtree(directory)
+        self.assertTrue("Unknown SKUs: 1" in output.getvalue())
+        default = ProductVariation.objects.get(id=default.id)
+        self.assertEqual(default.num_in_stock, 3)
+        self.assertEqual(default.sale_price, Decimal("5"))
+        product = Product.objects.get(id=self._product.id)
+        self.assertEqual(product.sku, default.sku)
+        self.assertEqual(product.unit_price, Decimal("10"))
+        self.assertEqual(product.num_in_stock, 3)
+        self.assertEqual(product.sale_price, Decimal("5"))
+        # Sales are only reapplied to the products whose prices
+        # changed, including variations that now pass the price filter.
+        sale.active = False
+        sale.save()
+        untouched = Product.objects.create(title="Other")
+        untouched = untouched.variations.create(sku="OTHER", unit_price=20)
+        deduct = Sale.objects.create(title="Deduct", active=True,
+                                     discount_deduct=6)
+        deduct.products.add(self._product, untouched.product)
+        self.assertEqual(ProductVariation.objects.get(id=other.id).sale_id,
+                         None)
+        ProductVariation.objects.filter(id=untouched.id).update(
+            sale_price=Decimal("1"))
+        feed = [(other.sku, {"unit_price": Decimal("8")}),
+                (default.sku, {"unit_price": Decimal("5")})]
+        pricefeed.apply_feed(feed)
+        other = ProductVariation.objects.get(id=other.id)
+        self.assertEqual((other.sale_id, other.sale_price),
+                         (deduct.id, Decimal("2")))
+        default = ProductVariation.objects.get(id=default.id)
+        self.assertEqual((default.sale_id, default.sale_price), (None, None))
+        untouched = ProductVariation.objects.get(id=untouched.id)
+        self.assertEqual(untouched.sale_price, Decimal("1"))
+        feed = StringIO("sku,unit_price\n%s,free\n" % default.sku)
+        self.assertRaises(pricefeed.FeedError, list,
+                          pricefeed.read_feed(feed, "csv"))
+
+    def test_search(self):
+        """
+        Test that the search index finds published products by the
+        words in their titles, content, categories, options and SKUs,
+        best matches first, and indexes products again once they're
+        changed.
+        """
+        self._category.title = "Gadgets"
+        self._category.save()
+        self._product.title = "Blue widget"
+        self._product.content = "<p>A widget that's red inside.</p>"
+        self._product.save()
+        self._product.categories.add(self._category)
+        self._product.variations.create(sku="BW-100", option1="Large")
+        other = Product.objects.create(title="Red widget", **self._published)
+        Product.objects.create(title="Red widget",
+                               status=CONTENT_STATUS_DRAFT)
+        url = reverse("shop_search")
+        index_dir = settings.SHOP_SEARCH_INDEX_DIR
+        directory = mkdtemp()
+        # The index directory is created when the index is first built.
+        settings.SHOP_SEARCH_INDEX_DIR = os.path.join(directory, "search")
+        try:
+            # Mezzanine's search is used until the index is built.
+            self.assertEqual(search_products("widget"), None)
+            response = self.client.get(url, {"q": "blue widget"})
+            self.assertContains(response, "Blue widget")
+            call_command("search_index", stdout=StringIO())
+            product_id = self._product.id
+            self.assertEqual(search_products("red"), [other.id, product_id])
+            self.assertEqual(search_products("wid"), [product_id, other.id])
+            self.assertEqual(search_products("RED blue"), [product_id])
+            self.assertEqual(search_products("gadgets large"), [product_id])
+            self.assertEqual(search_products("bw-100"), [product_id])
+            self.assertEqual(search_products("bw"), [product_id])
+            self.assertEqual(search_products("green"), [])
+            self.assertEqual(search_products(""), [])
+            other.title = "Green widget"
+            other.save()
+            self.assertEqual(search_products("red"), [product_id])
+            self.assertEqual(search_products("green"), [other.id])
+            response = self.client.get(url, {"q": "widget"})
+            products = response.context["products"]
+            self.assertEqual([p.id for p in products.object_list],
+                             [product_id, other.id])
+            other.delete()
+            self.assertEqual(search_products("widget"), [product_id])
+            # Products changed during a request are indexed once the
+            # response is ready, and too many mark the index as stale.
+            search.defer()
+            self._product.title = "Yellow widget"
+            self._product.save()
+            self.assertEqual(search_products("yellow"), [])
+            search.flush()
+            self.assertEqual(search_products("yellow"), [product_id])
+            search.defer()
+            self._category.delete()
+            search.flush()
+            self.assertTrue(search.is_stale())
+            self.assertEqual(search_products("gadgets"), [product_id])
+            call_command("search_index", stale=True, stdout=StringIO())
+            self.assertFalse(search.is_stale())
+            self.assertEqual(search_products("gadgets"), [])
+            # Other processes can't write the index while it's locked.
+            if search.flock is not None:
+                from fcntl import flock, LOCK_EX, LOCK_NB
+                path = os.path.join(settings.SHOP_SEARCH_INDEX_DIR,
+                                    "products.lock")
+                with search.write_lock():
+                    with open(path) as f:
+                        self.assertRaises(IOError, flock, f.fileno(),
+                                          LOCK_EX | LOCK_NB)
+        finally:
+            settings.SHOP_SEARCH_INDEX_DIR = index_dir
+            search.invalidate()
+            rmtree(directory)
 
     def test_syntax(self):
         """
@@ -360,6 +1065,202 @@ class ShopTests(TestCase):
             self.fail("Syntax warnings!\n\n%s" % "\n".join(warnings))
 
 
+class DataGeneratorTests(TestCase):
+
+    def generate(self):
+        generator = DataGenerator(seed=1, batch_size=7)
+        return generator.generate(categories=3, products=10, options=3,
+                                  max_values=2, images=0, sales=1,
+                                  discount_codes=2, carts=3, orders=5)
+
+    def test_generate(self):
+        """
+        Test that generated products match their default variations,
+        that orders match their items, and that the same seed
+        generates the same products.
+        """
+        counts = self.generate()
+        self.assertEqual(ProductVariation.objects.count(),
+                         counts["variations"])
+        for product in Product.objects.all():
+            default = product.variations.get(default=True)
+            self.assertEqual(product.unit_price, default.unit_price)
+            self.assertEqual(product.sku, default.sku)
+            self.assertTrue(product.categories.exists())
+        self.assertEqual(Cart.objects.count(), 3)
+        self.assertEqual(Order.objects.count(), 5)
+        for order in Order.objects.all():
+            item_total = sum([i.total_price for i in order.items.all()])
+            self.assertEqual(order.item_total, item_total)
+        titles = lambda: list(Product.objects.order_by("id").values_list(
+            "title", flat=True))
+        first = titles()
+        self.generate()
+        self.assertEqual(titles(), first * 2)
+
+    def test_benchmarks(self):
+        """
+        Test that the benchmarks run against generated data, and that
+        comparing results flags slower runs and extra queries.
+        """
+        self.generate()
+        results = run_benchmarks(["cart", "Order.setup"], repeat=1,
+                                 cart_items=2, isolate=False)
+        for name, result in results.items():
+            self.assertFalse("error" in result, result.get("error"))
+            self.assertTrue(result["queries"] > 0)
+        previous = {"cart": {"time": 1, "queries": 10}}
+        current = {"cart": {"time": 1.1, "queries": 10}}
+        self.assertEqual(compare(previous, current, .2), [])
+        current = {"cart": {"time": 2, "queries": 11}}
+        self.assertEqual(len(compare(previous, current, .2)), 2)
+
+
+class QueryBudgetTests(TestCase):
+
+    # Number of cart items and variations each view is run with, to
+    # check that the queries don't grow faster than their budgets.
+    sizes = ((1, 2), (4, 8), (8, 16))
+
+    def _setup(self, cart_items, variations):
+        """
+        Create a product with the given number of variations, add
+        the given number of them to the cart and the wishlist.
+        """
+        Product.objects.all().delete()
+        Order.objects.all().delete()
+        published = {"status": CONTENT_STATUS_PUBLISHED}
+        self._product = Product.objects.create(**published)
+        self._category = Category.objects.create(title="Category",
+                                                 **published)
+        self._product.categories.add(self._category)
+        option_type = settings.SHOP_OPTION_TYPE_CHOICES[0][0]
+        names = ["test%s" % i for i in range(variations)]
+        for name in names:
+            ProductOption.objects.get_or_create(type=option_type, name=name)
+        option_field = ProductVariation.option_fields()[0].name
+        variations = self._product.variations
+        with query_budget("ProductVariation.create_from_options"):
+            variations.create_from_options({option_field: names})
+        variations.update(unit_price=TEST_PRICE, num_in_stock=TEST_STOCK)
+        variations.manage_empty()
+        self._product.copy_default_variation()
+        self._variations = list(variations.order_by("id"))
+        skus = []
+        for variation in self._variations[:cart_items]:
+            data = {option_field: variation.option1, "quantity": 1}
+            if skus:
+                data["product"] = self._product.id
+                with query_budget("cart_add_json", variations=len(names)):
+                    self.client.post(reverse("shop_cart_add"), data)
+            else:
+                with query_budget("product_add", variations=len(names)):
+                    self.client.post(self._product.get_absolute_url(), data)
+            skus.append(variation.sku)
+        self.client.cookies["wishlist"] = ",".join(skus)
+
+    def test_views(self):
+        """
+        Test that the shop views run within their query budgets.
+        """
+        for cart_items, variations in self.sizes:
+            self._setup(cart_items, variations)
+            sizes = {"cart_items": cart_items, "variations": variations}
+            with query_budget("product", **sizes):
+                self.client.get(self._product.get_absolute_url())
+            with query_budget("category", **sizes):
+                response = self.client.get(self._category.get_absolute_url())
+            self.assertEqual(len(response.context["products"].object_list), 1)
+            with query_budget("cart", **sizes):
+                self.client.get(reverse("shop_cart"))
+            with query_budget("wishlist", **sizes):
+                self.client.get(reverse("shop_wishlist"))
+            cart = Cart.objects.from_request(self.client)
+            data = {"items-INITIAL_FORMS": cart_items, "update_cart": 1,
+                    "items-TOTAL_FORMS": cart_items}
+            for i, item in enumerate(cart):
+                data["items-%s-id" % i] = item.id
+                data["items-%s-quantity" % i] = 2
+            with query_budget("cart_update", **sizes):
+                self.client.post(reverse("shop_cart"), data)
+            data = {"item": item.id, "quantity": 1}
+            with query_budget("cart_update_json", **sizes):
+                self.client.post(reverse("shop_cart_update"), data)
+            data = {"step": len(CHECKOUT_STEPS), "discount_code": "",
+                    "billing_detail_email": "example@example.com"}
+            for name, field in OrderForm(None, None).fields.items():
+                value = field.choices[-1][1] if hasattr(field, "choices") \
+                    else "1"
+                data.setdefault(name, value)
+            with query_budget("checkout_steps", **sizes):
+                self.client.post(reverse("shop_checkout"), data)
+            with query_budget("complete", **sizes):
+                response = self.client.get(reverse("shop_complete"))
+            self.assertEqual(len(response.context["items"]), cart_items)
+            order = response.context["order"]
+            url = reverse("shop_invoice", args=(order.id,))
+            with query_budget("invoice", **sizes):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+    def test_order_history(self):
+        """
+        Test that the order history runs within its query budget.
+        """
+        user = User.objects.create_user("test", "test@example.com", "test")
+        self.client.login(username="test", password="test")
+        for cart_items, variations in self.sizes:
+            for i in range(cart_items):
+                order = Order.objects.create(user_id=user.id)
+                order.items.create(sku=str(i), quantity=1)
+            with query_budget("order_history", cart_items=cart_items):
+                self.client.get(reverse("shop_order_history"))
+
+    def test_model_methods(self):
+        """
+        Test that key model methods and the product export run within
+        their query budgets.
+        """
+        for cart_items, variations in self.sizes:
+            self._setup(0, variations)
+            cart = Cart.objects.create(last_updated=now())
+            for variation in self._variations[:cart_items]:
+                with query_budget("Cart.add_item"):
+                    cart.add_item(variation, 1)
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                with query_budget("export_products", variations=variations):
+                    product_db.export_products(os.devnull)
+            finally:
+                sys.stdout = stdout
+
+    def test_budget_exceeded(self):
+        """
+        Test that exceeding a budget lists the queries run, grouped by
+        where they were run from.
+        """
+        with query_budget(2) as budget:
+            User.objects.count()
+            User.objects.count()
+        self.assertEqual(len(budget.queries), 2)
+        try:
+            with query_budget(1):
+                for i in range(3):
+                    User.objects.count()
+        except QueryBudgetExceeded, e:
+            self.assertTrue("3 queries at" in str(e))
+            self.assertTrue("tests.py" in str(e))
+        else:
+            self.fail("Query budget wasn't exceeded")
+
+        @query_budget(1)
+        def count_twice():
+            User.objects.count()
+            User.objects.count()
+        self.assertRaises(QueryBudgetExceeded, count_twice)
+
+
 class SaleTests(TestCase):
 
     def setUp(self):
@@ -411,6 +1312,39 @@ class SaleTests(TestCase):
         for variation in ProductVariation.objects.all():
             self.assertTrue(variation.sale_price)
 
+    def test_sale_sync(self):
+        """
+        Test that adding and removing products only updates those
+        products, and that the sale prices can be rebuilt.
+        """
+        sale = Sale.objects.all()[0]
+        sale.active = True
+        sale.save()
+        product1, product2 = Product.objects.order_by("id")
+        product3 = Product.objects.create(unit_price="1.27")
+        product3.variations.create(unit_price="1.27")
+        # A sale price that isn't rewritten unless all products are.
+        Product.objects.filter(id=product1.id).update(sale_price="1")
+        sale.products.add(product3)
+        self.assertEqual(Product.objects.get(id=product1.id).sale_price,
+                         Decimal("1"))
+        product3 = Product.objects.get(id=product3.id)
+        self.assertEqual(product3.sale_id, sale.id)
+        self.assertTrue(product3.variations.all()[0].sale_price)
+        sale.products.remove(product2)
+        self.assertEqual(Product.objects.get(id=product2.id).sale_id, None)
+        for variation in product2.variations.all():
+            self.assertEqual(variation.sale_price, None)
+        # Saving the sale unchanged leaves the products as they are,
+        # and the full rebuild is run by the apply_sales command.
+        sale = Sale.objects.get(id=sale.id)
+        sale.save()
+        self.assertEqual(Product.objects.get(id=product1.id).sale_price,
+                         Decimal("1"))
+        call_command("apply_sales", stdout=StringIO())
+        self.assertNotEqual(Product.objects.get(id=product1.id).sale_price,
+                            Decimal("1"))
+
 
 try:
     __import__("stripe")
@@ -474,6 +1408,202 @@ if stripe_used:
     StripeTests.test_charge = mock.patch(charge)(StripeTests.test_charge)
 
 
+class PaymentTransportTests(TestCase):
+    """
+    Test the payment gateway transport against the stub gateway.
+    """
+
+    def setUp(self):
+        self.server = StubGatewayServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_keep_alive(self):
+        """
+        Test connections to the gateway are reused.
+        """
+        transport = Transport(self.server.url)
+        for i in range(3):
+            self.assertEqual(transport.post("/", "a=1"), DEFAULT_RESPONSE[1])
+        transport.close()
+        clients = set([r["client"] for r in self.server.requests])
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(clients), 1)
+
+    def test_timeout(self):
+        """
+        Test a slow gateway raises an error once the read timeout is
+        reached.
+        """
+        self.server.delay = 1
+        transport = Transport(self.server.url, read_timeout=0.1)
+        self.assertRaises(TransportError, transport.post, "/", "a=1")
+
+    def test_retries(self):
+        """
+        Test idempotent requests are retried after a server error, and
+        payment requests aren't.
+        """
+        self.server.responses = [(500, ""), (500, "")]
+        transport = Transport(self.server.url, retries=1)
+        self.assertRaises(TransportError, transport.post, "/", "a=1")
+        self.assertEqual(len(self.server.requests), 1)
+        data = transport.request("GET", "/", idempotent=True)
+        self.assertEqual(data, DEFAULT_RESPONSE[1])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_stale_connection(self):
+        """
+        Test a payment request is made on a new connection when the
+        gateway has closed the pooled connection, and an idempotent
+        request is made again when the closed connection fails after
+        the request was sent on it.
+        """
+        self.server.drop_connections = True
+        transport = Transport(self.server.url, retries=0)
+        self.assertEqual(transport.post("/", "a=1"), DEFAULT_RESPONSE[1])
+        # Wait for the gateway to close the pooled connection.
+        select([transport._idle[0][0].sock], [], [], 5)
+        self.assertEqual(transport.post("/", "a=1"), DEFAULT_RESPONSE[1])
+        transport._dropped = lambda connection: False
+        self.assertEqual(transport.request("GET", "/", idempotent=True),
+                         DEFAULT_RESPONSE[1])
+        transport.close()
+        clients = set([r["client"] for r in self.server.requests])
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(clients), 3)
+
+    def test_reset_after_sent(self):
+        """
+        Test a payment request isn't made again when a pooled
+        connection fails after the request was sent on it, since the
+        gateway may have processed it.
+        """
+
+        class ResetConnection(object):
+            sock = socket.socket()
+
+            def request(self, *args):
+                pass
+
+            def getresponse(self):
+                raise socket.error(errno.ECONNRESET, "Connection reset")
+
+            def close(self):
+                pass
+
+        transport = Transport(self.server.url, retries=1)
+        transport._dropped = lambda connection: False
+        transport._idle.append((ResetConnection(), time()))
+        try:
+            transport.post("/", "a=1")
+        except TransportError, e:
+            self.assertTrue(e.sent)
+        else:
+            self.fail("The reset connection didn't raise an error")
+        self.assertEqual(len(self.server.requests), 0)
+
+    def test_client_error(self):
+        """
+        Test a client error raises an error without being retried,
+        rather than the gateways parsing the body of the response.
+        """
+        self.server.responses = [(404, "Not Found")]
+        transport = Transport(self.server.url, retries=1)
+        self.assertRaises(TransportError, transport.request, "GET", "/",
+                          idempotent=True)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_circuit_breaker(self):
+        """
+        Test the gateway is no longer called once it has failed the
+        given number of times in a row.
+        """
+        self.server.responses = [(500, "")] * 2
+        transport = Transport(self.server.url, circuit_failures=2,
+                              circuit_reset=60)
+        for i in range(2):
+            self.assertRaises(TransportError, transport.post, "/", "a=1")
+        self.assertRaises(CircuitOpenError, transport.post, "/", "a=1")
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class InstrumentationTests(TestCase):
+
+    def setUp(self):
+        self._sinks = settings.SHOP_INSTRUMENTATION_SINKS
+        self._dir = settings.SHOP_INSTRUMENTATION_DIR
+        self._address = settings.SHOP_INSTRUMENTATION_STATSD_ADDRESS
+        settings.SHOP_INSTRUMENTATION_DIR = mkdtemp()
+
+    def tearDown(self):
+        rmtree(settings.SHOP_INSTRUMENTATION_DIR)
+        settings.SHOP_INSTRUMENTATION_SINKS = self._sinks
+        settings.SHOP_INSTRUMENTATION_DIR = self._dir
+        settings.SHOP_INSTRUMENTATION_STATSD_ADDRESS = self._address
+        reset_sinks()
+
+    def test_histogram(self):
+        """
+        Test that timings and counters are aggregated across processes
+        and reported as percentiles.
+        """
+        sink = "cartridge.shop.instrumentation.HistogramSink"
+        settings.SHOP_INSTRUMENTATION_SINKS = (sink,)
+        reset_sinks()
+        product = Product.objects.create()
+        variation = product.variations.create(num_in_stock=TEST_STOCK)
+        for i in range(3):
+            variation.live_num_in_stock()
+        timed = timer("test")(lambda ms: get_sinks()[0].timing("ms", ms))
+        for ms in range(1, 101):
+            timed(ms)
+        incr("test.counter", 2)
+        histogram = get_sinks()[0]
+        self.assertEqual(histogram.counters["stock.live_num_in_stock.cached"],
+                         2)
+        self.assertEqual(histogram.timings["test"]["count"], 100)
+        summary = percentiles(histogram.timings["ms"], (50, 90))
+        self.assertTrue(45 <= summary["p50"] <= 55)
+        self.assertTrue(85 <= summary["p90"] <= 100)
+        self.assertEqual(summary["max"], 100)
+        # Another process with the same timings.
+        histogram.flush()
+        path = glob(os.path.join(settings.SHOP_INSTRUMENTATION_DIR, "*"))[0]
+        copy(path, path.replace(".json", "0.json"))
+        data = read_histograms()
+        self.assertEqual(data["timings"]["ms"]["count"], 200)
+        self.assertEqual(data["counters"]["test.counter"], 4)
+        output = StringIO()
+        call_command("shop_metrics", percentiles="50,99", reset=True,
+                     stdout=output)
+        self.assertTrue("stock.live_num_in_stock" in output.getvalue())
+        self.assertTrue("p99" in output.getvalue())
+        self.assertFalse(read_histograms()["timings"])
+
+    def test_statsd(self):
+        """
+        Test that timings and counters are sent in the statsd format.
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        address = "127.0.0.1:%s" % server.getsockname()[1]
+        settings.SHOP_INSTRUMENTATION_STATSD_ADDRESS = address
+        sink = "cartridge.shop.instrumentation.StatsdSink"
+        settings.SHOP_INSTRUMENTATION_SINKS = (sink,)
+        reset_sinks()
+        try:
+            incr("test")
+            self.assertEqual(server.recv(1024), "cartridge.test:1|c")
+            with timer("test"):
+                pass
+            self.assertTrue(server.recv(1024).endswith("ms"))
+        finally:
+            server.close()
+
+
 class TaxationTests(TestCase):
 
     def test_default_handler_exists(self):
@@ -508,8 +1638,212 @@ class TaxationTests(TestCase):
             session = {}
 
         set_tax(request, tax_type, tax_total)
+        state = CheckoutState(request.session)
 
-        assert request.session.get('tax_type') == tax_type, \
+        assert state.get('tax_type') == tax_type, \
             'tax_type not set with set_tax'
-        assert request.session.get('tax_total') == tax_total, \
+        assert state.get('tax_total') == Decimal(str(tax_total)), \
             'tax_total not set with set_tax'
+
+
+class RatesTests(TestCase):
+
+    def setUp(self):
+        """
+        Zones for a city within a country, the rest of the country,
+        and everywhere else, with their shipping and tax rates.
+        """
+        country = ShippingZone.objects.create(title="Country",
+                                              countries="Australia, AU")
+        city = ShippingZone.objects.create(title="City",
+                                           countries="Australia")
+        city.postcodes.create(start="2000", end="2234")
+        other = ShippingZone.objects.create(title="International")
+        self._zones = (country, city, other)
+        city.shipping_rates.create(title="City", amount=5)
+        country.shipping_rates.create(title="Standard", amount=10,
+                                      max_total=100)
+        country.shipping_rates.create(title="Free", amount=0, min_total=100)
+        other.shipping_rates.create(title="Express", amount=30,
+                                    max_quantity=5)
+        country.tax_rates.create(title="GST", rate=10, includes_shipping=True)
+        TaxRate.objects.create(title="Tax", rate=5)
+
+    def test_index(self):
+        """
+        Test that the most specific zone is found for each address,
+        and that the index is rebuilt when the rates change, without
+        querying the database otherwise.
+        """
+        country, city, other = self._zones
+        index = rates.get_index()
+        with query_budget(0):
+            self.assertEqual(rates.get_index(), index)
+            self.assertEqual(index.zone_for("australia", "2010"), city)
+            self.assertEqual(index.zone_for("AU", "2010"), country)
+            self.assertEqual(index.zone_for("Australia", "3000"), country)
+            self.assertEqual(index.zone_for("France", "2010"), other)
+            rate = index.shipping_rate(country, Decimal("50"), 1)
+            self.assertEqual(rate.title, "Standard")
+            rate = index.shipping_rate(country, Decimal("100"), 1)
+            self.assertEqual(rate.title, "Free")
+            self.assertEqual(index.shipping_rate(other, 0, 6), None)
+            self.assertEqual([r.title for r in index.tax(other)], ["Tax"])
+        ShippingRate.objects.filter(title="Free").delete()
+        index = rates.get_index()
+        self.assertEqual(index.shipping_rate(country, Decimal("100"), 1),
+                         None)
+
+    def test_handlers(self):
+        """
+        Test that the handlers set the shipping and tax for the zone
+        of the shipping address.
+        """
+        product = Product.objects.create()
+        variation = product.variations.create(unit_price=TEST_PRICE)
+        cart = Cart.objects.create(last_updated=now())
+        cart.add_item(variation, 2)
+
+        class request:
+            session = {}
+
+        request.cart = cart
+
+        class order_form:
+            cleaned_data = {"shipping_detail_country": "Australia",
+                            "shipping_detail_postcode": "3000"}
+
+        rates.billship_handler(request, order_form)
+        rates.tax_handler(request, order_form)
+        state = CheckoutState(request.session)
+        self.assertEqual(state.get("shipping_type"), "Standard")
+        self.assertEqual(state.get("shipping_total"), 10)
+        self.assertEqual(state.get("tax_type"), "GST")
+        self.assertEqual(state.get("tax_total"), Decimal("5.00"))
+        cart.add_item(variation, 4)
+        request.cart = Cart.objects.get(id=cart.id)
+        order_form.cleaned_data["shipping_detail_country"] = "France"
+        self.assertRaises(CheckoutError, rates.billship_handler, request,
+                          order_form)
+
+
+class ExplainTests(TransactionTestCase):
+
+    def test_explain(self):
+        """
+        Test that the shop's main lookups use indexes rather than
+        scanning whole tables. SQLite's driver commits any transaction
+        before running ``EXPLAIN``, so this isn't run in a transaction
+        that's rolled back like the other tests.
+        """
+        if connection.vendor != "sqlite":
+            return
+        for name, plan, tables in check():
+            self.assertEqual(tables, [], "%s: %s" % (name, plan))
+        output = StringIO()
+        call_command("shop_explain", "cart", "wishlist", verbosity=2,
+                     fail=True, stdout=output)
+        self.assertEqual(output.getvalue().count(" ok"), 2)
+
+
+class CheckoutTokenTests(TransactionTestCase):
+
+    def test_savepoints(self):
+        """
+        Test that the checkout token is claimed within a savepoint on
+        databases that use them, where committing while saving the
+        order would also release the savepoint, as on PostgreSQL.
+        SQLite only behaves like this with its driver's own
+        transaction handling turned off, so this isn't run in a
+        transaction that's rolled back like the other tests.
+        """
+        if connection.vendor != "sqlite":
+            return
+        request = self._request()
+        token = "0" * 32
+        first = Order(checkout_token=token)
+        again = Order(checkout_token=token)
+        with self._savepoints():
+            self.assertTrue(setup_order(request, first))
+            self.assertFalse(setup_order(request, again))
+        self.assertEqual(Order.objects.get(checkout_token=token), first)
+        self.assertEqual(again.id, None)
+
+    def test_integrity_errors(self):
+        """
+        Test that integrity errors that aren't from claiming the
+        checkout token are raised, rather than retried indefinitely.
+        """
+        request = self._request()
+        for token in (None, "0" * 32):
+            order = Order(checkout_token=token)
+            attempts = []
+
+            def setup(request):
+                attempts.append(request)
+                raise IntegrityError("Not the token")
+            order.setup = setup
+            self.assertRaises(IntegrityError, setup_order, request, order)
+            self.assertTrue(len(attempts) <= CLAIM_TOKEN_ATTEMPTS)
+        self.assertEqual(Order.objects.count(), 0)
+
+    def _request(self):
+        """
+        Returns a request for the final checkout step with a session
+        and an empty cart.
+        """
+        request = RequestFactory().post("/")
+        request.user = AnonymousUser()
+        request.session = SessionStore()
+        request.session.save()
+        request.checkout_state = CheckoutState(request.session)
+        request.cart = Cart.objects.create()
+        return request
+
+    @contextmanager
+    def _savepoints(self):
+        """
+        Forces savepoints to be used with SQLite, with transactions
+        begun by savepoints or statements, and ended by commits and
+        rollbacks, rather than by its driver. Committing releases any
+        savepoints, so the test fails if a commit happens while one
+        is still needed.
+        """
+        db = connections[DEFAULT_DB_ALIAS]
+        db.cursor()
+        features, ops = db.features, db.ops
+        uses_savepoints = features.uses_savepoints
+        savepoints = []
+
+        def savepoint(sql):
+            def savepoint_sql(sid):
+                if sql == "SAVEPOINT":
+                    savepoints.append(sid)
+                else:
+                    savepoints.remove(sid)
+                return "%s %s" % (sql, sid)
+            return savepoint_sql
+
+        def end(sql):
+            self.assertEqual(savepoints, [], "%s in savepoint" % sql)
+            try:
+                db.cursor().execute(sql)
+            except DatabaseError:
+                pass  # No transaction is active.
+        features.uses_savepoints = True
+        ops.savepoint_create_sql = savepoint("SAVEPOINT")
+        ops.savepoint_commit_sql = savepoint("RELEASE")
+        ops.savepoint_rollback_sql = savepoint("ROLLBACK TO")
+        db.connection.isolation_level = None
+        db._commit = lambda: end("COMMIT")
+        db._rollback = lambda: end("ROLLBACK")
+        try:
+            yield
+        finally:
+            del savepoints[:]
+            end("COMMIT")
+            db.connection.isolation_level = ""
+            features.uses_savepoints = uses_savepoints
+            del ops.savepoint_create_sql, ops.savepoint_commit_sql
+            del ops.savepoint_rollback_sql
+            del db._commit, db._rollback
@@ -5,7 +5,17 @@ urlpatterns = patterns("cartridge.shop.views",
     url("^product/(?P<slug>.*)/$", "product", name="shop_product"),
     url("^wishlist/$", "wishlist", name="shop_wishlist"),
     url("^cart/$", "cart", name="shop_cart"),
+    url("^cart/add/$", "cart_add", name="shop_cart_add"),
+    url("^cart/add/items/$", "cart_add_items", name="shop_cart_add_items"),
+    url("^cart/update/$", "cart_update", name="shop_cart_update"),
+    url("^cart/remove/$", "cart_remove", name="shop_cart_remove"),
+    url("^cart/discount/$", "cart_discount", name="shop_cart_discount"),
+    url("^cart/state/$", "cart_state", name="shop_cart_state"),
+    url("^quick-order/$", "quick_order", name="shop_quick_order"),
+    url("^search/$", "search", name="shop_search"),
     url("^checkout/$", "checkout_steps", name="shop_checkout"),
+    url("^checkout/processing/$", "checkout_processing",
+        name="shop_checkout_processing"),
     url("^checkout/complete/$", "complete", name="shop_complete"),
     url("^invoice/(?P<order_id>\d+)/$", "invoice", name="shop_invoice"),
 )
@@ -1,4 +1,5 @@
 import hmac
+from decimal import Decimal
 from locale import setlocale, LC_MONETARY
 try:
     from hashlib import sha512 as digest
@@ -6,10 +7,145 @@ except ImportError:
     from md5 import new as digest
 
 from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson
 from django.utils.timezone import now
 from django.utils.translation import ugettext as _
 
 from mezzanine.conf import settings
+from mezzanine.utils.views import set_cookie
+
+
+class CheckoutState(object):
+    """
+    The cart ID, checkout step, order form fields, shipping, tax and
+    discount stored in the session, kept together as a single value
+    serialised to a compact JSON list of the fields in order. The
+    value is only loaded when first accessed, and only written back
+    to the session when one of the fields changes, so that requests
+    that don't change it don't cause the session to be saved.
+
+    The version is stored as the first item, so that the fields can
+    change - a state stored with a different version is ignored.
+    Sessions from before the state was kept together, which stored
+    each field under its own key, with the step in the order fields,
+    are converted to the single value the first time they're loaded.
+    """
+
+    version = 1
+    session_key = "shop"
+    fields = ("cart", "step", "order", "shipping_type", "shipping_total",
+              "tax_type", "tax_total", "discount_code", "discount_total",
+              "free_shipping")
+    decimal_fields = ("shipping_total", "tax_total", "discount_total")
+
+    def __init__(self, session):
+        self._session = session
+        self._values = None
+
+    def _load(self):
+        if self._values is None:
+            self._values = {}
+            if self.session_key not in self._session:
+                self._load_legacy()
+                return self._values
+            try:
+                stored = simplejson.loads(self._session[self.session_key])
+            except (TypeError, ValueError):
+                stored = None
+            if isinstance(stored, list) and stored[:1] == [self.version]:
+                for name, value in zip(self.fields, stored[1:]):
+                    if value is not None:
+                        self._values[name] = self._convert(name, value)
+        return self._values
+
+    def _load_legacy(self):
+        """
+        Moves the fields stored under their own session keys into the
+        state.
+        """
+        legacy = [name for name in self.fields if name != "step"]
+        legacy = [name for name in legacy if name in self._session]
+        if not legacy:
+            return
+        for name in legacy:
+            value = self._session.pop(name)
+            if name == "order" and isinstance(value, dict):
+                value = dict(value)
+                step = value.pop("step", None)
+                if step is not None:
+                    self._values["step"] = step
+            if value is not None:
+                self._values[name] = self._convert(name, value)
+        self._save()
+
+    def _convert(self, name, value):
+        if name in self.decimal_fields:
+            return Decimal(str(value))
+        return value
+
+    def _save(self):
+        stored = [self.version]
+        for name in self.fields:
+            value = self._values.get(name)
+            if value is not None and name in self.decimal_fields:
+                value = str(value)
+            stored.append(value)
+        # Fields that aren't set at the end of the list are left out.
+        while stored[-1] is None:
+            stored.pop()
+        self._session[self.session_key] = simplejson.dumps(
+            stored, cls=DjangoJSONEncoder, separators=(",", ":"))
+
+    def __contains__(self, name):
+        return name in self._load()
+
+    def get(self, name, default=None):
+        return self._load().get(name, default)
+
+    @property
+    def step(self):
+        return self.get("step")
+
+    def update(self, **values):
+        """
+        Sets the given fields, removing those given as ``None``, and
+        writes the state to the session if any of them have changed.
+        """
+        current = self._load()
+        dirty = False
+        for name, value in values.items():
+            if name not in self.fields:
+                raise KeyError(name)
+            if value is None:
+                if name in current:
+                    del current[name]
+                    dirty = True
+            else:
+                value = self._convert(name, value)
+                if name not in current or current[name] != value:
+                    current[name] = value
+                    dirty = True
+        if dirty:
+            self._save()
+
+    def clear(self, *names):
+        """
+        Removes the given fields.
+        """
+        self.update(**dict([(name, None) for name in names]))
+
+
+def checkout_state(request):
+    """
+    Returns the ``CheckoutState`` for the request, which is set up by
+    ``ShopMiddleware``, or a new one for the request's session if it
+    hasn't been through the middleware.
+    """
+    state = getattr(request, "checkout_state", None)
+    if state is None:
+        state = CheckoutState(request.session)
+    return state
 
 
 class EmptyCart(object):
@@ -45,7 +181,17 @@ class EmptyCart(object):
         from cartridge.shop.models import Cart
         cart = Cart.objects.create(last_updated=now())
         cart.add_item(*args, **kwargs)
-        self._request.session["cart"] = cart.id
+        checkout_state(self._request).update(cart=cart.id)
+
+    def add_items(self, *args, **kwargs):
+        """
+        Create a real cart object as ``add_item`` does, and add the
+        items to it.
+        """
+        from cartridge.shop.models import Cart
+        cart = Cart.objects.create(last_updated=now())
+        cart.add_items(*args, **kwargs)
+        checkout_state(self._request).update(cart=cart.id)
 
 
 def make_choices(choices):
@@ -63,31 +209,40 @@ def recalculate_discount(request):
     from cartridge.shop.models import Cart
     # Rebind the cart to request since it's been modified.
     request.cart = Cart.objects.from_request(request)
-    discount_code = request.session.get("discount_code", "")
+    state = checkout_state(request)
+    discount_code = state.get("discount_code", "")
     discount_form = DiscountForm(request, {"discount_code": discount_code})
     if discount_form.is_valid():
         discount_form.set_discount()
     else:
-        try:
-            del request.session["discount_total"]
-        except KeyError:
-            pass
+        state.clear("discount_total")
+
+
+def set_wishlist(request, response, skus):
+    """
+    Stores the SKUs in the wishlist - in the database for
+    authenticated users, otherwise in the wishlist cookie.
+    """
+    from cartridge.shop.models import WishlistItem
+    if request.user.is_authenticated():
+        WishlistItem.objects.set_skus(request.user, skus)
+    else:
+        set_cookie(response, "wishlist", ",".join(skus))
 
 
 def set_shipping(request, shipping_type, shipping_total):
     """
-    Stores the shipping type and total in the session.
+    Stores the shipping type and total in the checkout state.
     """
-    request.session["shipping_type"] = shipping_type
-    request.session["shipping_total"] = shipping_total
+    checkout_state(request).update(shipping_type=shipping_type,
+                                   shipping_total=shipping_total)
 
 
 def set_tax(request, tax_type, tax_total):
     """
-    Stores the tax type and total in the session.
+    Stores the tax type and total in the checkout state.
     """
-    request.session["tax_type"] = tax_type
-    request.session["tax_total"] = tax_total
+    checkout_state(request).update(tax_type=tax_type, tax_total=tax_total)
 
 
 def sign(value):
@@ -1,34 +1,47 @@
-from collections import defaultdict
+from re import match
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.messages import info
 from django.core.urlresolvers import get_callable, reverse
+from django.db.models import Sum
 from django.http import Http404, HttpResponse
+from django.middleware.csrf import get_token
 from django.shortcuts import get_object_or_404, redirect
 from django.template import RequestContext
-from django.template.defaultfilters import slugify
-from django.template.loader import get_template
+from django.template.loader import render_to_string
 from django.utils import simplejson
 from django.utils.translation import ugettext as _
 from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_POST
 
 from mezzanine.conf import settings
 from mezzanine.utils.importing import import_dotted_path
 from mezzanine.utils.views import render, set_cookie, paginate
 
 from cartridge.shop import checkout
-from cartridge.shop.forms import AddProductForm, DiscountForm, CartItemFormSet
-from cartridge.shop.models import Product, ProductVariation, Order, OrderItem
-from cartridge.shop.models import DiscountCode
-from cartridge.shop.utils import recalculate_discount, sign
+from cartridge.shop.cacheable import conditional_response
+from cartridge.shop.discounts import any_active_codes
+from cartridge.shop.editable import use_editable
+from cartridge.shop.forms import AddProductForm, CartItemForm, CartItemFormSet
+from cartridge.shop.forms import DiscountForm, QuickOrderForm
+from cartridge.shop.instrumentation import timer
+from cartridge.shop.invoices import invoice_context, invoice_filename
+from cartridge.shop.invoices import invoice_pdf
+from cartridge.shop.models import CartItem, Product, ProductVariation
+from cartridge.shop.models import Order, OrderItem
+from cartridge.shop.search import search_products
+from cartridge.shop.templatetags.shop_tags import currency
+from cartridge.shop.tasks import run_order_tasks
+from cartridge.shop.utils import recalculate_discount, set_wishlist, sign
 
 
-# Set up checkout handlers.
+# Set up checkout handlers, timed by ``cartridge.shop.instrumentation``.
 handler = lambda s: import_dotted_path(s) if s else lambda *args: None
-billship_handler = handler(settings.SHOP_HANDLER_BILLING_SHIPPING)
-tax_handler = handler(settings.SHOP_HANDLER_TAX)
-payment_handler = handler(settings.SHOP_HANDLER_PAYMENT)
-order_handler = handler(settings.SHOP_HANDLER_ORDER)
+timed = lambda name, s: timer("checkout.%s" % name)(handler(s))
+billship_handler = timed("billship_handler",
+                         settings.SHOP_HANDLER_BILLING_SHIPPING)
+tax_handler = timed("tax_handler", settings.SHOP_HANDLER_TAX)
+payment_handler = timed("payment_handler", settings.SHOP_HANDLER_PAYMENT)
 
 
 def product(request, slug, template="shop/product.html"):
@@ -38,6 +51,9 @@ def product(request, slug, template="shop/product.html"):
     """
     published_products = Product.objects.published(for_user=request.user)
     product = get_object_or_404(published_products, slug=slug)
+    not_modified = conditional_response(request)
+    if not_modified is not None:
+        return not_modified
     fields = [f.name for f in ProductVariation.option_fields()]
     variations = product.variations.all()
     variations_json = simplejson.dumps([dict([(f, getattr(v, f))
@@ -66,7 +82,7 @@ def product(request, slug, template="shop/product.html"):
                     skus.append(sku)
                 info(request, _("Item added to wishlist"))
                 response = redirect("shop_wishlist")
-                set_cookie(response, "wishlist", ",".join(skus))
+                set_wishlist(request, response, skus)
                 return response
     context = {
         "product": product,
@@ -115,19 +131,20 @@ def wishlist(request, template="shop/wishlist.html"):
         if not error:
             info(request, message)
             response = redirect(url)
-            set_cookie(response, "wishlist", ",".join(skus))
+            set_wishlist(request, response, skus)
             return response
 
-    # Remove skus from the cookie that no longer exist.
+    # Remove skus from the wishlist that no longer exist.
     published_products = Product.objects.published(for_user=request.user)
     f = {"product__in": published_products, "sku__in": skus}
     wishlist = ProductVariation.objects.filter(**f).select_related(depth=1)
-    wishlist = sorted(wishlist, key=lambda v: skus.index(v.sku))
+    positions = dict(zip(skus, range(len(skus))))
+    wishlist = sorted(wishlist, key=lambda v: positions[v.sku])
     context = {"wishlist_items": wishlist, "error": error}
     response = render(request, template, context)
     if len(wishlist) < len(skus):
         skus = [variation.sku for variation in wishlist]
-        set_cookie(response, "wishlist", ",".join(skus))
+        set_wishlist(request, response, skus)
     return response
 
 
@@ -160,13 +177,181 @@ def cart(request, template="shop/cart.html"):
         if valid:
             return redirect("shop_cart")
     context = {"cart_formset": cart_formset}
-    settings.use_editable()
-    if (settings.SHOP_DISCOUNT_FIELD_IN_CART and
-        DiscountCode.objects.active().count() > 0):
+    use_editable(request)
+    if settings.SHOP_DISCOUNT_FIELD_IN_CART and any_active_codes():
         context["discount_form"] = discount_form
     return render(request, template, context)
 
 
+def cart_json(request, errors=None):
+    """
+    Return a JSON response with the cart's totals and items, for the
+    AJAX cart views below, along with the errors for an invalid
+    request.
+    """
+    cart = request.cart
+    data = {
+        "quantity": cart.total_quantity(),
+        "total_price": currency(cart.total_price()),
+        "discount_total": currency(
+            request.checkout_state.get("discount_total", 0)),
+        "items": [{"id": item.id, "sku": item.sku, "quantity": item.quantity,
+                   "total_price": currency(item.total_price)}
+                  for item in cart],
+    }
+    status = 200
+    if errors is not None:
+        data["errors"] = errors
+        status = 400
+    return HttpResponse(simplejson.dumps(data), status=status,
+                        mimetype="application/json")
+
+
+def cart_item(request):
+    """
+    Return the item in the current cart for the ``item`` ID posted.
+    """
+    item_id = request.POST.get("item", "")
+    if request.cart.pk is None or not match(r"^\d+$", item_id):
+        raise Http404
+    return get_object_or_404(CartItem, id=item_id, cart=request.cart.pk)
+
+
+@never_cache
+@require_POST
+def cart_add(request):
+    """
+    Add a variation to the cart, given either by its ``sku`` or by a
+    ``product`` ID and its options, and return the cart as JSON.
+    """
+    product = None
+    sku = request.POST.get("sku")
+    published_products = Product.objects.published(for_user=request.user)
+    if sku:
+        if not published_products.filter(variations__sku=sku).exists():
+            raise Http404
+    else:
+        product_id = request.POST.get("product", "")
+        if not match(r"^\d+$", product_id):
+            raise Http404
+        product = get_object_or_404(published_products, id=product_id)
+    add_product_form = AddProductForm(request.POST, product=product,
+                                      to_cart=True)
+    if not add_product_form.is_valid():
+        return cart_json(request, add_product_form.errors)
+    quantity = add_product_form.cleaned_data["quantity"]
+    request.cart.add_item(add_product_form.variation, quantity)
+    recalculate_discount(request)
+    return cart_json(request)
+
+
+@never_cache
+@require_POST
+def cart_add_items(request):
+    """
+    Add many variations to the cart at once, with the SKUs and
+    quantities given as for ``quick_order``, and return the cart as
+    JSON, with an error for each line that can't be added.
+    """
+    quick_order_form = QuickOrderForm(request.POST)
+    if not quick_order_form.is_valid():
+        return cart_json(request, quick_order_form.errors)
+    request.cart.add_items(quick_order_form.variations)
+    recalculate_discount(request)
+    return cart_json(request)
+
+
+@never_cache
+@require_POST
+def cart_update(request):
+    """
+    Change the quantity of an item in the cart, removing it if the
+    quantity is zero, and return the cart as JSON.
+    """
+    cart_item_form = CartItemForm(request.POST, instance=cart_item(request))
+    if not cart_item_form.is_valid():
+        return cart_json(request, cart_item_form.errors)
+    cart_item_form.save()
+    recalculate_discount(request)
+    return cart_json(request)
+
+
+@never_cache
+@require_POST
+def cart_remove(request):
+    """
+    Remove an item from the cart and return the cart as JSON.
+    """
+    cart_item(request).delete()
+    recalculate_discount(request)
+    return cart_json(request)
+
+
+@never_cache
+@require_POST
+def cart_discount(request):
+    """
+    Apply a discount code to the cart and return the cart as JSON.
+    """
+    discount_form = DiscountForm(request, request.POST)
+    if not discount_form.is_valid():
+        return cart_json(request, discount_form.errors)
+    discount_form.set_discount()
+    return cart_json(request)
+
+
+@never_cache
+def cart_state(request):
+    """
+    Return the user panel with the cart summary, and the CSRF token
+    for the current visitor as JSON, along with whether each variation
+    is in stock for the ``product`` ID given, for the product and
+    category pages rendered without them when ``SHOP_CACHEABLE_PAGES``
+    is ``True``.
+    """
+    cart = request.cart
+    context = RequestContext(request)
+    state = {
+        "panel": render_to_string("includes/user_panel.html", context),
+        "cart_quantity": cart.total_quantity(),
+        "cart_total": currency(cart.total_price()),
+        "wishlist_quantity": len(request.wishlist),
+        "csrf_token": get_token(request),
+    }
+    product_id = request.GET.get("product", "")
+    if match(r"^\d+$", product_id):
+        products = Product.objects.published(for_user=request.user)
+        products = products.filter(id=product_id)
+        variations = ProductVariation.objects.filter(product__in=products)
+        stock = dict(variations.values_list("sku", "num_in_stock"))
+        # The live number in stock for each variation, as given by
+        # ``ProductVariation.live_num_in_stock``.
+        items = CartItem.objects.filter(sku__in=stock.keys())
+        for item in items.values("sku").annotate(in_carts=Sum("quantity")):
+            if stock[item["sku"]] is not None:
+                stock[item["sku"]] -= item["in_carts"]
+        state["in_stock"] = dict([(sku, num is None or num > 0)
+                                  for sku, num in stock.items()])
+    return HttpResponse(simplejson.dumps(state),
+                        mimetype="application/json")
+
+
+@never_cache
+def quick_order(request, template="shop/quick_order.html"):
+    """
+    Display the quick order form and handle adding the SKUs and
+    quantities given to the cart.
+    """
+    quick_order_form = QuickOrderForm(request.POST or None)
+    if request.method == "POST" and quick_order_form.is_valid():
+        request.cart.add_items(quick_order_form.variations)
+        recalculate_discount(request)
+        info(request, _("Items added to cart"))
+        return redirect("shop_cart")
+    context = {"quick_order_form": quick_order_form}
+    return render(request, template, context)
+
+
 @never_cache
 def checkout_steps(request):
     """
@@ -205,12 +390,12 @@ def checkout_steps(request):
             # process, but remove sensitive fields from the session
             # such as the credit card fields so that they're never
             # stored anywhere.
-            request.session["order"] = dict(form.cleaned_data)
+            order_data = dict(form.cleaned_data)
             sensitive_card_fields = ("card_number", "card_expiry_month",
                                      "card_expiry_year", "card_ccv")
-            for field in sensitive_card_fields:
-                if field in request.session["order"]:
-                    del request.session["order"][field]
+            for field in sensitive_card_fields + ("step",):
+                order_data.pop(field, None)
+            request.checkout_state.update(order=order_data)
 
             # FIRST CHECKOUT STEP - handle shipping and discount code.
             if step == checkout.CHECKOUT_STEP_FIRST:
@@ -228,27 +413,35 @@ def checkout_steps(request):
                 # fields. If there is a payment error then delete the
                 # order, otherwise remove the cart items from stock
                 # and send the order receipt email.
+                # If the final step has already been submitted with
+                # the same checkout token, rather than taking payment
+                # again we redirect to a page that waits for the first
+                # submission to finish.
                 order = form.save(commit=False)
-                order.setup(request)
+                token = form.cleaned_data.get("checkout_token")
+                order.checkout_token = token
                 # Try payment.
                 try:
+                    if not checkout.setup_order(request, order):
+                        url = reverse("shop_checkout_processing")
+                        return redirect("%s?token=%s" % (url, token))
                     transaction_id = payment_handler(request, form, order)
                 except checkout.CheckoutError, e:
                     # Error in payment handler.
-                    order.delete()
+                    if order.id is not None:
+                        order.delete()
                     checkout_errors.append(e)
                     if settings.SHOP_CHECKOUT_STEPS_CONFIRMATION:
                         step -= 1
                 else:
                     # Finalize order - ``order.complete()`` performs
                     # final cleanup of session and cart.
-                    # ``order_handler()`` can be defined by the
-                    # developer to implement custom order processing.
-                    # Then send the order email to the customer.
+                    # ``run_order_tasks()`` then runs or defers the
+                    # remaining tasks, such as the custom order handler
+                    # and sending the order email to the customer.
                     order.transaction_id = transaction_id
                     order.complete(request)
-                    order_handler(request, form, order)
-                    checkout.send_order_email(request, order)
+                    run_order_tasks(request, form, order)
                     # Set the cookie for remembering address details
                     # if the "remember" checkbox was checked.
                     response = redirect("shop_complete")
@@ -270,11 +463,8 @@ def checkout_steps(request):
 
     # Update the step so that we don't rely on POST data to take us back to
     # the same point in the checkout process.
-    try:
-        request.session["order"]["step"] = step
-        request.session.modified = True
-    except KeyError:
-        pass
+    if "order" in request.checkout_state:
+        request.checkout_state.update(step=step)
 
     step_vars = checkout.CHECKOUT_STEPS[step - 1]
     template = "shop/%s.html" % step_vars["template"]
@@ -285,6 +475,25 @@ def checkout_steps(request):
     return render(request, template, context)
 
 
+@never_cache
+def checkout_processing(request, template="shop/checkout_processing.html"):
+    """
+    Displayed when the final checkout step is submitted again while
+    the first submission is still being processed. The page reloads
+    itself every ``SHOP_CHECKOUT_PROCESSING_INTERVAL`` seconds until
+    the order is complete, or returns to the checkout if payment for
+    the first submission failed.
+    """
+    status = checkout.processing_status(request, request.GET.get("token"))
+    if status == "complete":
+        return redirect("shop_complete")
+    elif status == "failed":
+        return redirect("shop_checkout")
+    context = {"steps": checkout.CHECKOUT_STEPS,
+               "interval": settings.SHOP_CHECKOUT_PROCESSING_INTERVAL}
+    return render(request, template, context)
+
+
 @never_cache
 def complete(request, template="shop/complete.html"):
     """
@@ -297,15 +506,6 @@ def complete(request, template="shop/complete.html"):
     except Order.DoesNotExist:
         raise Http404
     items = order.items.all()
-    # Assign product names to each of the items since they're not
-    # stored.
-    skus = [item.sku for item in items]
-    variations = ProductVariation.objects.filter(sku__in=skus)
-    names = {}
-    for variation in variations.select_related(depth=1):
-        names[variation.sku] = variation.product.title
-    for i, item in enumerate(items):
-        setattr(items[i], "name", names[item.sku])
     context = {"order": order, "items": items,
                "steps": checkout.CHECKOUT_STEPS}
     return render(request, template, context)
@@ -323,18 +523,15 @@ def invoice(request, order_id, template="shop/order_invoice.html"):
     elif not request.user.is_staff:
         lookup["user_id"] = request.user.id
     order = get_object_or_404(Order, **lookup)
-    context = {"order": order}
-    context.update(order.details_as_dict())
-    context = RequestContext(request, context)
     if request.GET.get("format") == "pdf":
-        response = HttpResponse(mimetype="application/pdf")
-        name = slugify("%s-invoice-%s" % (settings.SITE_TITLE, order.id))
-        response["Content-Disposition"] = "attachment; filename=%s.pdf" % name
-        html = get_template(template).render(context)
-        import ho.pisa
-        ho.pisa.CreatePDF(html, response)
+        # PDFs are rendered once for each version of the order and
+        # then stored, see ``cartridge.shop.invoices``.
+        response = HttpResponse(invoice_pdf(order, template),
+                                mimetype="application/pdf")
+        name = invoice_filename(order)
+        response["Content-Disposition"] = "attachment; filename=%s" % name
         return response
-    return render(request, template, context)
+    return render(request, template, invoice_context(order, request))
 
 
 @login_required
@@ -347,12 +544,39 @@ def order_history(request, template="shop/order_history.html"):
                       request.GET.get("page", 1),
                       settings.SHOP_PER_PAGE_CATEGORY,
                       settings.MAX_PAGING_LINKS)
-    # Add the total quantity to each order - this can probably be
-    # replaced with fetch_related and Sum when we drop Django 1.3
-    order_quantities = defaultdict(int)
-    for item in OrderItem.objects.filter(order__user_id=request.user.id):
-        order_quantities[item.order_id] += item.quantity
+    # Add the total quantity to each order, only aggregating the items
+    # for the orders on the current page.
+    order_ids = [order.id for order in orders.object_list]
+    items = OrderItem.objects.filter(order__in=order_ids).values("order")
+    quantities = items.annotate(quantity_total=Sum("quantity"))
+    order_quantities = dict([(q["order"], q["quantity_total"])
+                             for q in quantities])
     for order in orders.object_list:
-        setattr(order, "quantity_total", order_quantities[order.id])
+        setattr(order, "quantity_total", order_quantities.get(order.id, 0))
     context = {"orders": orders}
     return render(request, template, context)
+
+
+def search(request, template="shop/search_results.html"):
+    """
+    Display the published products matching the search query, best
+    matches first, using the product search index, or Mezzanine's
+    search if the index hasn't been built.
+    """
+    use_editable(request)
+    query = request.GET.get("q", "")
+    product_ids = search_products(query, for_user=request.user)
+    if product_ids is None:
+        results = Product.objects.search(query, for_user=request.user)
+    else:
+        results = product_ids
+    products = paginate(results, request.GET.get("page", 1),
+                        settings.SHOP_PER_PAGE_CATEGORY,
+                        settings.MAX_PAGING_LINKS)
+    if product_ids is not None:
+        # Only load the products on the page, in the order ranked.
+        page = Product.objects.in_bulk(products.object_list)
+        products.object_list = [page[i] for i in products.object_list
+                                if i in page]
+    context = {"query": query, "products": products}
+    return render(request, template, context)
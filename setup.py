@@ -38,6 +38,7 @@ try:
         packages=find_packages(),
 
         install_requires=[
+            "django >= 1.5",
             "mezzanine >= 1.4.4",
             "pisa >= 3.0.33",
         ],